@@ -0,0 +1,17 @@
+import os
+import sys
+
+from nexsan_exporter import capture
+
+DEFAULT_FILE = os.path.join(os.path.dirname(__file__), '..', 'test', 'test_nexsan', 'opstats1.xml')
+
+def read_document():
+    '''
+    Returns the document named on the command line (a plain opstats file, or
+    a capture saved by --record), or a sample document.
+    '''
+    path = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_FILE
+    if path.endswith(capture.SUFFIX):
+        return capture.load(path)
+    with open(path, 'rb') as f:
+        return f.read()
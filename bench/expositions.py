@@ -0,0 +1,61 @@
+'''
+Compares serving an exposition as a list of bytes (copied through Python's
+socket writes) with serving it from a MemoryFile via wsgi.file_wrapper
+(sent by the kernel with sendfile), over keep-alive connections to a local
+server.
+
+Run from the top of the source tree:
+
+    $ python3 -m bench.expositions [size in bytes]
+'''
+import http.client
+import ipaddress
+import sys
+import threading
+import time
+
+from nexsan_exporter import memfile
+from nexsan_exporter import wsgiext
+
+REQUESTS = 500
+
+def serve(app):
+    lanes = [wsgiext.Lane('default', 4)]
+    server = wsgiext.Server((ipaddress.ip_address('127.0.0.1'), 0), wsgiext.SilentRequestHandler, lanes, lambda path: 'default', None, keepalive_timeout=10, keepalive_max_requests=0)
+    server.set_app(app)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def run(server, path):
+    conn = http.client.HTTPConnection('127.0.0.1', server.server_port)
+    start = time.perf_counter()
+    total = 0
+    for i in range(REQUESTS):
+        conn.request('GET', path)
+        total += len(conn.getresponse().read())
+    elapsed = time.perf_counter() - start
+    conn.close()
+    return elapsed, total
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 2000000
+    data = b'x' * (size - 1) + b'\n'
+    m = memfile.MemoryFile(data)
+
+    def app(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/plain'), ('Content-Length', str(len(data)))])
+        if environ['PATH_INFO'] == '/file':
+            return environ['wsgi.file_wrapper'](m.open())
+        return [data]
+
+    server = serve(app)
+    try:
+        for name, path in [('list', '/list'), ('file_wrapper', '/file')]:
+            elapsed, total = run(server, path)
+            print('{:13} {:8.3f} ms/request {:8.1f} MB/s'.format(name, elapsed / REQUESTS * 1000, total / elapsed / 1e6))
+    finally:
+        server.shutdown()
+        server.server_close()
+
+if __name__ == '__main__':
+    main()
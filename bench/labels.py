@@ -0,0 +1,50 @@
+'''
+Compares the memory allocated by collecting a document with a fresh label
+cache (as if every probe were the first) and with one kept across probes.
+
+Run from the top of the source tree:
+
+    $ python3 -m bench.labels [FILE | CAPTURE]
+'''
+import tracemalloc
+from xml.etree import ElementTree
+
+from nexsan_exporter import nexsan, targets
+
+from . import common
+
+def collect(body, labels):
+    labels.rotate()
+    return list(nexsan.Collector(ElementTree.fromstring(body), labels).collect())
+
+def measure(body, labels):
+    '''
+    Returns the number of memory blocks and bytes still allocated for the
+    collected families, after parsing and collecting body.
+    '''
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        families = collect(body, labels)
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    stats = after.compare_to(before, 'filename')
+    del families
+    return sum(s.count_diff for s in stats), sum(s.size_diff for s in stats)
+
+def main():
+    body = common.read_document()
+
+    fresh = measure(body, targets.LabelCache())
+
+    labels = targets.LabelCache()
+    collect(body, labels)
+    warm = measure(body, labels)
+
+    print('{:<12} {:>10} {:>12}'.format('label cache', 'blocks', 'bytes'))
+    print('{:<12} {:>10} {:>12}'.format('fresh', *fresh))
+    print('{:<12} {:>10} {:>12}'.format('warm', *warm))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,30 @@
+'''
+Compares the available XML parser engines: the time taken to parse a
+document, and to parse and collect it.
+
+Run from the top of the source tree:
+
+    $ python3 -m bench.parsers [FILE | CAPTURE]
+'''
+import timeit
+
+from nexsan_exporter import nexsan, parsers
+
+from . import common
+
+NUMBER = 50
+
+def best(fn):
+    return min(timeit.repeat(fn, number=NUMBER, repeat=5)) / NUMBER
+
+def main():
+    body = common.read_document()
+
+    print('{:<8} {:>12} {:>18}'.format('engine', 'parse (ms)', 'parse+collect (ms)'))
+    for name, parse in sorted(parsers.ENGINES.items()):
+        p = best(lambda: parse(body))
+        pc = best(lambda: list(nexsan.Collector(parse(body)).collect()))
+        print('{:<8} {:>12.3f} {:>18.3f}'.format(name, p * 1000, pc * 1000))
+
+if __name__ == '__main__':
+    main()
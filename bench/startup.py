@@ -0,0 +1,48 @@
+'''
+Measures how long it takes to import the exporter, and lists the modules that
+take longest to import (as reported by python3 -X importtime).
+
+Run from the top of the source tree:
+
+    $ python3 -m bench.startup
+'''
+import statistics
+import subprocess
+import sys
+import time
+
+RUNS = 20
+
+def importtime():
+    '''
+    Returns (cumulative microseconds, module) for each module imported by a
+    fresh interpreter.
+    '''
+    p = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import nexsan_exporter'], stderr=subprocess.PIPE, check=True)
+    result = []
+    for line in p.stderr.decode().splitlines()[1:]:
+        _, cumulative, module = line.split('|')
+        result.append((int(cumulative), module.strip()))
+    return result
+
+def main():
+    times = []
+    for i in range(RUNS):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', 'import nexsan_exporter'], check=True)
+        times.append(time.perf_counter() - start)
+    baseline = []
+    for i in range(RUNS):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', 'pass'], check=True)
+        baseline.append(time.perf_counter() - start)
+
+    print('interpreter startup:        {:.1f} ms (median of {})'.format(statistics.median(baseline) * 1000, RUNS))
+    print('startup + import exporter:  {:.1f} ms'.format(statistics.median(times) * 1000))
+    print()
+    print('Slowest imports (cumulative, one run):')
+    for us, module in sorted(importtime(), reverse=True)[:15]:
+        print('{:8.1f} ms {}'.format(us / 1000, module))
+
+if __name__ == '__main__':
+    main()
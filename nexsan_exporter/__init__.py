@@ -1,12 +1,34 @@
 import argparse
 import functools
 import ipaddress
+import logging
+import os
 import signal
 import threading
 import wsgiref.simple_server
 
 from . import wsgiext
+from . import capture
+from . import debug
 from . import exporter
+from . import governor
+from . import history
+from . import nexsan
+from . import parsers
+from . import rates
+from . import sampler
+from . import snapshots
+from . import targets
+from . import timing
+
+def percentage(s):
+    '''
+    Parses a command-line argument that must be between 0 and 100.
+    '''
+    value = float(s)
+    if not 0 <= value <= 100:
+        raise argparse.ArgumentTypeError('{} is not between 0 and 100'.format(s))
+    return value
 
 def main():
     '''
@@ -16,10 +38,90 @@ def main():
     parser.add_argument('--bind-address', type=ipaddress.ip_address, default='::', help='IPv6 or IPv4 address to listen on')
     parser.add_argument('--bind-port', type=int, default=9335, help='Port to listen on')
     parser.add_argument('--bind-v6only', type=int, choices=[0, 1], help='If 1, prevent IPv6 sockets from accepting IPv4 connections; if 0, allow; if unspecified, use OS default')
-    parser.add_argument('--thread-count', type=int, help='Number of request-handling threads to spawn')
+    parser.add_argument('--thread-count', type=int, default=wsgiext.DEFAULT_MAX_THREADS, help='Maximum number of threads to handle /probe and /probe_many requests')
+    parser.add_argument('--min-thread-count', type=int, default=1, help='Number of threads to keep for /probe and /probe_many requests when idle')
+    parser.add_argument('--probe-queue-limit', type=int, help='Maximum number of probe requests to queue while all their threads are busy; more are rejected')
+    parser.add_argument('--admin-thread-count', type=int, default=2, help='Number of threads to handle all other requests')
+    parser.add_argument('--admin-queue-limit', type=int, default=16, help='Maximum number of other requests to queue while all their threads are busy')
+    parser.add_argument('--thread-idle-timeout', type=float, default=60, help='Seconds after which idle threads beyond the minimum exit')
+    parser.add_argument('--keepalive-timeout', type=float, default=120, help='Seconds to keep an idle HTTP/1.1 connection open for another request; 0 closes connections after each response')
+    parser.add_argument('--keepalive-max-requests', type=int, default=1000, help='Number of requests after which a connection is closed; 0 for no limit')
+    parser.add_argument('--hedge-percentile', type=percentage, default=targets.hedge_percentile, help='When a target lists several addresses, also try the next one if the preferred address has not answered within this percentile of its recent latencies')
+    parser.add_argument('--max-concurrent-fetches', type=int, default=targets.max_concurrent_fetches, help='Maximum number of simultaneous requests to send to one management address')
+    parser.add_argument('--min-fetch-interval', type=float, default=targets.min_fetch_interval, help='Minimum number of seconds between the start of requests to one management address')
+    parser.add_argument('--fetch-queue-timeout', type=float, default=targets.fetch_queue_timeout, help='Seconds a probe waits for its turn to contact an array before failing')
+    parser.add_argument('--busy-cpu-percent', type=float, default=targets.busy_cpu_percent, help='If nonzero, fetch an array whose controller CPU use is above this percentage only every --busy-interval seconds, answering probes in between from the last document fetched')
+    parser.add_argument('--busy-interval', type=float, default=targets.busy_interval, help='Seconds between fetches of a busy array')
+    parser.add_argument('--xml-parser', choices=sorted(parsers.ENGINES), default=parsers.default, help='XML parser engine to use for opstats documents')
+    parser.add_argument('--no-section-reuse', dest='section_reuse', action='store_false', help='Parse and collect every section of every document fetched, even if it is unchanged since the previous probe of the target')
+    parser.add_argument('--compute-rates', action='store_true', help='Also report the per-second rate of each volume path and port counter, computed from consecutive probes of the target, as a *_per_second gauge')
+    parser.add_argument('--sample-interval', type=float, default=sampler.interval, help='If nonzero, poll each probed target in the background every this many seconds, and report the max, average and quantiles of port throughput')
+    parser.add_argument('--sample-window', type=float, default=sampler.window, help='Seconds of background samples to report over')
+    parser.add_argument('--history-bytes', type=int, default=history.budget, help='If nonzero, keep this many bytes of recent values for each target, to be served by /history')
+    parser.add_argument('--memory-budget-bytes', type=int, default=governor.budget, help='If nonzero, drop the state kept for the least recently probed targets (parsed documents, label caches, snapshots, history and cached expositions) while it uses more than this many bytes in total')
+    parser.add_argument('--memory-check-interval', type=float, default=governor.check_interval, help='Seconds between measurements of the state kept for targets')
+    parser.add_argument('--record', metavar='DIR', help='Save every opstats document fetched, compressed, under this directory')
+    parser.add_argument('--replay', metavar='DIR', help='Answer probes from documents saved by --record under this directory, instead of contacting the arrays')
+    parser.add_argument('--state-directory', metavar='DIR', help='Save the last good document from each target under this directory; after a restart, answer probes from them (marked stale) until each target is fetched again')
+    parser.add_argument('--max-snapshot-age', type=float, default=snapshots.max_age, help='Seconds after which a saved document is too old to answer probes from; 0 for no limit')
+    parser.add_argument('--slow-request-seconds', type=float, default=timing.slow_threshold, help='If nonzero, log the phase timings of probes that take longer than this')
+    parser.add_argument('--slow-request-log-rate', type=float, default=timing.slow_log_rate, help='Log at most this many slow probes per second')
+    parser.add_argument('--enable-debug', action='store_true', help='Serve profiling, memory and thread dumps under /debug')
+
+    subparsers = parser.add_subparsers(dest='command', metavar='COMMAND', help='Without a command, run the exporter')
+    render_parser = subparsers.add_parser('render', help='Print or write the metrics for saved opstats documents, without running the exporter')
+    render_parser.add_argument('files', nargs='+', metavar='FILE', help='opstats document, or a capture saved by --record')
+    render_parser.add_argument('--output-dir', metavar='DIR', help='Instead of printing, write each FILE\'s metrics to DIR/<name>.prom (DIR/<target>/<time>.prom for a capture), atomically (for the node_exporter textfile collector)')
+    render_parser.add_argument('--jobs', type=int, default=os.cpu_count(), help='Number of files to process in parallel')
+    render_parser.add_argument('--bench', action='store_true', help='Print the time taken to read, parse, collect and render each file to stderr')
+    render_parser.add_argument('--xml-parser', choices=sorted(parsers.ENGINES), default=argparse.SUPPRESS, help='XML parser engine to use')
     args = parser.parse_args()
 
-    server = wsgiext.Server((args.bind_address, args.bind_port), wsgiext.SilentRequestHandler, args.thread_count, args.bind_v6only)
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s %(name)s: %(message)s')
+
+    if args.command == 'render':
+        from . import render
+        render.main(args)
+        return
+
+    parsers.default = args.xml_parser
+    nexsan.reuse = args.section_reuse
+    targets.hedge_percentile = args.hedge_percentile
+    targets.max_concurrent_fetches = args.max_concurrent_fetches
+    targets.min_fetch_interval = args.min_fetch_interval
+    targets.fetch_queue_timeout = args.fetch_queue_timeout
+    targets.busy_cpu_percent = args.busy_cpu_percent
+    targets.busy_interval = args.busy_interval
+    rates.enabled = args.compute_rates
+    sampler.interval = args.sample_interval
+    if args.replay is not None and sampler.interval:
+        # Samples come from the arrays, which replaying does not contact.
+        logging.warning('Background sampling is disabled while replaying')
+        sampler.interval = 0
+    sampler.window = args.sample_window
+    history.budget = args.history_bytes
+    governor.budget = args.memory_budget_bytes
+    governor.check_interval = args.memory_check_interval
+    capture.record_directory = args.record
+    capture.replay_directory = args.replay
+    snapshots.directory = args.state_directory
+    snapshots.max_age = args.max_snapshot_age
+    debug.enabled = args.enable_debug
+    timing.slow_threshold = args.slow_request_seconds
+    timing.slow_log_rate = args.slow_request_log_rate
+
+    sockets = wsgiext.listen_fds()
+    if len(sockets) > 1:
+        parser.error('systemd passed {} sockets; only one is supported'.format(len(sockets)))
+    elif sockets:
+        logging.info('Listening on socket passed by systemd: %s', sockets[0].getsockname())
+
+    lanes = [
+        wsgiext.Lane('probe', args.thread_count, args.probe_queue_limit, args.min_thread_count, args.thread_idle_timeout),
+        wsgiext.Lane('admin', args.admin_thread_count, args.admin_queue_limit, args.admin_thread_count, args.thread_idle_timeout),
+    ]
+    exporter.lanes = lanes
+    server = wsgiext.Server((args.bind_address, args.bind_port), wsgiext.SilentRequestHandler, lanes, exporter.lane, args.bind_v6only, sock=sockets[0] if sockets else None, keepalive_timeout=args.keepalive_timeout, keepalive_max_requests=args.keepalive_max_requests)
     server.set_app(exporter.wsgi_app)
     wsgi_thread = threading.Thread(target=functools.partial(server.serve_forever, 86400), name='wsgi')
 
@@ -27,6 +129,18 @@ def main():
         server.shutdown()
     signal.signal(signal.SIGTERM, handle_sigterm)
 
+    if snapshots.directory is not None:
+        try:
+            os.makedirs(snapshots.directory, exist_ok=True)
+        except OSError as e:
+            logging.warning('Snapshots disabled: could not create state directory: %s', e)
+            snapshots.directory = None
+    if snapshots.directory is not None:
+        threading.Thread(target=snapshots.load, name='snapshots', daemon=True).start()
+
+    if governor.budget:
+        threading.Thread(target=governor.run, name='governor', daemon=True).start()
+
     wsgi_thread.start()
 
     wsgi_thread.join()
@@ -0,0 +1,96 @@
+'''
+Recording of raw opstats responses, and replaying them in place of the
+arrays.
+
+Captures are stored gzip-compressed, one directory per target, named by the
+time they were taken: DIR/<target>/<unix time in ms>.xml.gz.
+'''
+import concurrent.futures
+import gzip
+import logging
+import mmap
+import os
+import tempfile
+import threading
+import time
+import urllib.parse
+
+logger = logging.getLogger(__name__)
+
+# If set, every opstats document fetched is saved under this directory.
+record_directory = None
+
+# If set, probes are answered from the captures under this directory instead
+# of contacting the arrays.
+replay_directory = None
+
+SUFFIX = '.xml.gz'
+
+_replay_positions = {}
+_replay_lock = threading.Lock()
+
+# Captures are compressed and written here, off the request thread.
+_writer = concurrent.futures.ThreadPoolExecutor(1)
+
+def target_directory(directory, target):
+    return os.path.join(directory, urllib.parse.quote(target, safe=''))
+
+def record(target, body, timestamp=None):
+    '''
+    Saves a captured document for target. The file is written in the
+    background.
+    '''
+    if timestamp is None:
+        timestamp = time.time()
+    _writer.submit(write, target, body, timestamp)
+
+def write(target, body, timestamp):
+    '''
+    Writes a capture under a temporary name and then renames it, so a replay
+    never sees a partial file.
+    '''
+    try:
+        d = target_directory(record_directory, target)
+        os.makedirs(d, exist_ok=True)
+
+        fd, tmp = tempfile.mkstemp(dir=d, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(gzip.compress(body))
+            os.replace(tmp, os.path.join(d, '{}{}'.format(int(timestamp * 1000), SUFFIX)))
+        except BaseException:
+            os.unlink(tmp)
+            raise
+    except OSError:
+        logger.warning('Could not save capture of %s', target, exc_info=True)
+
+def captures(directory, target):
+    '''
+    Returns the paths of the captures of target, oldest first.
+    '''
+    d = target_directory(directory, target)
+    names = [n for n in os.listdir(d) if n.endswith(SUFFIX)]
+    names.sort(key=lambda n: int(n[:-len(SUFFIX)]))
+    return [os.path.join(d, n) for n in names]
+
+def load(path):
+    '''
+    Returns the document in a capture file, decompressed straight from a
+    memory map of the file.
+    '''
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        return gzip.decompress(m)
+
+def replay(target):
+    '''
+    Returns the next capture of target, cycling through them in the order
+    they were recorded.
+    '''
+    paths = captures(replay_directory, target)
+    if not paths:
+        raise FileNotFoundError('No captures of {!r} in {!r}'.format(target, replay_directory))
+
+    with _replay_lock:
+        i = _replay_positions.get(target, 0) % len(paths)
+        _replay_positions[target] = i + 1
+    return load(paths[i])
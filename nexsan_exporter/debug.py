@@ -0,0 +1,120 @@
+'''
+Diagnostic endpoints, for finding out where a running exporter spends its
+time and memory. They are only served if enabled on the command line.
+
+/debug/profile?seconds=N
+    Samples the stacks of every thread for N seconds, and returns the
+    functions seen most often along with each distinct stack, in the
+    "collapsed" format used by flame graph tools.
+
+/debug/tracemalloc
+    Starts tracing memory allocations; once tracing, returns the source lines
+    that hold the most memory. ?stop=1 stops tracing.
+
+/debug/threads
+    Returns the current stack of every thread.
+'''
+import collections
+import io
+import sys
+import threading
+import time
+import traceback
+import urllib.parse
+import wsgiref.util
+
+# Whether the endpoints are served.
+enabled = False
+
+MAX_PROFILE_SECONDS = 60
+PROFILE_INTERVAL = 0.005
+
+def wsgi_app(environ, start_response):
+    name = wsgiref.util.shift_path_info(environ)
+    qs = urllib.parse.parse_qs(environ['QUERY_STRING'])
+    if name == 'profile':
+        body = profile(min(float(qs.get('seconds', ['10'])[0]), MAX_PROFILE_SECONDS))
+    elif name == 'tracemalloc':
+        body = allocations(int(qs.get('limit', ['25'])[0]), 'stop' in qs)
+    elif name == 'threads':
+        body = threads()
+    else:
+        start_response('404 Not Found', [('Content-Type', 'text/plain')])
+        return [b'Not Found\r\n']
+
+    start_response('200 OK', [('Content-Type', 'text/plain; charset=utf-8')])
+    return [body.encode('utf-8')]
+
+def frame_name(frame):
+    code = frame.f_code
+    return '{} ({}:{})'.format(code.co_name, code.co_filename, frame.f_lineno)
+
+def profile(seconds):
+    '''
+    Samples every other thread's stack each PROFILE_INTERVAL for the given
+    number of seconds.
+    '''
+    me = threading.get_ident()
+    names = {t.ident: t.name for t in threading.enumerate()}
+    stacks = collections.Counter()
+    functions = collections.Counter()
+    samples = 0
+
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(frame_name(frame))
+                frame = frame.f_back
+            stack.reverse()
+            stacks[(names.get(ident, str(ident)),) + tuple(stack)] += 1
+            for f in set(stack):
+                functions[f] += 1
+            samples += 1
+        time.sleep(PROFILE_INTERVAL)
+
+    out = io.StringIO()
+    print('{} stack samples over {:.1f}s'.format(samples, seconds), file=out)
+    print(file=out)
+    print('Functions on the stack in the most samples:', file=out)
+    for f, n in functions.most_common(50):
+        print('{:8d} {:6.1%} {}'.format(n, n / max(samples, 1), f), file=out)
+    print(file=out)
+    print('Collapsed stacks (thread;outermost;...;innermost count):', file=out)
+    for stack, n in stacks.most_common():
+        print('{} {}'.format(';'.join(stack), n), file=out)
+    return out.getvalue()
+
+def allocations(limit, stop):
+    import tracemalloc
+
+    if stop:
+        tracemalloc.stop()
+        return 'Stopped tracing allocations.\n'
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+        return 'Started tracing allocations; request this page again for a snapshot.\n'
+
+    snapshot = tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+    ])
+    current, peak = tracemalloc.get_traced_memory()
+
+    out = io.StringIO()
+    print('Traced memory: {} bytes (peak {} bytes)'.format(current, peak), file=out)
+    print(file=out)
+    for stat in snapshot.statistics('lineno')[:limit]:
+        print(stat, file=out)
+    return out.getvalue()
+
+def threads():
+    names = {t.ident: t.name for t in threading.enumerate()}
+    out = io.StringIO()
+    for ident, frame in sys._current_frames().items():
+        print('Thread {} ({}):'.format(names.get(ident, '?'), ident), file=out)
+        traceback.print_stack(frame, file=out)
+        print(file=out)
+    return out.getvalue()
@@ -1,11 +1,43 @@
+import collections
+import concurrent.futures
+import functools
 import io
+import itertools
+import json
+import logging
 import socket
+import threading
 import urllib
 import wsgiref.util
 
-import prometheus_client
-
+from . import debug
+from . import governor
+from . import history
+from . import memfile
 from . import nexsan
+from . import rates
+from . import sampler
+from . import snapshots
+from . import targets
+from . import timing
+
+logger = logging.getLogger(__name__)
+
+# prometheus_client is imported by the functions that use it, rather than
+# here, so that it is loaded while serving the first request instead of
+# delaying startup.
+
+# The server's wsgiext.Lanes, whose state is reported by /metrics; set at
+# startup.
+lanes = []
+
+# The exposition of each target's last document, if it has been probed twice
+# in a row with the same document, as (document digest, memfile.MemoryFile).
+_expositions = {}
+_expositions_lock = threading.Lock()
+
+# Probes started by probe_many run here, rather than on the request thread.
+_probe_executor = concurrent.futures.ThreadPoolExecutor(16)
 
 def wsgi_app(environ, start_response):
     '''
@@ -16,10 +48,28 @@ def wsgi_app(environ, start_response):
         return front(environ, start_response)
     if name == 'probe':
         return probe(environ, start_response)
+    elif name == 'probe_many':
+        return probe_many(environ, start_response)
+    elif name == 'history':
+        return show_history(environ, start_response)
+    elif name == 'debug' and debug.enabled:
+        return debug.wsgi_app(environ, start_response)
     elif name == 'metrics':
         return prometheus_app(environ, start_response)
     return not_found(environ, start_response)
 
+def lane(path):
+    '''
+    Returns the name of the server lane that should handle a request for
+    path: 'probe' for requests that contact arrays, which can take seconds,
+    and 'admin' for everything else, which is answered from memory, so that
+    health checks and /metrics never queue behind probes.
+    '''
+    if path is None:
+        return 'probe'
+    name = path.lstrip('/').split('/', 1)[0]
+    return 'probe' if name in ('probe', 'probe_many') else 'admin'
+
 def front(environ, start_response):
     '''
     Front page, containing a form for interactive use, and a link to the
@@ -61,16 +111,338 @@ def probe(environ, start_response):
     '''
     Performs a probe using the given target address.
     '''
+    import prometheus_client
+
+    qs = urllib.parse.parse_qs(environ['QUERY_STRING'])
+
+    target = qs['target'][0]
+    user, pass_ = qs['user'][0], qs['pass'][0]
+    timings = timing.Timings()
+
+    # Done before starting the response, so that a failure is still reported
+    # with an error status rather than as a truncated exposition.
+    collector = collect_document(target=target, user=user, pass_=pass_, timings=timings)
+
+    exposition = cached_exposition(target, collector, timings)
+    if exposition is not None:
+        start_response('200 OK', [
+            ('Content-Type', prometheus_client.CONTENT_TYPE_LATEST),
+            ('Content-Length', str(exposition.size)),
+            ('Server-Timing', timings.header()),
+        ])
+        timing.log_if_slow(target, timings)
+        file_wrapper = environ.get('wsgi.file_wrapper', wsgiref.util.FileWrapper)
+        return file_wrapper(exposition.open())
+
+    # The body is rendered as it is sent, so the render phase can only be
+    # reported in the slow request log.
+    start_response('200 OK', [
+        ('Content-Type', prometheus_client.CONTENT_TYPE_LATEST),
+        ('Server-Timing', timings.header()),
+    ])
+    return render_timed(families(collector, target, user, pass_), target, timings)
+
+def render_timed(families, target, timings):
+    '''
+    Like render, but records the time taken as the render phase, and logs the
+    probe once the body has been sent if it was slow.
+    '''
+    try:
+        with timings.phase('render'):
+            yield from render(families)
+    finally:
+        timing.log_if_slow(target, timings)
+
+def collect(target, user, pass_, timings=None):
+    '''
+    Probes a target, returning an iterator over its metric families. The
+    probe and collection are finished by the time this returns; only the
+    construction of each family is left.
+    '''
+    collector = collect_document(target, user, pass_, timings)
+    return families(collector, target, user, pass_)
+
+def collect_document(target, user, pass_, timings=None):
+    '''
+    Probes a target, returning a nexsan.Collector whose samples have been
+    extracted.
+
+    If the target still has a stale snapshot from before the exporter
+    started, fetched with the same credentials, that is returned instead,
+    while the target is fetched in the background.
+    '''
+    governor.touch(target)
+    if snapshots.directory is None:
+        return fetch_document(target, user, pass_, timings)
+
+    snapshot = snapshots.stale(target, user, pass_, functools.partial(fetch_document, target, user, pass_))
+    if snapshot is not None:
+        return snapshot.collector
+    try:
+        return fetch_document(target, user, pass_, timings)
+    except Exception as e:
+        snapshots.failed(target, e)
+        raise
+
+def fetch_document(target, user, pass_, timings=None):
+    '''
+    Fetches a document from a target, as collect_document does, but never
+    answers from a snapshot.
+    '''
+    if timings is None:
+        timings = timing.Timings()
+
+    collector = nexsan.probe(target=target, user=user, pass_=pass_, timings=timings)
+    with timings.phase('collect'):
+        samples = collector.extract()
+    if history.budget:
+        history.get(target).record(samples)
+    if rates.enabled:
+        rates.get(target).update(samples)
+
+    if targets.busy_cpu_percent:
+        cpu = samples.get('nexsan_perf_cpu_usage_percent')
+        if cpu is not None and len(cpu.values):
+            targets.get(target).cpu_percent = max(cpu.values)
+
+    return collector
+
+def families(collector, target, user, pass_):
+    '''
+    Returns an iterator over the metric families of a probe: those of the
+    document, followed by any that describe the target's polling.
+    '''
+    result = document_families(collector, target)
+    if targets.busy_cpu_percent:
+        result = itertools.chain(result, targets.get(target).collect())
+    if sampler.interval:
+        result = itertools.chain(result, sampler.touch(target, user, pass_).collect())
+    return result
+
+def document_families(collector, target):
+    '''
+    Returns an iterator over the metric families that follow from a probe's
+    document alone: those collected from it, their rates, and whether it came
+    from a stale snapshot.
+    '''
+    result = collector.collect()
+    if rates.enabled and collector.snapshot_time is None:
+        result = itertools.chain(result, rates.collect(target))
+    if snapshots.directory is not None:
+        result = itertools.chain(result, snapshots.collect(collector))
+    return result
+
+def cached_exposition(target, collector, timings):
+    '''
+    Returns a memfile.MemoryFile holding the whole exposition of a probe
+    whose document is identical to the previous one from its target (see
+    nexsan.SectionCache), rendering it the first time; or None if the
+    document has changed, or if the probe has families that do not follow
+    from the document alone.
+    '''
+    if collector.document is None or targets.busy_cpu_percent or sampler.interval:
+        with _expositions_lock:
+            _expositions.pop(target, None)
+        return None
+
+    with _expositions_lock:
+        cached = _expositions.get(target)
+    if cached is not None and cached[0] == collector.document:
+        return cached[1]
+
+    with timings.phase('render'):
+        exposition = memfile.MemoryFile(b''.join(render(document_families(collector, target))))
+    with _expositions_lock:
+        _expositions[target] = collector.document, exposition
+    return exposition
+
+def retained():
+    '''
+    Returns the cached exposition of each target, by target; see governor.
+    '''
+    with _expositions_lock:
+        return {target: exposition for target, (_, exposition) in _expositions.items()}
+
+def forget(target):
+    with _expositions_lock:
+        _expositions.pop(target, None)
+
+def probe_many(environ, start_response):
+    '''
+    Probes every target given (as repeated target parameters) concurrently,
+    using the same credentials for each. The result is a single exposition in
+    which each series carries a probe_target label.
+
+    The label is not called "target" because the volume series already use
+    that name for the SCSI target ID.
+    '''
+    import prometheus_client
+
     qs = urllib.parse.parse_qs(environ['QUERY_STRING'])
 
-    reg = prometheus_client.CollectorRegistry()
-    reg.register(nexsan.probe(target=qs['target'][0], user=qs['user'][0], pass_=qs['pass'][0]))
-    body = prometheus_client.generate_latest(reg)
+    user, pass_ = qs['user'][0], qs['pass'][0]
+    futures = {_probe_executor.submit(collect, target=t, user=user, pass_=pass_): t for t in dict.fromkeys(qs['target'])}
 
     start_response('200 OK', [('Content-Type', prometheus_client.CONTENT_TYPE_LATEST)])
-    return [body]
+    return probe_many_body(futures)
+
+def probe_many_body(futures):
+    '''
+    Yields the probe_many exposition, one family at a time, once every
+    future has completed.
+
+    The text format needs all the samples of a family together, after one
+    HELP and TYPE line; so each target's families are rendered as its future
+    completes, and kept until the others are in.
+    '''
+    from prometheus_client.core import GaugeMetricFamily
+
+    # Rendered blocks of each family, by name, in the order the names were
+    # first seen.
+    blocks = collections.OrderedDict()
+    # Sum of nexsan_unhealthy_components across targets, by class.
+    unhealthy = {}
+    for f in concurrent.futures.as_completed(futures):
+        target = futures[f]
+        try:
+            families = list(f.result())
+        except Exception:
+            logger.exception('Probe of %r failed', target)
+            families = []
+            success = 0
+        else:
+            success = 1
+
+        mf = GaugeMetricFamily('nexsan_probe_success', 'Whether the probe of the target succeeded')
+        mf.add_metric([], success)
+        families.append(mf)
+
+        for mf in families:
+            if mf.name == 'nexsan_unhealthy_components':
+                for sample in mf.samples:
+                    # Samples have more fields from prometheus_client 0.4.
+                    labels, value = sample[1], sample[2]
+                    unhealthy[labels['class']] = unhealthy.get(labels['class'], 0) + value
+            header = mf.name not in blocks
+            blocks.setdefault(mf.name, []).append(render_family(relabel(mf, probe_target=target), header))
 
-prometheus_app = prometheus_client.make_wsgi_app()
+    for block in blocks.values():
+        yield b''.join(block)
+
+    mf = GaugeMetricFamily('nexsan_fleet_unhealthy_components', 'Unhealthy components of each class, across all targets probed', labels=['class'])
+    for class_, value in unhealthy.items():
+        mf.add_metric([class_], value)
+    yield render_family(mf)
+
+def relabel(mf, **labels):
+    '''
+    Returns a copy of a metric family with extra labels added to every sample.
+    '''
+    from prometheus_client.core import Metric
+
+    result = Metric(mf.name, mf.documentation, mf.type)
+    for s in mf.samples:
+        result.add_sample(s[0], dict(s[1], **labels), s[2])
+    return result
+
+class Families:
+    '''
+    Presents a fixed list of metric families as a collector, for rendering
+    with generate_latest.
+    '''
+    def __init__(self, families):
+        self.__families = families
+
+    def collect(self):
+        return self.__families
+
+def render(families):
+    '''
+    Yields the text exposition of each metric family as it is rendered, so
+    that only one family's output is held in memory at a time.
+    '''
+    for mf in families:
+        yield render_family(mf)
+
+def render_family(mf, header=True):
+    '''
+    Returns a single metric family in the text exposition format, optionally
+    without its HELP and TYPE lines.
+
+    The output is kept with the family, since families of unchanged sections
+    are reported again by later probes (see nexsan.SectionCache).
+    '''
+    import prometheus_client
+
+    body = getattr(mf, 'exposition', None)
+    if body is None:
+        body = mf.exposition = prometheus_client.generate_latest(Families([mf]))
+    if not header:
+        body = body.split(b'\n', 2)[2]
+    return body
+
+def show_history(environ, start_response):
+    '''
+    Returns the recorded history of a target as JSON: for each series of the
+    metric families named by the series parameters, its labels and a list of
+    [timestamp, value] pairs. With no series parameters, returns the names of
+    the families that have history.
+    '''
+    qs = urllib.parse.parse_qs(environ['QUERY_STRING'])
+
+    target = qs['target'][0]
+    h = history.find(target)
+    if h is None:
+        return not_found(environ, start_response)
+
+    if 'series' in qs:
+        result = {'target': target, 'series': h.query(set(qs['series']))}
+    else:
+        result = {'target': target, 'names': h.names()}
+
+    start_response('200 OK', [('Content-Type', 'application/json')])
+    return [json.dumps(result).encode('utf-8')]
+
+class SelfCollector:
+    '''
+    Collects the exporter's own metrics from the state kept by other modules.
+    '''
+    def collect(self):
+        yield from targets.collect()
+        yield from nexsan.collect_reuse()
+        yield from collect_lanes()
+        yield from governor.collect()
+
+def collect_lanes():
+    '''
+    Yields metric families describing the server's lanes.
+    '''
+    from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+    families = [
+        (GaugeMetricFamily('nexsan_server_lane_threads', 'Threads in the lane', labels=['lane']), lambda lane: lane.threads),
+        (GaugeMetricFamily('nexsan_server_lane_busy_threads', 'Threads in the lane that are handling a request', labels=['lane']), lambda lane: lane.busy),
+        (GaugeMetricFamily('nexsan_server_lane_queued_requests', 'Requests waiting for a thread in the lane', labels=['lane']), lambda lane: lane.queued),
+        (CounterMetricFamily('nexsan_server_lane_rejected_requests_total', 'Requests rejected because the lane\'s queue was full', labels=['lane']), lambda lane: lane.rejected),
+        (CounterMetricFamily('nexsan_server_lane_threads_started_total', 'Threads started because the lane\'s queue backed up', labels=['lane']), lambda lane: lane.grown),
+        (CounterMetricFamily('nexsan_server_lane_threads_stopped_total', 'Threads stopped after being idle', labels=['lane']), lambda lane: lane.shrunk),
+    ]
+    for mf, value in families:
+        for lane in lanes:
+            mf.add_metric([lane.name], value(lane))
+        yield mf
+
+@functools.lru_cache(maxsize=None)
+def _prometheus_app():
+    import prometheus_client
+    prometheus_client.REGISTRY.register(SelfCollector())
+    return prometheus_client.make_wsgi_app()
+
+def prometheus_app(environ, start_response):
+    '''
+    The exporter's own metrics.
+    '''
+    return _prometheus_app()(environ, start_response)
 
 def not_found(environ, start_response):
     '''
@@ -0,0 +1,166 @@
+'''
+Accounting of the memory kept for each target between probes, and a budget
+on the total.
+
+Each kind of per-target state (see states) is measured by walking the objects
+it refers to; an object shared by several kinds is counted for the first. When
+the total exceeds budget, all the state of the least recently scraped targets
+is dropped until it fits. A target whose state was dropped starts afresh on
+its next probe, as after a restart: its document is parsed in full, and its
+history begins again.
+'''
+import gc
+import logging
+import sys
+import threading
+import time
+import types
+
+logger = logging.getLogger(__name__)
+
+# Bytes of per-target state to keep in total; 0 for no limit.
+budget = 0
+
+# Seconds between checks of the total against the budget. Measuring walks
+# every object kept for every target, which takes a few milliseconds per
+# target.
+check_interval = 60.0
+
+# Objects that are shared by everything, rather than kept for a target.
+_SHARED = (type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType)
+
+# When each target was last probed, as a time.monotonic() value.
+_scraped = {}
+
+# The bytes kept for each kind of state, by name, as of the last measurement,
+# and when that was.
+_usage = {}
+_measured = None
+_lock = threading.Lock()
+
+# Held while checking, so that concurrent checks do not both evict.
+_check_lock = threading.Lock()
+
+evictions = 0
+
+def states():
+    '''
+    Returns the kinds of per-target state, with the modules that keep them.
+    Each module has a retained function, returning the state of each target
+    by target, and a forget function that drops the state of one target.
+    '''
+    from . import exporter, history, nexsan, rates, snapshots, targets
+
+    return (
+        ('sections', nexsan),
+        ('targets', targets),
+        ('snapshots', snapshots),
+        ('history', history),
+        ('rates', rates),
+        ('expositions', exporter),
+    )
+
+def touch(target):
+    '''
+    Notes that target has been probed.
+    '''
+    _scraped[target] = time.monotonic()
+
+def sizeof(objs, seen):
+    '''
+    Returns the total size of objs and everything they refer to, leaving out
+    objects whose ids are in seen, and adding those it counts.
+    '''
+    size = 0
+    while objs:
+        new = []
+        for o in objs:
+            if isinstance(o, _SHARED) or id(o) in seen:
+                continue
+            seen.add(id(o))
+            size += sys.getsizeof(o)
+            new.append(o)
+        objs = gc.get_referents(*new)
+    return size
+
+def measure():
+    '''
+    Returns the bytes kept for each target, by target, then by kind of state.
+    '''
+    retained = [(name, module.retained()) for name, module in states()]
+    result = {}
+    seen = {}
+    for name, by_target in retained:
+        for target, state in by_target.items():
+            result.setdefault(target, {})[name] = sizeof([state], seen.setdefault(target, set()))
+    return result
+
+def check():
+    '''
+    Measures the state kept for each target, and if it exceeds budget, drops
+    the state of the least recently scraped targets until it does not.
+    '''
+    global evictions, _measured, _usage
+
+    with _check_lock:
+        sizes = measure()
+        total = sum(sum(s.values()) for s in sizes.values())
+        if budget and total > budget:
+            for target in sorted(sizes, key=lambda t: _scraped.get(t, float('-inf'))):
+                if total <= budget:
+                    break
+                forget(target)
+                freed = sum(sizes.pop(target).values())
+                total -= freed
+                with _lock:
+                    evictions += 1
+                logger.info('Dropped state of %s to free %d bytes', target, freed)
+
+        usage = {name: 0 for name, _ in states()}
+        for s in sizes.values():
+            for name, size in s.items():
+                usage[name] += size
+        with _lock:
+            _usage, _measured = usage, time.monotonic()
+
+def forget(target):
+    '''
+    Drops all the state kept for target.
+    '''
+    for name, module in states():
+        module.forget(target)
+    _scraped.pop(target, None)
+
+def run():
+    '''
+    Checks the budget every check_interval seconds; run in a background
+    thread if there is a budget.
+    '''
+    while True:
+        time.sleep(check_interval)
+        try:
+            check()
+        except Exception:
+            logger.exception('Checking the memory budget failed')
+
+def collect():
+    '''
+    Yields metric families describing the state kept for targets. If it has
+    not been measured within check_interval (as when there is no budget), it
+    is measured now.
+    '''
+    from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+    with _lock:
+        fresh = _measured is not None and time.monotonic() - _measured < check_interval
+    if not fresh:
+        check()
+
+    usage = GaugeMetricFamily('nexsan_state_bytes', 'Estimated memory kept between probes for all targets', labels=['state'])
+    with _lock:
+        for name, size in _usage.items():
+            usage.add_metric([name], size)
+    yield usage
+    if budget:
+        yield GaugeMetricFamily('nexsan_state_budget_bytes', 'Memory that state kept between probes may use before targets\' state is dropped', value=budget)
+    yield CounterMetricFamily('nexsan_state_evictions_total', 'Targets whose state was dropped to stay within the budget', value=evictions)
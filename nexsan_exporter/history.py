@@ -0,0 +1,143 @@
+'''
+In-memory history of the values collected from each target.
+
+Every probe of a target records a snapshot: a timestamp, and the value of
+each series. The snapshots are kept in ring buffers sized so that a target's
+history never uses more than budget bytes; the more series a target has, the
+fewer snapshots are kept.
+'''
+import math
+import threading
+import time
+
+from . import nexsan
+from . import ring
+
+# Bytes of history to keep per target; 0 disables history.
+budget = 0
+
+_histories = {}
+_histories_lock = threading.Lock()
+
+def get(target):
+    '''
+    Returns the History for target, creating it on first use.
+    '''
+    with _histories_lock:
+        try:
+            return _histories[target]
+        except KeyError:
+            h = _histories[target] = History(budget)
+            return h
+
+def find(target):
+    '''
+    Returns the History for target, or None if it has none.
+    '''
+    with _histories_lock:
+        return _histories.get(target)
+
+def retained():
+    '''
+    Returns the History of each target, by target; see governor.
+    '''
+    with _histories_lock:
+        return dict(_histories)
+
+def forget(target):
+    with _histories_lock:
+        _histories.pop(target, None)
+
+class History:
+    def __init__(self, budget):
+        self.__budget = budget
+        self.__lock = threading.Lock()
+        # Index into __values of each series, by (family name, label values).
+        self.__index = {}
+        self.__times = ring.Ring(1, 'q')
+        self.__values = []
+
+    @property
+    def nbytes(self):
+        with self.__lock:
+            return self.__times.nbytes + sum(r.nbytes for r in self.__values)
+
+    def __size(self, series):
+        '''
+        Returns the number of snapshots that fit in the budget, given the
+        number of series.
+        '''
+        return max(1, self.__budget // (8 * (series + 1)))
+
+    def record(self, samples, timestamp=None):
+        '''
+        Records a snapshot of samples, as returned by Collector.extract.
+        '''
+        if timestamp is None:
+            timestamp = time.time()
+
+        with self.__lock:
+            new = [(name, labels) for name, s in samples.items() for labels in s.labels if (name, labels) not in self.__index]
+            if new:
+                self.__resize(new)
+
+            values = [math.nan] * len(self.__values)
+            for name, s in samples.items():
+                for labels, value in zip(s.labels, s.values):
+                    values[self.__index[name, labels]] = value
+
+            self.__times.append(int(timestamp * 1000))
+            for r, value in zip(self.__values, values):
+                r.append(value)
+
+    def __resize(self, new):
+        '''
+        Adds series, shrinking every ring buffer to keep within the budget.
+        The newest snapshots are kept. Series with no values left are dropped.
+        '''
+        series = [key for key, i in sorted(self.__index.items(), key=lambda item: item[1])]
+        old_values = [r.values() for r in self.__values]
+        old_times = self.__times.values()
+
+        size = self.__size(len(series) + len(new))
+        keep = [(key, v[-size:]) for key, v in zip(series, old_values) if any(not math.isnan(x) for x in v[-size:])]
+        missing = [math.nan] * min(len(old_times), size)
+        keep += [(key, missing) for key in new]
+
+        self.__index = {}
+        self.__values = []
+        self.__times = ring.Ring(self.__size(len(keep)), 'q')
+        for t in old_times[-size:]:
+            self.__times.append(t)
+        for key, v in keep:
+            self.__index[key] = len(self.__values)
+            r = ring.Ring(self.__size(len(keep)))
+            for x in v:
+                r.append(x)
+            self.__values.append(r)
+
+    def names(self):
+        '''
+        Returns the names of the families that have history.
+        '''
+        with self.__lock:
+            return sorted({name for name, _ in self.__index})
+
+    def query(self, names):
+        '''
+        Returns the history of every series of the named families, as a list
+        of dicts with the series' name, labels, and (timestamp, value) pairs.
+        '''
+        with self.__lock:
+            times = [t / 1000 for t in self.__times.values()]
+            result = []
+            for (name, labels), i in sorted(self.__index.items()):
+                if name not in names:
+                    continue
+                values = self.__values[i].values()
+                result.append({
+                    'name': name,
+                    'labels': dict(zip(nexsan.LABELNAMES[name], labels)),
+                    'samples': [(t, v) for t, v in zip(times[-len(values):], values) if not math.isnan(v)],
+                })
+            return result
@@ -0,0 +1,78 @@
+'''
+Read-only data kept in an anonymous memory-backed file, so that it can be
+sent to a socket by the kernel (with sendfile) rather than copied through
+Python.
+'''
+import io
+import mmap
+import os
+import tempfile
+
+class MemoryFile:
+    '''
+    Holds data in a memfd (or, where there is no memfd_create, an unlinked
+    temporary file). Each response that sends it should use its own reader,
+    from open.
+    '''
+    def __init__(self, data, name='nexsan-exporter'):
+        if hasattr(os, 'memfd_create'):
+            self.__file = os.fdopen(os.memfd_create(name, os.MFD_CLOEXEC), 'w+b')
+        else:
+            self.__file = tempfile.TemporaryFile()
+        self.__file.write(data)
+        self.__file.flush()
+        self.size = len(data)
+        self.__map = mmap.mmap(self.__file.fileno(), self.size, access=mmap.ACCESS_READ) if self.size else b''
+
+    def fileno(self):
+        return self.__file.fileno()
+
+    def __sizeof__(self):
+        # Include the file's contents, which are held in memory.
+        return object.__sizeof__(self) + self.size
+
+    def open(self):
+        return Reader(self)
+
+    def view(self, start, end):
+        return memoryview(self.__map)[start:end]
+
+class Reader(io.RawIOBase):
+    '''
+    A file object reading a MemoryFile from the start, with its own position.
+    fileno returns the MemoryFile's descriptor, which should only be used
+    with calls that take an explicit offset (such as socket.sendfile);
+    closing the reader leaves it open.
+    '''
+    mode = 'rb'
+
+    def __init__(self, memfile):
+        self.__memfile = memfile
+        self.__pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def fileno(self):
+        return self.__memfile.fileno()
+
+    def readinto(self, b):
+        data = self.__memfile.view(self.__pos, self.__pos + len(b))
+        n = len(data)
+        b[:n] = data
+        self.__pos += n
+        return n
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.__pos
+        elif whence == io.SEEK_END:
+            offset += self.__memfile.size
+        self.__pos = max(0, offset)
+        return self.__pos
+
+    def tell(self):
+        return self.__pos
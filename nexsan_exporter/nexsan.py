@@ -1,200 +1,726 @@
-import urllib.request
-import urllib.parse
+import array
+import collections
+import functools
+import hashlib
+import logging
+import re
+import threading
+
+from . import capture
+from . import parsers
+from . import snapshots
+from . import targets
+from . import timing
+
+logger = logging.getLogger(__name__)
+
+# Whether sections of a target's document that are unchanged since its last
+# probe are reused rather than parsed and collected again; see SectionCache.
+reuse = True
+
+def probe(target, user, pass_, timings=None):
+    '''
+    Returns a collector populated with metrics from the target array.
+
+    target may list the management addresses of both controllers, separated by
+    commas; see targets.Target.fetch.
+
+    If a timing.Timings is given, the fetch and parse phases are recorded in
+    it. Once parsed, the document is saved as the target's snapshot, if
+    snapshots are enabled.
+    '''
+    if timings is None:
+        timings = timing.Timings()
 
-from xml.etree import ElementTree
+    with timings.phase('fetch'):
+        body = document(target, user, pass_)
+    timings.upstream_bytes = len(body)
 
-from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+    with timings.phase('parse'):
+        collector = document_collector(target, body)
+    if snapshots.directory is not None and capture.replay_directory is None:
+        snapshots.save(target, body, user, pass_)
+    return collector
 
-def probe(target, user, pass_):
+def document(target, user, pass_):
     '''
-    Returns a collector populated with metrics from the target array.
+    Returns an opstats document from target: its next capture, if replaying
+    (see capture); otherwise one fetched from the array (see
+    targets.Target.fetch), which is recorded if recording.
+    '''
+    if capture.replay_directory is not None:
+        return capture.replay(target)
+    body = targets.get(target).fetch(functools.partial(fetch, user=user, pass_=pass_), targets.credentials(user, pass_))
+    if capture.record_directory is not None:
+        capture.record(target, body)
+    return body
+
+def document_collector(target, body):
+    '''
+    Returns a collector for a document from target, reusing the unchanged
+    sections of the target's last document (see SectionCache).
     '''
-    url = urllib.parse.urlunsplit(('http', target, '/admin/opstats.asp', None, None))
+    t = targets.get(target)
+    t.labels.rotate()
+    if reuse:
+        return section_cache(target).collector(body, t.labels)
+    return Collector(parsers.parse(body), t.labels)
+
+def fetch(address, user, pass_):
+    '''
+    Returns the raw opstats document from a single management address.
+    '''
+    import urllib.parse
+    import urllib.request
+
+    url = urllib.parse.urlunsplit(('http', address, '/admin/opstats.asp', None, None))
 
     password_mgr = urllib.request.HTTPPasswordMgrWithDefaultRealm()
     password_mgr.add_password(None, url, user, pass_)
     handler = urllib.request.HTTPBasicAuthHandler(password_mgr)
     opener = urllib.request.build_opener(handler)
     with opener.open(url, timeout=5) as resp:
-        return Collector(ElementTree.parse(resp))
+        return resp.read()
 
-class Collector:
-    def __init__(self, opstats):
-        self.__opstats = opstats
-        self.__parent_map = {c: p for p in opstats.iter() for c in p}
-
-        self.__nexsan_sys_details = GaugeMetricFamily('nexsan_sys_details', '', labels=['friendly_name', 'system_name', 'system_id', 'firmware_version'])
-        self.__nexsan_sys_date = CounterMetricFamily('nexsan_sys_date', '')
-        self.__nexsan_env_psu_power_good = GaugeMetricFamily('nexsan_env_psu_power_good', '', labels=['psu', 'enclosure'])
-        self.__nexsan_env_psu_power_watts = GaugeMetricFamily('nexsan_env_psu_power_watts', '', labels=['psu', 'enclosure'])
-        self.__nexsan_env_psu_temp_celsius = GaugeMetricFamily('nexsan_env_psu_temp_celsius', '', labels=['psu', 'enclosure'])
-        self.__nexsan_env_psu_temp_good = GaugeMetricFamily('nexsan_env_psu_temp_good', '', labels=['psu', 'enclosure'])
-        self.__nexsan_env_psu_blower_rpm = GaugeMetricFamily('nexsan_env_psu_blower_rpm', '', labels=['psu', 'enclosure', 'blower'])
-        self.__nexsan_env_psu_blower_good = GaugeMetricFamily('nexsan_env_psu_blower_good', '', labels=['psu', 'enclosure', 'blower'])
-        self.__nexsan_env_controller_voltage_volts = GaugeMetricFamily('nexsan_env_controller_voltage_volts', '', labels=['controller', 'enclosure', 'voltage'])
-        self.__nexsan_env_controller_voltage_good = GaugeMetricFamily('nexsan_env_controller_voltage_good', '', labels=['controller', 'enclosure', 'voltage'])
-        self.__nexsan_env_controller_temp_celsius = GaugeMetricFamily('nexsan_env_controller_temp_celsius', '', labels=['controller', 'enclosure', 'temp'])
-        self.__nexsan_env_controller_temp_good = GaugeMetricFamily('nexsan_env_controller_temp_good', '', labels=['controller', 'enclosure', 'temp'])
-        self.__nexsan_env_controller_battery_charge_good = GaugeMetricFamily('nexsan_env_controller_battery_charge_good', '', labels=['controller', 'enclosure', 'battery'])
-        self.__nexsan_env_pod_voltage_volts = GaugeMetricFamily('nexsan_env_pod_voltage_volts', '', labels=['pod', 'enclosure', 'voltage'])
-        self.__nexsan_env_pod_voltage_good = GaugeMetricFamily('nexsan_env_pod_voltage_good', '', labels=['pod', 'enclosure', 'voltage'])
-        self.__nexsan_env_pod_temp_celsius = GaugeMetricFamily('nexsan_env_pod_temp_celsius', '', labels=['pod', 'enclosure', 'temp'])
-        self.__nexsan_env_pod_temp_good = GaugeMetricFamily('nexsan_env_pod_temp_good', '', labels=['pod', 'enclosure', 'temp'])
-        self.__nexsan_env_pod_front_blower_rpm = GaugeMetricFamily('nexsan_env_pod_front_blower_rpm', '', labels=['pod', 'enclosure', 'blower'])
-        self.__nexsan_env_pod_front_blower_good = GaugeMetricFamily('nexsan_env_pod_front_blower_good', '', labels=['pod', 'enclosure', 'blower'])
-        self.__nexsan_env_pod_tray_blower_rpm = GaugeMetricFamily('nexsan_env_pod_tray_blower_rpm', '', labels=['pod', 'enclosure', 'blower'])
-        self.__nexsan_env_pod_tray_blower_good = GaugeMetricFamily('nexsan_env_pod_tray_blower_good', '', labels=['pod', 'enclosure', 'blower'])
-        self.__nexsan_volume_ios_total = CounterMetricFamily('nexsan_volume_ios_total', '', labels=['volume', 'name', 'array', 'serial', 'ident', 'target', 'lun'])
-        self.__nexsan_volume_ios_read_total = CounterMetricFamily('nexsan_volume_ios_read_total', '', labels=['volume', 'name', 'array', 'serial', 'ident', 'target', 'lun'])
-        self.__nexsan_volume_ios_write_total = CounterMetricFamily('nexsan_volume_ios_write_total', '', labels=['volume', 'name', 'array', 'serial', 'ident', 'target', 'lun'])
-        self.__nexsan_volume_blocks_read_total = CounterMetricFamily('nexsan_volume_blocks_read_total', '', labels=['volume', 'name', 'array', 'serial', 'ident', 'target', 'lun'])
-        self.__nexsan_volume_blocks_write_total = CounterMetricFamily('nexsan_volume_blocks_write_total', '', labels=['volume', 'name', 'array', 'serial', 'ident', 'target', 'lun'])
-        self.__nexsan_perf_cpu_usage_percent = GaugeMetricFamily('nexsan_perf_cpu_usage_percent', '', labels=['controller'])
-        self.__nexsan_perf_memory_usage_percent = GaugeMetricFamily('nexsan_perf_memory_usage_percent', '', labels=['controller'])
-        for x in ['read_bytes_per_second', 'write_bytes_per_second', 'read_ios_total', 'write_ios_total', 'read_blocks_total', 'write_blocks_total', 'port_resets_total', 'lun_resets_total']:
-            c = CounterMetricFamily if x.endswith('_total') else GaugeMetricFamily
-            setattr(self, '_Collector__nexsan_perf_{}'.format(x), c('nexsan_perf_{}'.format(x), '', labels=['controller', 'port']))
-        self.__nexsan_perf_link_errors_total = CounterMetricFamily('nexsan_perf_link_errors_total', '', labels=['controller', 'port', 'name'])
-        self.__nexsan_perf_load_ratio = GaugeMetricFamily('nexsan_perf_load_ratio', '', labels=['array', 'owner'])
-        self.__nexsan_maid_good = GaugeMetricFamily('nexsan_maid_good', '')
-        for x in ['active', 'idle', 'slow', 'stopped', 'off', 'standby', 'efficiency']:
-            setattr(self, '_Collector__nexsan_maid_{}_ratio'.format(x), GaugeMetricFamily('nexsan_maid_{}_ratio'.format(x), '', labels=['group']))
-
-    def isgood(self, elem):
-        if elem.attrib['good'] == 'yes':
-            return 1
-        else:
-            return 0
-
-    def collect(self):
-        for child in self.__opstats.iterfind('./*'):
-            if child.tag == 'nexsan_sys_details':
-                self.collect_sys_details(child)
-            elif child.tag == 'nexsan_env_status':
-                self.collect_env_status(child)
-            elif child.tag == 'nexsan_volume_stats':
-                self.collect_volume_stats(child)
-            elif child.tag == 'nexsan_perf_status':
-                self.collect_perf_status(child)
-            elif child.tag == 'nexsan_maid_stats':
-                self.collect_maid_stats(child)
-
-        yield from (v for k, v in self.__dict__.items() if k.startswith('_Collector__nexsan_'))
-
-    def collect_sys_details(self, sys_details):
-        self.__nexsan_sys_details.add_metric([sys_details.findtext('./' + l) for l in self.__nexsan_sys_details._labelnames], 1)
-        self.__nexsan_sys_date.add_metric([], int(sys_details.findtext('./date')))
-
-    def collect_env_status(self, env_status):
-        for psu in env_status.iterfind('.//psu'):
-            self.collect_psu(psu)
-        for c in env_status.iterfind('.//controller'):
-            self.collect_controller(c)
-        for pod in env_status.iterfind('.//pod'):
-            self.collect_pod(pod)
-
-    def collect_psu(self, psu):
-        parent = self.__parent_map[psu]
-        values = [psu.attrib['id'], parent.attrib['id'] if parent.tag == 'enclosure' else '']
-
-        self.__nexsan_env_psu_power_good.add_metric(values, self.isgood(psu.find('./state')))
-        state = psu.find('./state')
-        if 'power_watt' in state.attrib:
-            self.__nexsan_env_psu_power_watts.add_metric(values, int(state.attrib['power_watt']))
-
-        try:
-            x = int(psu.find('./temperature_deg_c').text)
-        except ValueError:
-            pass
-        else:
-            self.__nexsan_env_psu_temp_celsius.add_metric(values, x)
-
-        self.__nexsan_env_psu_temp_good.add_metric(values, self.isgood(psu.find('./temperature_deg_c')))
-
-        for b in psu.iterfind('./blower_rpm'):
-            self.__nexsan_env_psu_blower_rpm.add_metric(values + [b.attrib['id']], int(b.text))
-            self.__nexsan_env_psu_blower_good.add_metric(values + [b.attrib['id']], self.isgood(b))
-
-    def collect_controller(self, controller):
-        parent = self.__parent_map[controller]
-        values = [controller.attrib['id'], parent.attrib['id'] if parent.tag == 'enclosure' else '']
+def unauthorized(error):
+    '''
+    Returns whether error, raised by fetch, means that the array refused the
+    credentials.
+    '''
+    import urllib.error
+
+    return isinstance(error, urllib.error.HTTPError) and error.code in (401, 403)
+
+_PSU = ('psu', 'enclosure')
+_CONTROLLER = ('controller', 'enclosure')
+_POD = ('pod', 'enclosure')
+_PATH = ('volume', 'name', 'array', 'serial', 'ident', 'target', 'lun')
+_PORT = ('controller', 'port')
+
+# Every metric family, grouped by the opstats section that it is collected
+# from. Each is given as (name, type, label names). The order here is the
+# order of the exposition.
+METRICS = (
+    ('nexsan_sys_details', (
+        ('nexsan_sys_details', 'gauge', ('friendly_name', 'system_name', 'system_id', 'firmware_version')),
+        ('nexsan_sys_date', 'counter', ()),
+    )),
+    ('nexsan_env_status', (
+        ('nexsan_env_psu_power_good', 'gauge', _PSU),
+        ('nexsan_env_psu_power_watts', 'gauge', _PSU),
+        ('nexsan_env_psu_temp_celsius', 'gauge', _PSU),
+        ('nexsan_env_psu_temp_good', 'gauge', _PSU),
+        ('nexsan_env_psu_blower_rpm', 'gauge', _PSU + ('blower',)),
+        ('nexsan_env_psu_blower_good', 'gauge', _PSU + ('blower',)),
+        ('nexsan_env_controller_voltage_volts', 'gauge', _CONTROLLER + ('voltage',)),
+        ('nexsan_env_controller_voltage_good', 'gauge', _CONTROLLER + ('voltage',)),
+        ('nexsan_env_controller_temp_celsius', 'gauge', _CONTROLLER + ('temp',)),
+        ('nexsan_env_controller_temp_good', 'gauge', _CONTROLLER + ('temp',)),
+        ('nexsan_env_controller_battery_charge_good', 'gauge', _CONTROLLER + ('battery',)),
+        ('nexsan_env_pod_voltage_volts', 'gauge', _POD + ('voltage',)),
+        ('nexsan_env_pod_voltage_good', 'gauge', _POD + ('voltage',)),
+        ('nexsan_env_pod_temp_celsius', 'gauge', _POD + ('temp',)),
+        ('nexsan_env_pod_temp_good', 'gauge', _POD + ('temp',)),
+        ('nexsan_env_pod_front_blower_rpm', 'gauge', _POD + ('blower',)),
+        ('nexsan_env_pod_front_blower_good', 'gauge', _POD + ('blower',)),
+        ('nexsan_env_pod_tray_blower_rpm', 'gauge', _POD + ('blower',)),
+        ('nexsan_env_pod_tray_blower_good', 'gauge', _POD + ('blower',)),
+    )),
+    ('nexsan_volume_stats', (
+        ('nexsan_volume_ios_total', 'counter', _PATH),
+        ('nexsan_volume_ios_read_total', 'counter', _PATH),
+        ('nexsan_volume_ios_write_total', 'counter', _PATH),
+        ('nexsan_volume_blocks_read_total', 'counter', _PATH),
+        ('nexsan_volume_blocks_write_total', 'counter', _PATH),
+        ('nexsan_volume_array_ios_total', 'counter', ('array',)),
+        ('nexsan_volume_array_ios_read_total', 'counter', ('array',)),
+        ('nexsan_volume_array_ios_write_total', 'counter', ('array',)),
+        ('nexsan_volume_array_blocks_read_total', 'counter', ('array',)),
+        ('nexsan_volume_array_blocks_write_total', 'counter', ('array',)),
+    )),
+    ('nexsan_perf_status', (
+        ('nexsan_perf_cpu_usage_percent', 'gauge', ('controller',)),
+        ('nexsan_perf_memory_usage_percent', 'gauge', ('controller',)),
+        ('nexsan_perf_read_bytes_per_second', 'gauge', _PORT),
+        ('nexsan_perf_write_bytes_per_second', 'gauge', _PORT),
+        ('nexsan_perf_read_ios_total', 'counter', _PORT),
+        ('nexsan_perf_write_ios_total', 'counter', _PORT),
+        ('nexsan_perf_read_blocks_total', 'counter', _PORT),
+        ('nexsan_perf_write_blocks_total', 'counter', _PORT),
+        ('nexsan_perf_port_resets_total', 'counter', _PORT),
+        ('nexsan_perf_lun_resets_total', 'counter', _PORT),
+        ('nexsan_perf_link_errors_total', 'counter', _PORT + ('name',)),
+        ('nexsan_perf_load_ratio', 'gauge', ('array', 'owner')),
+        ('nexsan_perf_controller_read_bytes_per_second', 'gauge', ('controller',)),
+        ('nexsan_perf_controller_write_bytes_per_second', 'gauge', ('controller',)),
+        ('nexsan_perf_controller_read_ios_total', 'counter', ('controller',)),
+        ('nexsan_perf_controller_write_ios_total', 'counter', ('controller',)),
+        ('nexsan_perf_controller_read_blocks_total', 'counter', ('controller',)),
+        ('nexsan_perf_controller_write_blocks_total', 'counter', ('controller',)),
+    )),
+    ('nexsan_maid_stats', (
+        ('nexsan_maid_good', 'gauge', ()),
+    ) + tuple(
+        ('nexsan_maid_{}_ratio'.format(x), 'gauge', ('group',)) for x in ['active', 'idle', 'slow', 'stopped', 'off', 'standby', 'efficiency']
+    )),
+    # Not a section: families computed from the whole document.
+    ('nexsan_op_status', (
+        ('nexsan_unhealthy_components', 'gauge', ('class',)),
+    )),
+)
+
+# The label names of each family, by name.
+LABELNAMES = {name: labelnames for _, families in METRICS for name, _, labelnames in families}
+
+@functools.lru_cache(maxsize=None)
+def family_types():
+    '''
+    Returns the metric family class for each type in METRICS. prometheus_client
+    is imported on first use, rather than at startup.
+    '''
+    from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
 
-        for v in controller.iterfind('./voltage'):
-            self.__nexsan_env_controller_voltage_volts.add_metric(values + [v.attrib['id']], float(v.text))
-            self.__nexsan_env_controller_voltage_good.add_metric(values + [v.attrib['id']], self.isgood(v))
+    return {
+        'counter': CounterMetricFamily,
+        'gauge': GaugeMetricFamily,
+    }
 
-        for t in controller.iterfind('./temperature_deg_c'):
-            self.__nexsan_env_controller_temp_celsius.add_metric(values + [t.attrib.get('id', '')], float(t.text))
-            self.__nexsan_env_controller_temp_good.add_metric(values + [t.attrib.get('id', '')], self.isgood(t))
+@functools.lru_cache(maxsize=None)
+def sample_class():
+    '''
+    Returns the class of the samples of a metric family: prometheus_client's
+    Sample from version 0.4, or tuple for earlier versions, whose samples are
+    plain (name, labels, value) tuples.
+    '''
+    try:
+        from prometheus_client.core import Sample
+    except ImportError:
+        return tuple
+    return Sample
 
-        for b in controller.iterfind('./battery'):
-            self.__nexsan_env_controller_battery_charge_good.add_metric(values + [b.attrib['id']], self.isgood(b.find('./charge_state')))
+def set_samples(mf, labelnames, series, labels):
+    '''
+    Sets the samples of a counter or gauge family to (label values, value)
+    for each item of series, named as add_metric would name them. The label
+    dict of each sample comes from labels (a targets.LabelCache), so that it
+    is shared with every other family of the same series.
+    '''
+    Sample = sample_class()
+    name = mf.name
+    if Sample is tuple:
+        mf.samples = [(name, labels.labels(labelnames, values), value) for values, value in series]
+        return
+    # From 0.4, counter families are named without the _total suffix, and
+    # their samples with it.
+    if mf.type == 'counter':
+        name += '_total'
+    mf.samples = [Sample(name, labels.labels(labelnames, values), value, None, None) for values, value in series]
+
+# The names of the families collected from each section, by tag.
+SECTION_FAMILIES = {section: [name for name, _, _ in families] for section, families in METRICS}
+
+# Matches each section of an opstats document (the children of the root
+# nexsan_op_status element).
+SECTION_RE = re.compile(rb'<(nexsan_(?!op_status\b)\w+)[\s>].*?</\1\s*>', re.DOTALL)
+
+def sections(body):
+    '''
+    Yields (tag, start, end) giving the byte range of each section of an
+    opstats document, without parsing it.
+    '''
+    for m in SECTION_RE.finditer(body):
+        yield m.group(1).decode('ascii'), m.start(), m.end()
 
-    def collect_pod(self, pod):
-        values = [pod.attrib['id'], self.__parent_map[pod].attrib['id']]
+class Samples:
+    '''
+    The samples collected for one metric family: a label value tuple and a
+    value for each series.
+    '''
+    __slots__ = ('labels', 'values')
 
-        for v in pod.iterfind('./voltage'):
-            self.__nexsan_env_pod_voltage_volts.add_metric(values + [v.attrib['id']], float(v.text))
-            self.__nexsan_env_pod_voltage_good.add_metric(values + [v.attrib['id']], self.isgood(v))
+    def __init__(self):
+        self.labels = []
+        self.values = array.array('d')
 
-        for t in pod.iterfind('./temperature_deg_c'):
-            self.__nexsan_env_pod_temp_celsius.add_metric(values + [t.attrib['id']], float(t.text))
-            self.__nexsan_env_pod_temp_good.add_metric(values + [t.attrib['id']], self.isgood(t))
+    def add(self, labels, value):
+        self.labels.append(tuple(labels))
+        self.values.append(value)
 
-        for b1 in pod.iterfind('./front_panel/blower_rpm'):
-            self.__nexsan_env_pod_front_blower_rpm.add_metric(values + [b1.attrib['id']], float(b1.text))
-            self.__nexsan_env_pod_front_blower_good.add_metric(values + [b1.attrib['id']], self.isgood(b1))
+class Section:
+    '''
+    What was extracted from one section of a document: the Samples of each of
+    its families, by name, and once they have been collected, the families
+    themselves.
+    '''
+    __slots__ = ('samples', 'families')
+
+    def __init__(self, samples):
+        self.samples = samples
+        self.families = None
+
+# Families collected from the child elements of a volume path, by tag.
+PATH_FIELDS = {
+    'total_ios': 'nexsan_volume_ios_total',
+    'read_ios': 'nexsan_volume_ios_read_total',
+    'write_ios': 'nexsan_volume_ios_write_total',
+    'read_blocks': 'nexsan_volume_blocks_read_total',
+    'write_blocks': 'nexsan_volume_blocks_write_total',
+}
+
+# Families collected from the child elements of a controller port, by tag,
+# with the factor that converts each value to base units.
+PORT_FIELDS = {
+    'read_mbytes_per_sec': ('nexsan_perf_read_bytes_per_second', 1024 * 1024),
+    'write_mbytes_per_sec': ('nexsan_perf_write_bytes_per_second', 1024 * 1024),
+    'read_ios': ('nexsan_perf_read_ios_total', 1),
+    'write_ios': ('nexsan_perf_write_ios_total', 1),
+    'read_blocks': ('nexsan_perf_read_blocks_total', 1),
+    'write_blocks': ('nexsan_perf_write_blocks_total', 1),
+    'port_resets': ('nexsan_perf_port_resets_total', 1),
+    'lun_resets': ('nexsan_perf_lun_resets_total', 1),
+}
+
+# Per-array totals of the volume path families, by the family they sum.
+PATH_ROLLUPS = {
+    'nexsan_volume_ios_total': 'nexsan_volume_array_ios_total',
+    'nexsan_volume_ios_read_total': 'nexsan_volume_array_ios_read_total',
+    'nexsan_volume_ios_write_total': 'nexsan_volume_array_ios_write_total',
+    'nexsan_volume_blocks_read_total': 'nexsan_volume_array_blocks_read_total',
+    'nexsan_volume_blocks_write_total': 'nexsan_volume_array_blocks_write_total',
+}
+
+# Per-controller totals of the port families, by the family they sum.
+PORT_ROLLUPS = {
+    'nexsan_perf_read_bytes_per_second': 'nexsan_perf_controller_read_bytes_per_second',
+    'nexsan_perf_write_bytes_per_second': 'nexsan_perf_controller_write_bytes_per_second',
+    'nexsan_perf_read_ios_total': 'nexsan_perf_controller_read_ios_total',
+    'nexsan_perf_write_ios_total': 'nexsan_perf_controller_write_ios_total',
+    'nexsan_perf_read_blocks_total': 'nexsan_perf_controller_read_blocks_total',
+    'nexsan_perf_write_blocks_total': 'nexsan_perf_controller_write_blocks_total',
+}
+
+MAID_STATES = ['active', 'idle', 'slow', 'stopped', 'off', 'standby', 'efficiency']
 
-        for b2 in pod.iterfind('./fan_tray/blower_rpm'):
-            self.__nexsan_env_pod_tray_blower_rpm.add_metric(values + [b2.attrib['id']], float(b2.text))
-            self.__nexsan_env_pod_tray_blower_good.add_metric(values + [b2.attrib['id']], self.isgood(b2))
+class Collector:
+    '''
+    Collects metrics from an opstats document: its root element, or a list of
+    some of its section elements.
 
-    def collect_volume_stats(self, volume_stats):
-        for volume in volume_stats.iterfind('./volume'):
-            self.collect_volume(volume)
+    reused gives the Section, by tag, of sections that were extracted from an
+    earlier document and are to be reported again. on_extract is called with
+    the Section of every section, by tag, once they have been extracted.
 
-    def collect_volume(self, volume):
-        values = [volume.attrib['id'], volume.attrib['name'], volume.attrib['array'], volume.attrib['serial_number']]
+    If the document is identical to the last one from its target, so that
+    every section is reused, document is its digest.
 
-        for path in volume.iterfind('./path'):
-            path_values = values + [path.attrib['init_ident'], path.attrib['target_id'], path.attrib['lun']]
+    If the document was loaded from a snapshot saved before the exporter
+    started (see snapshots), snapshot_time is when it was fetched, as a
+    time.time() value.
+    '''
+    def __init__(self, opstats, labels=None, reused=None, on_extract=None, document=None):
+        self.document = document
+        self.snapshot_time = None
+        self.__opstats = opstats.getroot() if hasattr(opstats, 'getroot') else opstats
+        # Shared label tuples and dicts; see targets.LabelCache.
+        self.__labels = targets.LabelCache() if labels is None else labels
+        self.__values = self.__labels.values
+        # Samples for the families of each section found in the document, by
+        # family name.
+        self.__samples = {}
+        self.__sections = dict(reused) if reused else {}
+        self.__on_extract = on_extract
 
-            self.__nexsan_volume_ios_total.add_metric(path_values, int(path.findtext('./total_ios')))
-            self.__nexsan_volume_ios_read_total.add_metric(path_values, int(path.findtext('./read_ios')))
-            self.__nexsan_volume_ios_write_total.add_metric(path_values, int(path.findtext('./write_ios')))
-            self.__nexsan_volume_blocks_read_total.add_metric(path_values, int(path.findtext('./read_blocks')))
-            self.__nexsan_volume_blocks_write_total.add_metric(path_values, int(path.findtext('./write_blocks')))
+    def isgood(self, elem):
+        if elem.attrib['good'] == 'yes':
+            return 1
+        else:
+            return 0
 
-    def collect_perf_status(self, perf):
-        for controller in perf.iterfind('./controller'):
-            values = [controller.attrib['id']]
+    def extract(self):
+        '''
+        Extracts samples from the document, the first time it is called.
+        Returns a dict of the Samples for each family, by name, for the
+        sections present in the document.
+        '''
+        if self.__opstats is not None:
+            for section in self.__sections.values():
+                self.__samples.update(section.samples)
+            for child in self.__opstats:
+                extract = extractor(child.tag, child.get('version'))
+                if extract is not None:
+                    extract(self, self.__section(child.tag), child)
+                    self.__sections[child.tag] = Section({name: self.__samples[name] for name in SECTION_FAMILIES[child.tag]})
+            self.collect_unhealthy()
+            self.__opstats = None
+            if self.__on_extract is not None:
+                self.__on_extract(self.__sections)
+        return self.__samples
+
+    def collect_unhealthy(self):
+        '''
+        Counts the components of each class (each *_good family) that are not
+        good.
+        '''
+        good = [(name, s) for name, s in self.__samples.items() if name.endswith('_good')]
+        if not good:
+            return
+        s = self.__section('nexsan_op_status')
+        for name, samples in good:
+            s['nexsan_unhealthy_components'].add(self.__values([name[len('nexsan_'):-len('_good')]]), samples.values.tolist().count(0))
 
-            self.__nexsan_perf_cpu_usage_percent.add_metric(values, int(controller.findtext('./cpu_percent')))
-            self.__nexsan_perf_memory_usage_percent.add_metric(values, int(controller.findtext('./memory_percent')))
+    def collect(self):
+        samples_by_name = self.extract()
+
+        for section, families in METRICS:
+            s = self.__sections.get(section)
+            if s is not None and s.families is not None:
+                yield from s.families
+                continue
+
+            collected = []
+            for name, type_, labelnames in families:
+                samples = samples_by_name.get(name)
+                if samples is None:
+                    continue
+                mf = family_types()[type_](name, '', labels=labelnames)
+                set_samples(mf, labelnames, zip(samples.labels, samples.values), self.__labels)
+                collected.append(mf)
+                yield mf
+            if s is not None:
+                s.families = collected
+
+    def __section(self, tag):
+        '''
+        Returns the Samples for the families of the given section, by name,
+        creating them the first time the section is seen.
+        '''
+        for section, families in METRICS:
+            if section == tag:
+                for name, _, _ in families:
+                    self.__samples.setdefault(name, Samples())
+        return self.__samples
+
+    def collect_sys_details(self, s, sys_details):
+        s['nexsan_sys_details'].add(self.__values([sys_details.findtext(l) for l in ['friendly_name', 'system_name', 'system_id', 'firmware_version']]), 1)
+        s['nexsan_sys_date'].add((), int(sys_details.findtext('date')))
+
+    def collect_env_status_v1(self, s, env_status):
+        '''
+        Version 1 has no enclosures: components are children of the section.
+        '''
+        self.collect_enclosure(s, env_status, '')
+
+    def collect_env_status_v3(self, s, env_status):
+        for enclosure in env_status.iterfind('enclosure'):
+            self.collect_enclosure(s, enclosure, enclosure.attrib['id'])
+
+    def collect_enclosure(self, s, enclosure, enclosure_id):
+        for child in enclosure:
+            collect = self.ENCLOSURE_CHILDREN.get(child.tag)
+            if collect is not None:
+                collect(self, s, child, enclosure_id)
+
+    def collect_psu(self, s, psu, enclosure_id):
+        values = self.__values([psu.attrib['id'], enclosure_id])
+
+        state = psu.find('state')
+        s['nexsan_env_psu_power_good'].add(values, self.isgood(state))
+        if 'power_watt' in state.attrib:
+            s['nexsan_env_psu_power_watts'].add(values, int(state.attrib['power_watt']))
 
-            for port in controller.iterfind('./port'):
-                port_values = values + [port.attrib['name']]
+        temp = psu.find('temperature_deg_c')
+        try:
+            x = int(temp.text)
+        except ValueError:
+            pass
+        else:
+            s['nexsan_env_psu_temp_celsius'].add(values, x)
+
+        s['nexsan_env_psu_temp_good'].add(values, self.isgood(temp))
+
+        for b in psu.iterfind('blower_rpm'):
+            labels = self.__values(values + (b.attrib['id'],))
+            s['nexsan_env_psu_blower_rpm'].add(labels, int(b.text))
+            s['nexsan_env_psu_blower_good'].add(labels, self.isgood(b))
+
+    def collect_controller(self, s, controller, enclosure_id):
+        values = self.__values([controller.attrib['id'], enclosure_id])
+
+        for v in controller.iterfind('voltage'):
+            labels = self.__values(values + (v.attrib['id'],))
+            s['nexsan_env_controller_voltage_volts'].add(labels, float(v.text))
+            s['nexsan_env_controller_voltage_good'].add(labels, self.isgood(v))
+
+        # Version 1 has a single temperature sensor, with no id.
+        for t in controller.iterfind('temperature_deg_c'):
+            labels = self.__values(values + (t.attrib.get('id', ''),))
+            s['nexsan_env_controller_temp_celsius'].add(labels, float(t.text))
+            s['nexsan_env_controller_temp_good'].add(labels, self.isgood(t))
+
+        for b in controller.iterfind('battery'):
+            labels = self.__values(values + (b.attrib['id'],))
+            s['nexsan_env_controller_battery_charge_good'].add(labels, self.isgood(b.find('charge_state')))
+
+    def collect_pod(self, s, pod, enclosure_id):
+        values = self.__values([pod.attrib['id'], enclosure_id])
+
+        for v in pod.iterfind('voltage'):
+            labels = self.__values(values + (v.attrib['id'],))
+            s['nexsan_env_pod_voltage_volts'].add(labels, float(v.text))
+            s['nexsan_env_pod_voltage_good'].add(labels, self.isgood(v))
+
+        for t in pod.iterfind('temperature_deg_c'):
+            labels = self.__values(values + (t.attrib['id'],))
+            s['nexsan_env_pod_temp_celsius'].add(labels, float(t.text))
+            s['nexsan_env_pod_temp_good'].add(labels, self.isgood(t))
+
+        for b1 in pod.iterfind('front_panel/blower_rpm'):
+            labels = self.__values(values + (b1.attrib['id'],))
+            s['nexsan_env_pod_front_blower_rpm'].add(labels, float(b1.text))
+            s['nexsan_env_pod_front_blower_good'].add(labels, self.isgood(b1))
+
+        for b2 in pod.iterfind('fan_tray/blower_rpm'):
+            labels = self.__values(values + (b2.attrib['id'],))
+            s['nexsan_env_pod_tray_blower_rpm'].add(labels, float(b2.text))
+            s['nexsan_env_pod_tray_blower_good'].add(labels, self.isgood(b2))
+
+    ENCLOSURE_CHILDREN = {
+        'psu': collect_psu,
+        'controller': collect_controller,
+        'pod': collect_pod,
+    }
+
+    def collect_volume_stats(self, s, volume_stats):
+        # Sums of the path families, by (rollup family, array).
+        totals = {}
+        for volume in volume_stats.iterfind('volume'):
+            self.collect_volume(s, volume, totals)
+
+        for (name, array_), total in totals.items():
+            s[name].add(self.__values([array_]), total)
+
+    def collect_volume(self, s, volume, totals):
+        values = (volume.attrib['id'], volume.attrib['name'], volume.attrib['array'], volume.attrib['serial_number'])
+
+        for path in volume.iterfind('path'):
+            path_values = self.__values(values + (path.attrib['init_ident'], path.attrib['target_id'], path.attrib['lun']))
+
+            for field in path:
+                name = PATH_FIELDS.get(field.tag)
+                if name is not None:
+                    x = int(field.text)
+                    s[name].add(path_values, x)
+                    key = PATH_ROLLUPS[name], values[2]
+                    totals[key] = totals.get(key, 0) + x
+
+    def collect_perf_status(self, s, perf):
+        for child in perf:
+            if child.tag == 'controller':
+                self.collect_perf_controller(s, child)
+            elif child.tag == 'array':
+                s['nexsan_perf_load_ratio'].add(self.__values([child.attrib['name'], child.findtext('owner')]), int(child.findtext('load_percent'))/100)
+
+    def collect_perf_controller(self, s, controller):
+        values = self.__values([controller.attrib['id']])
+
+        s['nexsan_perf_cpu_usage_percent'].add(values, int(controller.findtext('cpu_percent')))
+        s['nexsan_perf_memory_usage_percent'].add(values, int(controller.findtext('memory_percent')))
+
+        # Sums of the port families, by rollup family.
+        totals = {}
+        for port in controller.iterfind('port'):
+            port_values = self.__values(values + (port.attrib['name'],))
+
+            for field in port:
+                try:
+                    name, factor = PORT_FIELDS[field.tag]
+                except KeyError:
+                    pass
+                else:
+                    x = factor * int(field.text)
+                    s[name].add(port_values, x)
+                    rollup = PORT_ROLLUPS.get(name)
+                    if rollup is not None:
+                        totals[rollup] = totals.get(rollup, 0) + x
+
+            # Only present from version 2.
+            for le in port.iterfind('link_errors/link_error'):
+                s['nexsan_perf_link_errors_total'].add(self.__values(port_values + (le.attrib['error_name'],)), int(le.attrib['count']))
+
+        for name, total in totals.items():
+            s[name].add(values, total)
+
+    def collect_maid_stats(self, s, maid):
+        s['nexsan_maid_good'].add((), self.isgood(maid.find('maid_stats_status')))
+
+        for group in maid.iterfind('maid_group'):
+            for x in MAID_STATES:
+                elem = group.findtext('{}_percent'.format(x))
+                if elem is not None:
+                    s['nexsan_maid_{}_ratio'.format(x)].add(self.__values([group.attrib['name']]), int(elem)/100)
+
+    # The extractor for each section, by tag and then by version.
+    SECTIONS = {
+        'nexsan_sys_details': {1: collect_sys_details},
+        'nexsan_env_status': {1: collect_env_status_v1, 3: collect_env_status_v3},
+        'nexsan_volume_stats': {1: collect_volume_stats},
+        'nexsan_perf_status': {1: collect_perf_status, 2: collect_perf_status},
+        'nexsan_maid_stats': {2: collect_maid_stats},
+    }
+
+# Extractors chosen for each (tag, version) seen so far.
+_extractors = {}
+_extractors_lock = threading.Lock()
+
+def extractor(tag, version):
+    '''
+    Returns the Collector method that extracts samples from a section, given
+    its tag and version attribute; or None for sections that are not
+    collected.
 
-                self.__nexsan_perf_read_bytes_per_second.add_metric(port_values, 1024 * 1024 * int(port.findtext('./read_mbytes_per_sec')))
-                self.__nexsan_perf_write_bytes_per_second.add_metric(port_values, 1024 * 1024 * int(port.findtext('./write_mbytes_per_sec')))
-                self.__nexsan_perf_read_ios_total.add_metric(port_values, int(port.findtext('./read_ios')))
-                self.__nexsan_perf_write_ios_total.add_metric(port_values, int(port.findtext('./write_ios')))
-                self.__nexsan_perf_read_blocks_total.add_metric(port_values, int(port.findtext('./read_blocks')))
-                self.__nexsan_perf_write_blocks_total.add_metric(port_values, int(port.findtext('./write_blocks')))
-                self.__nexsan_perf_port_resets_total.add_metric(port_values, int(port.findtext('./port_resets')))
-                self.__nexsan_perf_lun_resets_total.add_metric(port_values, int(port.findtext('./lun_resets')))
+    For a version that we do not know about, the extractor for the newest
+    known version before it is used (or the oldest, if there is none) and a
+    warning is logged, once.
+    '''
+    try:
+        return _extractors[tag, version]
+    except KeyError:
+        pass
+
+    with _extractors_lock:
+        if (tag, version) in _extractors:
+            return _extractors[tag, version]
+
+        versions = Collector.SECTIONS.get(tag)
+        if versions is None:
+            result = None
+        else:
+            try:
+                v = int(version)
+            except (TypeError, ValueError):
+                v = None
+            if v in versions:
+                result = versions[v]
+            else:
+                older = [k for k in versions if v is not None and k < v]
+                chosen = max(older) if older else min(versions)
+                logger.warning('Unknown version %r of %s; treating it as version %d', version, tag, chosen)
+                result = versions[chosen]
+
+        _extractors[tag, version] = result
+        return result
+
+# Counts of documents and sections that were reused, or not, by SectionCache.
+reuse_counts = collections.Counter()
+_reuse_counts_lock = threading.Lock()
+
+_section_caches = {}
+_section_caches_lock = threading.Lock()
+
+def section_cache(target):
+    '''
+    Returns the SectionCache for target, creating it on first use.
+    '''
+    with _section_caches_lock:
+        try:
+            return _section_caches[target]
+        except KeyError:
+            c = _section_caches[target] = SectionCache()
+            return c
 
-                for le in port.iterfind('./link_errors/link_error'):
-                    self.__nexsan_perf_link_errors_total.add_metric(port_values + [le.attrib['error_name']], int(le.attrib['count']))
+def retained():
+    '''
+    Returns the SectionCache of each target, by target; see governor.
+    '''
+    with _section_caches_lock:
+        return dict(_section_caches)
 
-        for array in perf.iterfind('./array'):
-            self.__nexsan_perf_load_ratio.add_metric([array.attrib['name'], array.findtext('./owner')], int(array.findtext('./load_percent'))/100)
+def forget(target):
+    with _section_caches_lock:
+        _section_caches.pop(target, None)
 
-    def collect_maid_stats(self, maid):
-        self.__nexsan_maid_good.add_metric([], self.isgood(maid.find('./maid_stats_status')))
+def digest(data):
+    return hashlib.sha1(data).digest()
 
-        for group in maid.iterfind('./maid_group'):
-            for x in ['active', 'idle', 'slow', 'stopped', 'off', 'standby', 'efficiency']:
-                elem = group.findtext('./{}_percent'.format(x))
-                if elem is not None:
-                    getattr(self, '_Collector__nexsan_maid_{}_ratio'.format(x)).add_metric([group.attrib['name']], int(elem)/100)
+class SectionCache:
+    '''
+    Remembers a digest of each section of a target's last document, and what
+    was extracted from it, so that a section whose bytes have not changed is
+    not parsed, extracted or collected again. A document that has not changed
+    at all is not even split into sections.
+    '''
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__document = None
+        # (digest, Section) by tag.
+        self.__sections = {}
+
+    def collector(self, body, labels):
+        '''
+        Returns a Collector for body, parsing only the sections that have
+        changed.
+        '''
+        document = digest(body)
+        with self.__lock:
+            previous, cached = self.__document, self.__sections
+
+        if document == previous:
+            count_reuse(('document', 'hit'), [(tag, 'hit') for tag in cached])
+            return Collector([], labels, {tag: section for tag, (_, section) in cached.items()}, document=document)
+
+        digests = {}
+        reused = {}
+        changed = []
+        for tag, start, end in sections(body):
+            if tag in digests:
+                # Sections that appear more than once cannot be told apart.
+                return Collector(parsers.parse(body), labels)
+            d = digests[tag] = digest(body[start:end])
+            c = cached.get(tag)
+            if c is not None and c[0] == d:
+                reused[tag] = c[1]
+            else:
+                changed.append((start, end))
+        count_reuse(('document', 'miss'), [(tag, 'hit' if tag in reused else 'miss') for tag in digests])
+
+        opstats = None
+        if reused:
+            try:
+                opstats = [parsers.parse(body[start:end]) for start, end in changed]
+            except Exception:
+                logger.debug('Parsing changed sections failed; parsing the whole document', exc_info=True)
+        if opstats is None:
+            reused = {}
+            opstats = parsers.parse(body)
+
+        return Collector(opstats, labels, reused, functools.partial(self.__store, document, digests))
+
+    def __store(self, document, digests, extracted):
+        with self.__lock:
+            self.__document = document
+            self.__sections = {tag: (d, extracted[tag]) for tag, d in digests.items() if tag in extracted}
+
+def count_reuse(document, sections):
+    with _reuse_counts_lock:
+        reuse_counts[document] += 1
+        for key in sections:
+            reuse_counts[key] += 1
+
+def collect_reuse():
+    '''
+    Yields metric families counting the documents and sections reused by
+    SectionCache.
+    '''
+    from prometheus_client.core import CounterMetricFamily
+
+    with _reuse_counts_lock:
+        counts = dict(reuse_counts)
+    documents = CounterMetricFamily('nexsan_reuse_documents_total', 'Documents fetched that were identical to the previous one from their target', labels=['result'])
+    sections = CounterMetricFamily('nexsan_reuse_sections_total', 'Sections of documents fetched that were identical to the previous one from their target', labels=['section', 'result'])
+    for (key, result), count in sorted(counts.items()):
+        if key == 'document':
+            documents.add_metric([result], count)
+        else:
+            sections.add_metric([key, result], count)
+    yield documents
+    yield sections
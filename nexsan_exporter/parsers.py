@@ -0,0 +1,70 @@
+'''
+Interchangeable engines that parse an opstats document into a tree of
+elements with the ElementTree API, for nexsan.Collector to consume.
+
+The XML modules are imported when a document is first parsed, rather than at
+startup.
+'''
+import functools
+import importlib.util
+
+# Parse functions, by engine name. Each takes the document as bytes and
+# returns its root element.
+ENGINES = {}
+
+def engine(name):
+    '''
+    Decorator that registers a parse function under name.
+    '''
+    def decorator(fn):
+        ENGINES[name] = fn
+        return fn
+    return decorator
+
+@engine('etree')
+def parse_etree(body):
+    from xml.etree import ElementTree
+    return ElementTree.fromstring(body)
+
+@engine('expat')
+def parse_expat(body):
+    '''
+    Feeds expat events straight into an ElementTree TreeBuilder.
+
+    Opstats elements never have mixed content, so whitespace-only text (the
+    document's indentation) is dropped rather than stored as text and tails.
+    '''
+    import xml.parsers.expat
+    from xml.etree import ElementTree
+
+    builder = ElementTree.TreeBuilder()
+    parser = xml.parsers.expat.ParserCreate()
+    parser.buffer_text = True
+    parser.buffer_size = 65536
+    parser.StartElementHandler = builder.start
+    parser.EndElementHandler = builder.end
+
+    def data(text):
+        if not text.isspace():
+            builder.data(text)
+    parser.CharacterDataHandler = data
+
+    parser.Parse(body, True)
+    return builder.close()
+
+if importlib.util.find_spec('lxml') is not None:
+    @functools.lru_cache(maxsize=None)
+    def _lxml_parser():
+        import lxml.etree
+        return lxml.etree.XMLParser(remove_blank_text=True, remove_comments=True, remove_pis=True, resolve_entities=False)
+
+    @engine('lxml')
+    def parse_lxml(body):
+        import lxml.etree
+        return lxml.etree.fromstring(body, _lxml_parser())
+
+# The engine used by parse; may be changed at startup.
+default = 'etree'
+
+def parse(body):
+    return ENGINES[default](body)
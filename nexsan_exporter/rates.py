@@ -0,0 +1,145 @@
+'''
+Per-second rates of the volume path and port counters, computed from
+consecutive documents of each target, so that dashboards can graph them
+without asking Prometheus for rate() over thousands of series.
+
+Rates are computed over the array's own clock (nexsan_sys_date), so that a
+document reused while the array is busy does not count as an interval with
+no I/O. A counter that is lower than in the previous document was reset, and
+is taken to have counted up from 0.
+'''
+import array
+import math
+import threading
+import time
+
+from . import nexsan
+from . import targets
+
+# Whether rates are computed.
+enabled = False
+
+# The counters whose rates are computed, with the name of each rate's gauge.
+COUNTERS = tuple((name, name[:-len('_total')] + '_per_second') for name in [
+    'nexsan_volume_ios_total',
+    'nexsan_volume_ios_read_total',
+    'nexsan_volume_ios_write_total',
+    'nexsan_volume_blocks_read_total',
+    'nexsan_volume_blocks_write_total',
+    'nexsan_perf_read_ios_total',
+    'nexsan_perf_write_ios_total',
+    'nexsan_perf_read_blocks_total',
+    'nexsan_perf_write_blocks_total',
+    'nexsan_perf_port_resets_total',
+    'nexsan_perf_lun_resets_total',
+    'nexsan_perf_link_errors_total',
+])
+
+_rates = {}
+_rates_lock = threading.Lock()
+
+def get(target):
+    '''
+    Returns the Rates for target, creating it on first use.
+    '''
+    with _rates_lock:
+        try:
+            return _rates[target]
+        except KeyError:
+            r = _rates[target] = Rates()
+            return r
+
+def retained():
+    '''
+    Returns the Rates of each target, by target; see governor.
+    '''
+    with _rates_lock:
+        return dict(_rates)
+
+def forget(target):
+    with _rates_lock:
+        _rates.pop(target, None)
+
+def collect(target):
+    '''
+    Yields a gauge family for each counter whose rate is known for target.
+    '''
+    with _rates_lock:
+        r = _rates.get(target)
+    if r is not None:
+        yield from r.collect(targets.get(target).labels)
+
+def rate(previous, current, seconds):
+    '''
+    Returns the per-second rate of each series of current (a nexsan.Samples)
+    since previous, as an array, in one pass over both. Series that are not in
+    previous have a rate of nan.
+    '''
+    if previous.labels == current.labels:
+        before = previous.values
+    else:
+        index = dict(zip(previous.labels, previous.values))
+        before = [index.get(labels, math.nan) for labels in current.labels]
+    return array.array('d', [
+        ((c - p) if c >= p else c) / seconds if p == p else math.nan
+        for c, p in zip(current.values, before)
+    ])
+
+class Rates:
+    '''
+    The counters of a target's last document, and the rates computed from
+    them and the document before.
+    '''
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__time = None
+        # Samples of each counter in COUNTERS, by name.
+        self.__counters = {}
+        # (label values, rates) of each counter in COUNTERS, by name.
+        self.__rates = {}
+
+    def update(self, samples):
+        '''
+        Computes rates from samples, as returned by Collector.extract, and
+        keeps them for the next update. The rates are left alone if the
+        document's time has not moved on since the last update (as when it
+        is the same document), and forgotten if it went backwards.
+        '''
+        sys_date = samples.get('nexsan_sys_date')
+        now = sys_date.values[0] if sys_date is not None and len(sys_date.values) else time.time()
+
+        with self.__lock:
+            if self.__time is not None and now == self.__time:
+                return
+            seconds = now - self.__time if self.__time is not None and now > self.__time else None
+
+            counters = {}
+            rates = {}
+            for name, _ in COUNTERS:
+                current = samples.get(name)
+                if current is None:
+                    continue
+                counters[name] = current
+                previous = self.__counters.get(name)
+                if seconds is not None and previous is not None:
+                    rates[name] = current.labels, rate(previous, current, seconds)
+
+            self.__time = now
+            self.__counters = counters
+            self.__rates = rates
+
+    def collect(self, labels):
+        '''
+        Yields a gauge family for each counter whose rate is known. labels is
+        the target's targets.LabelCache.
+        '''
+        with self.__lock:
+            rates = self.__rates
+        for name, gauge in COUNTERS:
+            r = rates.get(name)
+            if r is None:
+                continue
+            labelnames = nexsan.LABELNAMES[name]
+            mf = nexsan.family_types()['gauge'](gauge, 'Per-second rate of {} between the last two documents'.format(name), labels=labelnames)
+            nexsan.set_samples(mf, labelnames, ((values, value) for values, value in zip(*r) if value == value), labels)
+            yield mf
@@ -0,0 +1,159 @@
+'''
+Renders metrics from saved opstats documents, without running the server.
+
+This gives the exposition for arrays that are polled some other way (e.g. by
+cron, for node_exporter's textfile collector), and a way to time the parse,
+collect and render steps on their own.
+'''
+import concurrent.futures
+import os
+import sys
+import tempfile
+import time
+import urllib.parse
+
+from . import capture
+from . import exporter
+from . import nexsan
+from . import parsers
+
+def read(path):
+    if path.endswith(capture.SUFFIX):
+        return capture.load(path)
+    with open(path, 'rb') as f:
+        return f.read()
+
+def target_name(path):
+    '''
+    Returns the name used for the probe_target label of a file's series. For
+    a capture saved by --record, this is the target it was taken from, named
+    by its directory; otherwise it is the file's base name, without its .xml
+    or .xml.gz suffix (so a snapshot gives the name of its target too).
+    '''
+    directory, name = os.path.split(path)
+    if capture_time(name) is not None:
+        return urllib.parse.unquote(os.path.basename(os.path.abspath(directory)))
+    if name.endswith(capture.SUFFIX):
+        return urllib.parse.unquote(name[:-len(capture.SUFFIX)])
+    if name.endswith('.xml'):
+        return name[:-len('.xml')]
+    return name
+
+def capture_time(name):
+    '''
+    Returns the time in a capture's file name, as a string, or None if name
+    is not that of a capture saved by --record.
+    '''
+    if name.endswith(capture.SUFFIX):
+        stem = name[:-len(capture.SUFFIX)]
+        if stem.isdigit():
+            return stem
+    return None
+
+def output_path(output_dir, path):
+    '''
+    Returns the file that --output-dir writes a file's metrics to:
+    DIR/<name>.prom, where name is as returned by target_name; or, for a
+    capture saved by --record, DIR/<name>/<time>.prom, so that the captures
+    of a target do not overwrite each other. Raises ValueError if the name
+    would lead outside DIR.
+    '''
+    target = target_name(path)
+    if not target or '/' in target or '..' in target:
+        raise ValueError('Cannot write the metrics of {!r} to {!r}'.format(path, target + '.prom'))
+    time_ = capture_time(os.path.basename(path))
+    if time_ is not None:
+        return os.path.join(output_dir, target, time_ + '.prom')
+    return os.path.join(output_dir, target + '.prom')
+
+def render_file(path, engine, label):
+    '''
+    Returns the exposition for a saved document, and the time taken by each
+    step. If label is true, each series gets a probe_target label naming the
+    file, as with /probe_many.
+    '''
+    timings = []
+    start = time.perf_counter()
+
+    body = read(path)
+    timings.append(('read', time.perf_counter() - start))
+
+    root = parsers.ENGINES[engine](body)
+    timings.append(('parse', time.perf_counter() - start - sum(t for _, t in timings)))
+
+    collector = nexsan.Collector(root)
+    collector.extract()
+    timings.append(('collect', time.perf_counter() - start - sum(t for _, t in timings)))
+
+    families = collector.collect()
+    if label:
+        target = target_name(path)
+        families = (exporter.relabel(mf, probe_target=target) for mf in families)
+    output = b''.join(exporter.render(families))
+    timings.append(('render', time.perf_counter() - start - sum(t for _, t in timings)))
+
+    return output, timings
+
+def write_atomically(path, data):
+    '''
+    Writes data to path via a temporary file in the same directory, so that a
+    reader (such as the textfile collector) never sees a partial file.
+    '''
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix='.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+def strip_duplicate_headers(output, seen):
+    '''
+    Removes the HELP and TYPE lines of families whose headers were already
+    written, so that several files can be printed as one exposition.
+    '''
+    lines = []
+    for line in output.splitlines(True):
+        if line.startswith(b'# HELP ') or line.startswith(b'# TYPE '):
+            name = line.split(b' ', 3)[2]
+            if (line[:6], name) in seen:
+                continue
+            seen.add((line[:6], name))
+        lines.append(line)
+    return b''.join(lines)
+
+def main(args):
+    '''
+    Entry point for the render command.
+    '''
+    # Label series with the file they came from, unless there is only one
+    # exposition to print.
+    label = args.output_dir is not None or len(args.files) > 1
+
+    if args.output_dir is not None:
+        try:
+            outputs = [output_path(args.output_dir, path) for path in args.files]
+        except ValueError as e:
+            sys.exit('render: {}'.format(e))
+
+    with concurrent.futures.ProcessPoolExecutor(args.jobs) as ex:
+        results = ex.map(render_file, args.files, [args.xml_parser] * len(args.files), [label] * len(args.files))
+
+        seen = set()
+        totals = {}
+        for i, (path, (output, timings)) in enumerate(zip(args.files, results)):
+            if args.output_dir is not None:
+                os.makedirs(os.path.dirname(outputs[i]), exist_ok=True)
+                write_atomically(outputs[i], output)
+            else:
+                sys.stdout.buffer.write(strip_duplicate_headers(output, seen))
+
+            if args.bench:
+                print('{}: {}'.format(path, ' '.join('{}={:.3f}ms'.format(step, t * 1000) for step, t in timings)), file=sys.stderr)
+                for step, t in timings:
+                    totals[step] = totals.get(step, 0) + t
+
+    if args.bench:
+        print('total: {}'.format(' '.join('{}={:.3f}ms'.format(step, t * 1000) for step, t in totals.items())), file=sys.stderr)
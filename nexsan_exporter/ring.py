@@ -0,0 +1,34 @@
+import array
+
+class Ring:
+    '''
+    A fixed-size ring buffer of numbers, stored in an array.
+
+    typecode is as for array.array: 'd' for floats, 'q' for integers.
+    '''
+    __slots__ = ('__values', '__next', '__count')
+
+    def __init__(self, size, typecode='d'):
+        self.__values = array.array(typecode, bytes(array.array(typecode).itemsize * size))
+        self.__next = 0
+        self.__count = 0
+
+    def __len__(self):
+        return self.__count
+
+    def append(self, value):
+        self.__values[self.__next] = value
+        self.__next = (self.__next + 1) % len(self.__values)
+        self.__count = min(self.__count + 1, len(self.__values))
+
+    def values(self):
+        '''
+        Returns the stored values, oldest first.
+        '''
+        if self.__count < len(self.__values):
+            return self.__values[:self.__count].tolist()
+        return (self.__values[self.__next:] + self.__values[:self.__next]).tolist()
+
+    @property
+    def nbytes(self):
+        return self.__values.itemsize * len(self.__values)
@@ -0,0 +1,151 @@
+'''
+Background sampling of the instantaneous port throughput gauges.
+
+The array reports read_mbytes_per_sec and write_mbytes_per_sec as point
+samples, so a scrape every 30 seconds misses short bursts. When sampling is
+enabled, each probed target gets a thread that fetches opstats every interval
+seconds, keeps the throughput of each port in a ring buffer covering the last
+window seconds, and reports the maximum, average and some quantiles over it.
+'''
+import functools
+import logging
+import math
+import threading
+import time
+
+from . import nexsan
+from . import parsers
+from . import ring
+from . import targets
+
+logger = logging.getLogger(__name__)
+
+# Seconds between samples; 0 disables sampling.
+interval = 0
+
+# Seconds of samples to report over.
+window = 30
+
+# A sampler stops when its target has not been probed for this many windows.
+IDLE_WINDOWS = 10
+
+QUANTILES = [0.5, 0.9, 0.99]
+
+# The gauges that are sampled, and the name prefix of the families reported
+# for each.
+GAUGES = ['nexsan_perf_read_bytes_per_second', 'nexsan_perf_write_bytes_per_second']
+
+_samplers = {}
+_samplers_lock = threading.Lock()
+
+def touch(target, user, pass_):
+    '''
+    Returns the running Sampler for target, starting one if necessary, and
+    notes that the target has been probed. A sampler started with other
+    credentials is stopped and replaced, so that its samples are not
+    reported to a probe that could not have fetched them.
+    '''
+    credentials = targets.credentials(user, pass_)
+    with _samplers_lock:
+        s = _samplers.get(target)
+        if s is not None and not targets.same_credentials(s.credentials, credentials):
+            s.stop()
+            s = None
+        if s is None or not s.is_alive():
+            s = _samplers[target] = Sampler(target, user, pass_)
+            s.start()
+        s.touched = time.monotonic()
+        return s
+
+class Sampler(threading.Thread):
+    def __init__(self, target, user, pass_):
+        super().__init__(name='sampler {}'.format(target), daemon=True)
+        self.target = target
+        self.credentials = targets.credentials(user, pass_)
+        self.touched = time.monotonic()
+        # Straight from the array, not through capture: replayed captures
+        # are for probes, and a sample need not be recorded.
+        self.__fetch = functools.partial(targets.get(target).fetch, functools.partial(nexsan.fetch, user=user, pass_=pass_), self.credentials)
+        self.__stopping = threading.Event()
+        self.__failing = False
+        self.__size = max(1, int(math.ceil(window / interval)))
+        self.__lock = threading.Lock()
+        # Ring buffers by gauge name, then by label values.
+        self.__rings = {name: {} for name in GAUGES}
+
+    def stop(self):
+        '''
+        Makes the sampler stop, without waiting for it.
+        '''
+        self.__stopping.set()
+
+    def run(self):
+        while not self.__stopping.is_set() and time.monotonic() - self.touched < IDLE_WINDOWS * window:
+            start = time.monotonic()
+            try:
+                self.sample(self.__fetch())
+            except Exception:
+                # Only the first failure in a row is worth a warning.
+                (logger.debug if self.__failing else logger.warning)('Sampling %r failed', self.target, exc_info=True)
+                self.__failing = True
+            else:
+                self.__failing = False
+            # Sampling stretches along with the target's fetch interval, so
+            # that a busy array is not sampled from a reused document.
+            self.__stopping.wait(max(0, max(interval, targets.get(self.target).interval()) - (time.monotonic() - start)))
+
+        with _samplers_lock:
+            if _samplers.get(self.target) is self:
+                del _samplers[self.target]
+
+    def sample(self, body):
+        '''
+        Records the throughput gauges from an opstats document. Only the perf
+        section is parsed.
+        '''
+        for tag, start, end in nexsan.sections(body):
+            if tag == 'nexsan_perf_status':
+                section = parsers.parse(body[start:end])
+                break
+        else:
+            return
+
+        with self.__lock:
+            for mf in nexsan.Collector([section]).collect():
+                rings = self.__rings.get(mf.name)
+                if rings is None:
+                    continue
+                for sample in mf.samples:
+                    # Samples have more fields from prometheus_client 0.4.
+                    labels, value = sample[1], sample[2]
+                    key = labels['controller'], labels['port']
+                    r = rings.get(key)
+                    if r is None:
+                        r = rings[key] = ring.Ring(self.__size)
+                    r.append(value)
+
+    def collect(self):
+        from prometheus_client.core import GaugeMetricFamily
+
+        with self.__lock:
+            snapshot = {name: {key: r.values() for key, r in rings.items()} for name, rings in self.__rings.items()}
+
+        for name in GAUGES:
+            mf_max = GaugeMetricFamily(name + '_max', 'Maximum over the sampling window', labels=['controller', 'port'])
+            mf_avg = GaugeMetricFamily(name + '_avg', 'Average over the sampling window', labels=['controller', 'port'])
+            mf_quantile = GaugeMetricFamily(name + '_quantile', 'Quantiles over the sampling window', labels=['controller', 'port', 'quantile'])
+            for key, values in snapshot[name].items():
+                if not values:
+                    continue
+                mf_max.add_metric(key, max(values))
+                mf_avg.add_metric(key, sum(values) / len(values))
+                for q in QUANTILES:
+                    mf_quantile.add_metric(key + (str(q),), targets.percentile(values, q * 100))
+            yield mf_max
+            yield mf_avg
+            yield mf_quantile
+
+        mf = GaugeMetricFamily('nexsan_perf_samples', 'Number of samples in the sampling window', labels=['controller', 'port'])
+        for key, values in snapshot[GAUGES[0]].items():
+            mf.add_metric(key, len(values))
+        yield mf
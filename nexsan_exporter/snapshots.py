@@ -0,0 +1,274 @@
+'''
+The last good opstats document of each target, saved on disk so that a
+restarted exporter can answer probes before the arrays do.
+
+Each target's snapshot is stored gzip-compressed in DIR/<target>.xml.gz (the
+same format as capture), with the file's modification time set to when the
+document was fetched. Beside it, DIR/<target>.auth holds an HMAC of the
+credentials that fetched it, keyed by a secret in DIR/.key.
+
+At startup every snapshot is loaded as a stale document for its target.
+Until the target is fetched again, probes with the same credentials are
+answered from the stale document at once, marked as such, while a fresh
+fetch with them runs in the background; other probes fetch the target
+themselves. So that a stale document does not hide an array that has stopped
+answering, it is dropped once it is older than max_age, once that background
+fetch fails, or once any other fetch fails for a reason other than the
+credentials it was given.
+'''
+import concurrent.futures
+import gzip
+import hmac
+import logging
+import os
+import tempfile
+import threading
+import time
+import urllib.parse
+
+from . import capture
+
+logger = logging.getLogger(__name__)
+
+# If set, snapshots are saved and loaded under this directory.
+directory = None
+
+# Seconds after it was fetched that a snapshot is no longer used; 0 for no
+# limit.
+max_age = 3600.0
+
+# Stale Snapshots loaded at startup, by target, until each is replaced by a
+# fresh document.
+_stale = {}
+# Digest of the document last saved for each target, and the credentials
+# that fetched it, so that an unchanged document is not compressed and
+# written again.
+_digests = {}
+# The secret that credentials are hashed with, by directory.
+_keys = {}
+_lock = threading.Lock()
+
+# Snapshots are compressed and written here, off the request thread.
+_writer = concurrent.futures.ThreadPoolExecutor(1)
+
+# Background fetches of targets with stale snapshots run here.
+_refresher = concurrent.futures.ThreadPoolExecutor(8)
+
+class Snapshot:
+    '''
+    A document loaded from disk: a nexsan.Collector whose samples have been
+    extracted, the credentials that fetched it (as returned by credentials,
+    or None if they are not known), and the future of the fetch started to
+    replace it, if any.
+    '''
+    def __init__(self, collector, credentials):
+        self.collector = collector
+        self.credentials = credentials
+        self.refreshing = None
+
+def expired(fetched):
+    '''
+    Returns whether a snapshot fetched at fetched (a time.time() value) is too
+    old to use.
+    '''
+    return bool(max_age) and time.time() - fetched > max_age
+
+def path(target):
+    return os.path.join(directory, urllib.parse.quote(target, safe='') + capture.SUFFIX)
+
+def auth_path(target):
+    return os.path.join(directory, urllib.parse.quote(target, safe='') + '.auth')
+
+def key():
+    '''
+    Returns the secret that credentials are hashed with, creating it the first
+    time.
+    '''
+    with _lock:
+        try:
+            return _keys[directory]
+        except KeyError:
+            pass
+        p = os.path.join(directory, '.key')
+        try:
+            fd = os.open(p, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        except FileExistsError:
+            with open(p, 'rb') as f:
+                k = f.read()
+        else:
+            k = os.urandom(32)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(k)
+        _keys[directory] = k
+        return k
+
+def credentials(user, pass_):
+    '''
+    Returns an HMAC of user and pass_, in hex, to compare with a snapshot's.
+    '''
+    return hmac.new(key(), '{}:{}'.format(user, pass_).encode('utf-8'), 'sha256').hexdigest()
+
+def save(target, body, user, pass_):
+    '''
+    Records body, fetched with user and pass_, as the last good document of
+    target, replacing any stale snapshot in memory. The file is written in
+    the background.
+    '''
+    from . import nexsan
+
+    d = nexsan.digest(body), credentials(user, pass_)
+    with _lock:
+        _stale.pop(target, None)
+        unchanged = _digests.get(target) == d
+        _digests[target] = d
+    _writer.submit(write, target, None if unchanged else body, d[1], time.time())
+
+def write(target, body, credentials, fetched):
+    '''
+    Writes body to target's snapshot, and credentials beside it, each under a
+    temporary name and renamed into place, so that a crash never leaves a
+    partial file. If body is None, neither is changed, and only the time the
+    document was fetched is updated.
+    '''
+    p = path(target)
+    try:
+        if body is None:
+            os.utime(p, (fetched, fetched))
+            return
+
+        replace_file(auth_path(target), credentials.encode('ascii'), None)
+        replace_file(p, gzip.compress(body), fetched)
+    except OSError:
+        logger.warning('Could not save snapshot of %s', target, exc_info=True)
+
+def replace_file(p, data, mtime):
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        if mtime is not None:
+            os.utime(tmp, (mtime, mtime))
+        os.replace(tmp, p)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+def load():
+    '''
+    Loads every snapshot in directory as a stale document for its target,
+    unless the target has been fetched since the exporter started. Run in the
+    background at startup.
+    '''
+    from . import nexsan
+
+    start = time.monotonic()
+    loaded = 0
+    for name in sorted(os.listdir(directory)):
+        if name.startswith('.') or not name.endswith(capture.SUFFIX):
+            continue
+        target = urllib.parse.unquote(name[:-len(capture.SUFFIX)])
+        p = os.path.join(directory, name)
+        try:
+            fetched = os.stat(p).st_mtime
+            if expired(fetched):
+                continue
+            # Decompressed straight from a memory map of the file.
+            body = capture.load(p)
+            collector = nexsan.document_collector(target, body)
+            collector.extract()
+        except Exception:
+            logger.warning('Could not load snapshot %s', p, exc_info=True)
+            continue
+        collector.snapshot_time = fetched
+        try:
+            with open(auth_path(target), 'rb') as f:
+                auth = f.read().decode('ascii').strip()
+        except (OSError, UnicodeDecodeError):
+            # Saved by a version that did not record credentials; answered
+            # to no one.
+            auth = None
+
+        with _lock:
+            if target in _digests:
+                continue
+            _digests[target] = nexsan.digest(body), auth
+            _stale[target] = Snapshot(collector, auth)
+        loaded += 1
+    logger.info('Loaded %d snapshots in %.1fs', loaded, time.monotonic() - start)
+
+def stale(target, user, pass_, refresh):
+    '''
+    Returns target's stale Snapshot, or None if it has none (or it has
+    expired, or was fetched with credentials other than user and pass_).
+    Unless a previous call's refresh is still running, refresh is first
+    started in the background; it should fetch the target with user and
+    pass_, which replaces the snapshot.
+    '''
+    c = credentials(user, pass_)
+    with _lock:
+        snapshot = _stale.get(target)
+        if snapshot is None:
+            return None
+        if expired(snapshot.collector.snapshot_time):
+            del _stale[target]
+            return None
+        if snapshot.credentials is None or not hmac.compare_digest(snapshot.credentials, c):
+            return None
+        if snapshot.refreshing is None or snapshot.refreshing.done():
+            snapshot.refreshing = _refresher.submit(replace, target, snapshot, refresh)
+    return snapshot
+
+def retained():
+    '''
+    Returns the collector of each stale snapshot, by target; see governor.
+    '''
+    with _lock:
+        return {target: s.collector for target, s in _stale.items()}
+
+def forget(target):
+    with _lock:
+        _stale.pop(target, None)
+
+def replace(target, snapshot, refresh):
+    '''
+    Calls refresh to replace target's stale snapshot. If it fails, the
+    snapshot is dropped, so that further probes report the failure rather
+    than the old document; the credentials it used are those that fetched
+    the snapshot, so even an authentication failure means they are no longer
+    good.
+    '''
+    try:
+        return refresh()
+    except Exception as e:
+        logger.warning('Fetching %s to replace its stale snapshot failed: %s', target, e)
+        with _lock:
+            if _stale.get(target) is snapshot:
+                del _stale[target]
+        raise
+
+def failed(target, error):
+    '''
+    Called when a probe of target that was not answered from its stale
+    snapshot fails with error. Unless the array refused the probe's
+    credentials (which need not be those of the snapshot), the snapshot is
+    dropped, as in replace.
+    '''
+    from . import nexsan
+
+    if nexsan.unauthorized(error):
+        return
+    with _lock:
+        _stale.pop(target, None)
+
+def collect(collector):
+    '''
+    Yields metric families saying whether collector's document came from a
+    stale snapshot.
+    '''
+    from prometheus_client.core import GaugeMetricFamily
+
+    yield GaugeMetricFamily('nexsan_probe_snapshot_stale', 'Whether the metrics came from a document saved before the exporter started, because the target has not been fetched since', value=int(collector.snapshot_time is not None))
+    if collector.snapshot_time is not None:
+        yield GaugeMetricFamily('nexsan_probe_snapshot_age_seconds', 'Time since the saved document the metrics came from was fetched', value=time.time() - collector.snapshot_time)
@@ -0,0 +1,380 @@
+import collections
+import concurrent.futures
+import hmac
+import os
+import threading
+import time
+
+from . import timing
+
+# Percentile of the preferred address's recent fetch latencies after which a
+# hedged request is sent to the next address.
+hedge_percentile = 95
+
+# Hedge delay used until an address has enough latency history.
+hedge_default_delay = 1.0
+
+# Latency charged to an address whose fetch failed, so that a dead controller
+# stops being preferred.
+failure_penalty = 5.0
+
+# At most this many fetches are sent to one management address at a time; the
+# arrays' embedded web servers slow down or fail when given several.
+max_concurrent_fetches = 1
+
+# Fetches from one management address are started at least this many seconds
+# apart.
+min_fetch_interval = 0
+
+# A fetch that has waited this many seconds for its turn gives up.
+fetch_queue_timeout = 10.0
+
+# If nonzero, a target whose busiest controller reports more CPU use than this
+# percentage is fetched at most once every busy_interval seconds; probes in
+# between are answered from the last document fetched. This stops monitoring
+# from adding load to a controller that is already saturated.
+busy_cpu_percent = 0
+busy_interval = 60.0
+
+LATENCY_HISTORY = 64
+LATENCY_MIN_SAMPLES = 5
+
+# Time fetches spend waiting for their turn.
+queue_wait = timing.Histogram([.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10])
+queue_timeouts = 0
+_queue_timeouts_lock = threading.Lock()
+
+_executor = concurrent.futures.ThreadPoolExecutor(32)
+
+# Credentials are remembered as an HMAC with this, rather than as given.
+_credentials_key = os.urandom(32)
+
+_targets = {}
+_targets_lock = threading.Lock()
+
+def get(name):
+    '''
+    Returns the Target for name, creating it on first use.
+    '''
+    with _targets_lock:
+        try:
+            return _targets[name]
+        except KeyError:
+            t = _targets[name] = Target(name)
+            return t
+
+def retained():
+    '''
+    Returns the Target of each target, by name; see governor.
+    '''
+    with _targets_lock:
+        return dict(_targets)
+
+def forget(name):
+    '''
+    Drops the Target of name, so that targets named in probes do not pile up
+    forever; it is created afresh by the next probe.
+    '''
+    with _targets_lock:
+        _targets.pop(name, None)
+
+def collect():
+    '''
+    Yields the metric families describing the fetch queues.
+    '''
+    from prometheus_client.core import CounterMetricFamily
+
+    yield queue_wait.family('nexsan_fetch_queue_wait_seconds', 'Time fetches waited for their turn to contact a management address')
+    yield CounterMetricFamily('nexsan_fetch_queue_timeouts_total', 'Fetches that gave up waiting for their turn', value=queue_timeouts)
+
+def credentials(user, pass_):
+    '''
+    Returns a digest of user and pass_, so that whether two probes gave the
+    same credentials can be told without keeping them.
+    '''
+    return hmac.new(_credentials_key, '{}:{}'.format(user, pass_).encode('utf-8'), 'sha256').hexdigest()
+
+def same_credentials(a, b):
+    '''
+    Returns whether a and b, as returned by credentials, are the same.
+    '''
+    return a is not None and b is not None and hmac.compare_digest(a, b)
+
+def percentile(values, p):
+    s = sorted(values)
+    return s[int(round(p / 100 * (len(s) - 1)))]
+
+class Target:
+    '''
+    State kept for a target between probes.
+
+    A target names one array. Its name may list several management addresses
+    (one per controller), separated by commas; any of them can serve opstats.
+    '''
+    def __init__(self, name):
+        self.name = name
+        self.addresses = [a.strip() for a in name.split(',') if a.strip()]
+        if not self.addresses:
+            raise ValueError('No addresses in target {!r}'.format(name))
+        self.__lock = threading.Lock()
+        self.__latencies = {a: collections.deque(maxlen=LATENCY_HISTORY) for a in self.addresses}
+        self.__gates = {a: Gate() for a in self.addresses}
+        self.labels = LabelCache()
+        # Reported by the most recent document, once one has been collected.
+        self.cpu_percent = None
+        self.__last_fetch = None
+        self.__last_body = None
+        self.__last_credentials = None
+
+    def preferred(self):
+        '''
+        Returns the addresses, fastest first. Addresses with no history keep
+        their configured order, after those that have been measured.
+        '''
+        with self.__lock:
+            medians = {a: percentile(l, 50) if l else float('inf') for a, l in self.__latencies.items()}
+        return sorted(self.addresses, key=medians.__getitem__)
+
+    def hedge_delay(self, address):
+        '''
+        Returns how long to wait for address before hedging to the next one.
+        '''
+        with self.__lock:
+            l = self.__latencies[address]
+            if len(l) < LATENCY_MIN_SAMPLES:
+                return hedge_default_delay
+            return percentile(l, hedge_percentile)
+
+    def interval(self):
+        '''
+        Returns the minimum number of seconds between fetches of the target,
+        stretched while its controllers are busy.
+        '''
+        if busy_cpu_percent and self.cpu_percent is not None and self.cpu_percent > busy_cpu_percent:
+            return max(min_fetch_interval, busy_interval)
+        return min_fetch_interval
+
+    def document_age(self):
+        '''
+        Returns the number of seconds since the last document was fetched, or
+        None if there has not been one.
+        '''
+        with self.__lock:
+            if self.__last_fetch is None:
+                return None
+            return time.monotonic() - self.__last_fetch
+
+    def collect(self):
+        '''
+        Yields metric families describing how the target is being polled.
+        '''
+        from prometheus_client.core import GaugeMetricFamily
+
+        yield GaugeMetricFamily('nexsan_probe_fetch_interval_seconds', 'Current minimum interval between fetches of the target', value=self.interval())
+        age = self.document_age()
+        if age is not None:
+            yield GaugeMetricFamily('nexsan_probe_document_age_seconds', 'Time since the document the metrics came from was fetched', value=age)
+
+    def fetch(self, fetch_one, credentials=None):
+        '''
+        Returns a document from the target, as fetch_hedged does. While the
+        target is busy (see busy_cpu_percent), the last document is returned
+        instead if it was fetched less than interval() seconds ago, with the
+        same credentials (as returned by the credentials function; fetch_one
+        uses them).
+        '''
+        if busy_cpu_percent:
+            with self.__lock:
+                if self.__last_body is not None and time.monotonic() - self.__last_fetch < self.interval() and same_credentials(self.__last_credentials, credentials):
+                    return self.__last_body
+
+        result = self.fetch_hedged(fetch_one)
+        with self.__lock:
+            self.__last_fetch = time.monotonic()
+            self.__last_body = result if busy_cpu_percent else None
+            self.__last_credentials = credentials if busy_cpu_percent else None
+        return result
+
+    def fetch_hedged(self, fetch_one):
+        '''
+        Calls fetch_one(address) for the preferred address. If it has not
+        answered within its hedge delay (or fails), the next address is tried
+        as well; the first successful result is returned. Requests that lose
+        the race are left to finish in the background so that their latency is
+        still recorded.
+
+        Each fetch first waits for its turn at its address (see Gate), until
+        fetch_queue_timeout seconds after this is called. The wait is on the
+        calling thread, so that fetches queued for one array do not hold the
+        shared fetch threads that other arrays need; and the hedge delay is
+        counted from when the fetch starts, not from when it was queued.
+        '''
+        deadline = time.monotonic() + fetch_queue_timeout
+        addresses = self.preferred()
+        pending = {}
+        error = None
+        while True:
+            timeout = None
+            if addresses:
+                a = addresses[0]
+                gate = self.__gates[a]
+                try:
+                    # A hedge stops waiting for its turn as soon as an earlier
+                    # fetch has finished, in case that one succeeded.
+                    turn = gate.acquire(deadline, lambda: any(f.done() for f in pending))
+                except QueueTimeout as e:
+                    addresses.pop(0)
+                    error = e
+                    continue
+                if turn:
+                    addresses.pop(0)
+                    f = _executor.submit(self.__timed, fetch_one, a)
+                    f.add_done_callback(self.__wake)
+                    pending[f] = a
+                    if addresses:
+                        timeout = self.hedge_delay(a)
+            if not pending:
+                raise error
+
+            done, _ = concurrent.futures.wait(pending, timeout, concurrent.futures.FIRST_COMPLETED)
+            for f in done:
+                del pending[f]
+                try:
+                    return f.result()
+                except Exception as e:
+                    error = e
+
+    def __timed(self, fetch_one, address):
+        '''
+        Fetches from address, whose turn at its Gate has been acquired.
+        '''
+        gate = self.__gates[address]
+        try:
+            start = time.monotonic()
+            try:
+                result = fetch_one(address)
+            except Exception:
+                self.__record(address, max(time.monotonic() - start, failure_penalty))
+                raise
+            self.__record(address, time.monotonic() - start)
+            return result
+        finally:
+            gate.release()
+
+    def __wake(self, future):
+        for gate in self.__gates.values():
+            gate.wake()
+
+    def __record(self, address, latency):
+        with self.__lock:
+            self.__latencies[address].append(latency)
+
+class QueueTimeout(Exception):
+    pass
+
+class Gate:
+    '''
+    Queues the fetches from one management address, so that no more than
+    max_concurrent_fetches are in progress at once, and so that each starts
+    at least min_fetch_interval seconds after the previous one.
+    '''
+    def __init__(self):
+        self.__cond = threading.Condition()
+        self.__active = 0
+        self.__last_start = float('-inf')
+
+    def acquire(self, deadline, cancelled=None):
+        '''
+        Waits for a turn, and returns True. Raises QueueTimeout if there is
+        none before deadline (a time.monotonic() value). If cancelled is given,
+        it is called whenever the wait is woken (see wake), and if it returns
+        true, False is returned without a turn.
+        '''
+        global queue_timeouts
+
+        start = time.monotonic()
+        with self.__cond:
+            while True:
+                now = time.monotonic()
+                # How long until the interval since the last fetch has passed,
+                # or None if another fetch has to finish first.
+                delay = None
+                if self.__active < max_concurrent_fetches:
+                    delay = self.__last_start + min_fetch_interval - now
+                    if delay <= 0:
+                        break
+                if cancelled is not None and cancelled():
+                    queue_wait.observe(now - start)
+                    return False
+                if now >= deadline:
+                    with _queue_timeouts_lock:
+                        queue_timeouts += 1
+                    queue_wait.observe(now - start)
+                    raise QueueTimeout('Gave up waiting {:.1f}s for a turn to fetch'.format(now - start))
+                self.__cond.wait(deadline - now if delay is None else min(delay, deadline - now))
+
+            self.__active += 1
+            self.__last_start = now
+        queue_wait.observe(now - start)
+        return True
+
+    def release(self):
+        with self.__cond:
+            self.__active -= 1
+            self.__cond.notify()
+
+    def wake(self):
+        '''
+        Wakes the fetches waiting for a turn, so that they check whether they
+        are still wanted.
+        '''
+        with self.__cond:
+            self.__cond.notify_all()
+
+class LabelCache:
+    '''
+    Interns label value tuples, and the label dicts built from them, so that
+    all the families of a series share one copy, and so that they are reused
+    from one probe of a target to the next.
+
+    Entries that were not used since the previous call to rotate are dropped
+    by the next one, so series that go away do not stay here forever.
+    '''
+    def __init__(self):
+        self.__values = [{}, {}]
+        self.__labels = [{}, {}]
+
+    def rotate(self):
+        '''
+        Called at the start of each probe.
+        '''
+        self.__values = [{}, self.__values[0]]
+        self.__labels = [{}, self.__labels[0]]
+
+    def values(self, values):
+        '''
+        Returns the shared tuple equal to values.
+        '''
+        t = tuple(values)
+        current, previous = self.__values
+        try:
+            return current[t]
+        except KeyError:
+            result = current[t] = previous.get(t, t)
+            return result
+
+    def labels(self, labelnames, values):
+        '''
+        Returns the shared label dict for values (as returned by the values
+        method) and a family's label names.
+        '''
+        key = labelnames, values
+        current, previous = self.__labels
+        try:
+            return current[key]
+        except KeyError:
+            result = previous.get(key)
+            if result is None:
+                result = dict(zip(labelnames, values))
+            current[key] = result
+            return result
@@ -0,0 +1,129 @@
+'''
+Timing of the phases of a probe, for the Server-Timing header and the slow
+request log.
+'''
+import bisect
+import contextlib
+import json
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Probes that take longer than this many seconds are logged; 0 disables the
+# log.
+slow_threshold = 0
+
+# At most this many slow probes are logged per second; the rest are counted,
+# and the count is included in the next entry that is logged.
+slow_log_rate = 1.0
+
+class Timings:
+    '''
+    The duration of each phase of a probe, in the order they happened.
+    '''
+    def __init__(self):
+        self.start = time.monotonic()
+        self.phases = []
+        self.upstream_bytes = None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.monotonic() - start))
+
+    def header(self):
+        '''
+        Returns the value of a Server-Timing header for the phases so far.
+        '''
+        return ', '.join('{};dur={:.1f}'.format(name, t * 1000) for name, t in self.phases)
+
+class RateLimiter:
+    '''
+    A token bucket: allows rate events per second, with bursts of up to rate
+    events (or one, if rate is less than one).
+    '''
+    def __init__(self, rate):
+        self.rate = rate
+        self.capacity = max(1, rate)
+        self.__tokens = self.capacity
+        self.__last = time.monotonic()
+        self.__lock = threading.Lock()
+        self.suppressed = 0
+
+    def allow(self):
+        '''
+        Returns the number of events suppressed since the last one allowed,
+        or None if this one is suppressed too.
+        '''
+        with self.__lock:
+            now = time.monotonic()
+            self.__tokens = min(self.capacity, self.__tokens + (now - self.__last) * self.rate)
+            self.__last = now
+            if self.__tokens < 1:
+                self.suppressed += 1
+                return None
+            self.__tokens -= 1
+            suppressed, self.suppressed = self.suppressed, 0
+            return suppressed
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+def log_if_slow(target, timings):
+    '''
+    Logs a structured entry for a probe that took longer than slow_threshold,
+    subject to slow_log_rate.
+    '''
+    global _limiter
+
+    total = time.monotonic() - timings.start
+    if not slow_threshold or total < slow_threshold:
+        return
+
+    with _limiter_lock:
+        if _limiter is None or _limiter.rate != slow_log_rate:
+            _limiter = RateLimiter(slow_log_rate)
+    suppressed = _limiter.allow()
+    if suppressed is None:
+        return
+
+    entry = {'target': target, 'total': round(total, 4)}
+    entry.update((name, round(t, 4)) for name, t in timings.phases)
+    entry['upstream_bytes'] = timings.upstream_bytes
+    entry['suppressed'] = suppressed
+    logger.warning('Slow probe: %s', json.dumps(entry))
+
+class Histogram:
+    '''
+    Counts observations into cumulative buckets, for export as a Prometheus
+    histogram. prometheus_client is only imported when the histogram is
+    collected.
+    '''
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.__lock = threading.Lock()
+        self.__counts = [0] * (len(self.buckets) + 1)
+        self.__sum = 0.0
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.__lock:
+            self.__counts[i] += 1
+            self.__sum += value
+
+    def family(self, name, documentation):
+        from prometheus_client.core import HistogramMetricFamily
+
+        with self.__lock:
+            counts, sum_ = list(self.__counts), self.__sum
+        buckets = []
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            total += count
+            buckets.append(('+Inf' if bound == float('inf') else repr(float(bound)), total))
+        return HistogramMetricFamily(name, documentation, buckets=buckets, sum_value=sum_)
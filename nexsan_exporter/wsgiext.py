@@ -1,25 +1,254 @@
-import concurrent.futures
+import collections
 import http
+import io
+import itertools
+import logging
+import os
+import selectors
 import socket
-import sys
+import threading
+import time
+import urllib.parse
 import wsgiref.simple_server
 
+logger = logging.getLogger(__name__)
+
+# Used for a Lane when no maximum number of threads is given.
+DEFAULT_MAX_THREADS = 32
+
+class Lane:
+    '''
+    An elastic pool of threads that handles one class of requests.
+
+    The lane starts with min_threads threads. When a request arrives and no
+    thread is idle, another is started, up to max_threads; beyond that, up
+    to max_queue requests wait for a thread (None means no limit), and the
+    rest are rejected. Threads beyond min_threads that have been idle for
+    idle_timeout seconds exit.
+    '''
+    def __init__(self, name, max_threads=None, max_queue=None, min_threads=1, idle_timeout=60.0):
+        if max_threads is None:
+            max_threads = DEFAULT_MAX_THREADS
+        self.name = name
+        self.min_threads = min(min_threads, max_threads)
+        self.max_threads = max_threads
+        self.max_queue = max_queue
+        self.idle_timeout = idle_timeout
+        self.rejected = 0
+        self.grown = 0
+        self.shrunk = 0
+        self.__cond = threading.Condition()
+        self.__tasks = collections.deque()
+        self.__threads = set()
+        self.__idle = 0
+        self.__shutdown = False
+        self.__serial = itertools.count()
+        with self.__cond:
+            for i in range(self.min_threads):
+                self.__start_thread()
+
+    @property
+    def threads(self):
+        return len(self.__threads)
+
+    @property
+    def busy(self):
+        return len(self.__threads) - self.__idle
+
+    @property
+    def queued(self):
+        '''
+        The number of requests waiting for a thread.
+        '''
+        return len(self.__tasks)
+
+    def submit(self, fn, *args):
+        '''
+        Queues fn(*args) to run on one of the lane's threads. Returns False,
+        without queueing it, if the queue is full.
+        '''
+        with self.__cond:
+            waiting = len(self.__tasks) - self.__idle
+            if waiting >= 0 and len(self.__threads) < self.max_threads:
+                self.__start_thread()
+                self.grown += 1
+            elif self.max_queue is not None and waiting >= self.max_queue:
+                self.rejected += 1
+                return False
+            self.__tasks.append((fn, args))
+            self.__cond.notify()
+        return True
+
+    def __start_thread(self):
+        t = threading.Thread(target=self.__work, name='{} {}'.format(self.name, next(self.__serial)), daemon=True)
+        self.__threads.add(t)
+        # Counted as idle from now, so that requests submitted before it
+        # starts waiting do not start more threads.
+        self.__idle += 1
+        t.start()
+
+    def __work(self):
+        me = threading.current_thread()
+        while True:
+            with self.__cond:
+                deadline = time.monotonic() + self.idle_timeout
+                while not self.__tasks and not self.__shutdown:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        if len(self.__threads) > self.min_threads:
+                            break
+                        deadline = time.monotonic() + self.idle_timeout
+                        remaining = self.idle_timeout
+                    self.__cond.wait(remaining)
+                self.__idle -= 1
+                if not self.__tasks:
+                    self.__threads.discard(me)
+                    if not self.__shutdown:
+                        self.shrunk += 1
+                    return
+                fn, args = self.__tasks.popleft()
+
+            try:
+                fn(*args)
+            except Exception:
+                logger.exception('Unhandled error in %s lane', self.name)
+
+            with self.__cond:
+                self.__idle += 1
+
+    def shutdown(self):
+        '''
+        Stops the lane's threads once the requests already queued have been
+        handled, and waits for them.
+        '''
+        with self.__cond:
+            self.__shutdown = True
+            self.__cond.notify_all()
+            threads = list(self.__threads)
+        for t in threads:
+            t.join()
+
 class ThreadPoolServer(wsgiref.simple_server.WSGIServer):
-    def __pre_init(self, max_threads):
+    '''
+    Hands each connection to a Lane, chosen by the path of its request.
+
+    A connection whose request has not arrived when it is accepted is passed
+    to a dispatcher thread, which waits for it, so that the accept loop never
+    blocks.
+    '''
+    # How long to wait for a new connection's request line, in order to pick
+    # its lane; connections that have not sent it by then go to the default
+    # lane.
+    PEEK_TIMEOUT = 0.1
+    PEEK_BYTES = 1024
+
+    REJECT_RESPONSE = b'HTTP/1.0 503 Service Unavailable\r\nContent-Type: text/plain\r\nConnection: close\r\n\r\nToo many requests queued\r\n'
+
+    def __pre_init(self, lanes, classify):
         '''
         This must be called, by a deriving class, before __init__ is called.
 
         This is because the thread pool has to be set up before requests are
         processed, and because overriding __init__ is problematic while also
         changing its signature, *and* coöperating with IPv64Server.
+
+        lanes is a list of Lanes; the first is the default. classify is
+        called with the path of each request (or None if it could not be
+        read) and returns the name of the lane that should handle it.
         '''
-        if sys.version_info.major <= 3 and sys.version_info.minor < 5:
-            if max_threads is None:
-                max_threads = 4
-        self.__ex = concurrent.futures.ThreadPoolExecutor(max_threads)
+        self.lanes = {lane.name: lane for lane in lanes}
+        self.__default_lane = lanes[0]
+        self.__classify = classify
+        self.__lock = threading.Lock()
+        # Connections waiting for their request line, with their client
+        # addresses and the time to give up waiting; and those waiting to be
+        # registered with the selector.
+        self.__waiting = {}
+        self.__new = []
+        self.__closing = False
+        self.__selector = selectors.DefaultSelector()
+        self.__wake_r, self.__wake_w = socket.socketpair()
+        self.__selector.register(self.__wake_r, selectors.EVENT_READ)
+        self.__dispatcher = threading.Thread(target=self.__dispatch_waiting, name='dispatcher', daemon=True)
+        self.__dispatcher.start()
 
     def process_request(self, request, client_address):
-        self.__ex.submit(self.__process_request_thread, request, client_address)
+        data = self.__peek(request)
+        if data is None:
+            with self.__lock:
+                self.__new.append((request, client_address, time.monotonic() + self.PEEK_TIMEOUT))
+            self.__wake_w.send(b'\0')
+        else:
+            self.__dispatch(request, client_address, data)
+
+    def __peek(self, request):
+        '''
+        Returns what has arrived of the request, without consuming it or
+        waiting; or None if nothing has. b'' means the client has closed the
+        connection, or it failed.
+        '''
+        try:
+            return request.recv(self.PEEK_BYTES, socket.MSG_PEEK | socket.MSG_DONTWAIT)
+        except BlockingIOError:
+            return None
+        except OSError:
+            return b''
+
+    def __dispatch(self, request, client_address, data):
+        '''
+        Submits the connection to the lane for the path in data, the start
+        of its request.
+        '''
+        lane = self.lanes.get(self.__classify(self.__path(data)), self.__default_lane)
+        if not lane.submit(self.__process_request_thread, request, client_address):
+            try:
+                request.sendall(self.REJECT_RESPONSE)
+            except OSError:
+                pass
+            self.shutdown_request(request)
+
+    def __path(self, data):
+        '''
+        Returns the path from the request line at the start of data, or None
+        if it is not there.
+        '''
+        words = data.split(b'\r\n', 1)[0].split()
+        if len(words) < 2:
+            return None
+        return urllib.parse.urlsplit(words[1].decode('iso-8859-1')).path
+
+    def __dispatch_waiting(self):
+        '''
+        Dispatches each connection passed by process_request once some of
+        its request has arrived, or after PEEK_TIMEOUT.
+        '''
+        while True:
+            with self.__lock:
+                if self.__closing:
+                    break
+                new, self.__new = self.__new, []
+            for request, client_address, deadline in new:
+                self.__waiting[request] = client_address, deadline
+                self.__selector.register(request, selectors.EVENT_READ)
+
+            now = time.monotonic()
+            timeout = min((deadline for _, deadline in self.__waiting.values()), default=now + 3600) - now
+            ready = []
+            for key, _ in self.__selector.select(max(0, timeout)):
+                if key.fileobj is self.__wake_r:
+                    self.__wake_r.recv(4096)
+                    continue
+                ready.append(key.fileobj)
+
+            now = time.monotonic()
+            for request, (_, deadline) in list(self.__waiting.items()):
+                if request in ready or deadline <= now:
+                    self.__selector.unregister(request)
+                    client_address, _ = self.__waiting.pop(request)
+                    self.__dispatch(request, client_address, self.__peek(request) or b'')
+
+        for request in list(self.__waiting) + [r for r, _, _ in self.__new]:
+            self.shutdown_request(request)
 
     def __process_request_thread(self, request, client_address):
         '''
@@ -33,8 +262,16 @@ class ThreadPoolServer(wsgiref.simple_server.WSGIServer):
             self.shutdown_request(request)
 
     def server_close(self):
+        with self.__lock:
+            self.__closing = True
+        self.__wake_w.send(b'\0')
+        self.__dispatcher.join()
         super().server_close()
-        self.__ex.shutdown()
+        self.__selector.close()
+        self.__wake_r.close()
+        self.__wake_w.close()
+        for lane in self.lanes.values():
+            lane.shutdown()
 
 class InstantShutdownServer(wsgiref.simple_server.WSGIServer):
     '''
@@ -43,17 +280,20 @@ class InstantShutdownServer(wsgiref.simple_server.WSGIServer):
     for the poll_interval.
     '''
     def shutdown(self):
-        with socket.socket(self.socket.family) as s:
-            s.setblocking(0)
-            try:
-                s.connect(self.socket.getsockname())
-            except BlockingIOError:
-                pass
-            # Now the thread running serve_forever is waiting for the client
-            # to send a request...
-            super().shutdown()
-        # Now our socket is closed, the thread running serve_forever will check
-        # __shutdown_request and return.
+        # The flag is set by the base class's shutdown, which then waits for
+        # serve_forever to return; so it is called on another thread, while
+        # this one connects until a connection wakes serve_forever after the
+        # flag has been set.
+        stopping = threading.Thread(target=super().shutdown)
+        stopping.start()
+        while stopping.is_alive():
+            with socket.socket(self.socket.family) as s:
+                s.setblocking(0)
+                try:
+                    s.connect(self.socket.getsockname())
+                except BlockingIOError:
+                    pass
+                stopping.join(0.01)
 
 class IPv64Server(wsgiref.simple_server.WSGIServer):
     def __pre_init(self, server_address, bind_v6only):
@@ -72,7 +312,344 @@ class IPv64Server(wsgiref.simple_server.WSGIServer):
             self.socket.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, self.__bind_v6only)
         super().server_bind()
 
-class SilentRequestHandler(wsgiref.simple_server.WSGIRequestHandler):
+class InheritedSocketServer(wsgiref.simple_server.WSGIServer):
+    def __pre_init(self, sock):
+        '''
+        This must be called, by a deriving class, before __init__ is called.
+
+        If sock is not None, it is an already-listening socket (for instance,
+        one passed by systemd) that is used instead of binding a new one.
+        '''
+        self.__inherited = sock
+        if sock is not None:
+            self.address_family = sock.family
+
+    def server_bind(self):
+        if self.__inherited is None:
+            super().server_bind()
+            return
+        self.socket.close()
+        self.socket = self.__inherited
+        # The rest of what HTTPServer.server_bind and WSGIServer.server_bind
+        # do.
+        self.server_address = self.socket.getsockname()
+        host, port = self.server_address[:2]
+        self.server_name = socket.getfqdn(host)
+        self.server_port = port
+        self.setup_environ()
+
+    def server_activate(self):
+        if self.__inherited is None:
+            super().server_activate()
+
+class KeepAliveServer(wsgiref.simple_server.WSGIServer):
+    '''
+    Keeps HTTP/1.1 connections open between requests, for use with
+    KeepAliveRequestHandler.
+
+    A connection waiting for its next request does not hold a request thread:
+    it is watched by a single thread, and passed to process_request again
+    when the request arrives. Connections that are idle for idle_timeout
+    seconds, or that have served max_requests requests, are closed.
+    '''
+    def __pre_init(self, idle_timeout, max_requests):
+        '''
+        This must be called, by a deriving class, before __init__ is called.
+        '''
+        self.keepalive_timeout = idle_timeout
+        self.keepalive_max_requests = max_requests
+        self.__lock = threading.Lock()
+        # Number of requests served, by connection.
+        self.__served = {}
+        # Connections to be parked rather than closed once their handler
+        # returns, with their client addresses.
+        self.__keep = {}
+        # Idle connections, with their client addresses and the time they
+        # should be closed; and those waiting to be registered with the
+        # selector.
+        self.__parked = {}
+        self.__new = []
+        self.__closing = False
+        self.__selector = selectors.DefaultSelector()
+        self.__wake_r, self.__wake_w = socket.socketpair()
+        self.__selector.register(self.__wake_r, selectors.EVENT_READ)
+        self.__watcher = threading.Thread(target=self.__watch, name='keep-alive', daemon=True)
+        self.__watcher.start()
+
+    def request_served(self, request):
+        '''
+        Called by the handler before sending each response. Returns whether
+        the connection may be kept open for another request.
+        '''
+        with self.__lock:
+            served = self.__served[request] = self.__served.get(request, 0) + 1
+        if not self.keepalive_timeout:
+            return False
+        return not self.keepalive_max_requests or served < self.keepalive_max_requests
+
+    def keep(self, request, client_address):
+        '''
+        Called by the handler to have the connection parked, rather than
+        closed, once it returns.
+        '''
+        with self.__lock:
+            self.__keep[request] = client_address
+
+    def shutdown_request(self, request):
+        with self.__lock:
+            client_address = self.__keep.pop(request, None)
+            if client_address is not None and not self.__closing:
+                self.__new.append((request, client_address, time.monotonic() + self.keepalive_timeout))
+                park = True
+            else:
+                self.__served.pop(request, None)
+                park = False
+        if park:
+            self.__wake_w.send(b'\0')
+        else:
+            super().shutdown_request(request)
+
+    def __watch(self):
+        while True:
+            with self.__lock:
+                if self.__closing:
+                    break
+                new, self.__new = self.__new, []
+            for request, client_address, deadline in new:
+                self.__parked[request] = client_address, deadline
+                self.__selector.register(request, selectors.EVENT_READ)
+
+            now = time.monotonic()
+            timeout = min((deadline for _, deadline in self.__parked.values()), default=now + 3600) - now
+            for key, _ in self.__selector.select(max(0, timeout)):
+                if key.fileobj is self.__wake_r:
+                    self.__wake_r.recv(4096)
+                    continue
+                request = key.fileobj
+                self.__selector.unregister(request)
+                client_address, _ = self.__parked.pop(request)
+                try:
+                    more = request.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT)
+                except OSError:
+                    more = b''
+                if more:
+                    self.process_request(request, client_address)
+                else:
+                    # The client closed the connection.
+                    self.shutdown_request(request)
+
+            now = time.monotonic()
+            for request, (_, deadline) in list(self.__parked.items()):
+                if deadline <= now:
+                    self.__selector.unregister(request)
+                    del self.__parked[request]
+                    self.shutdown_request(request)
+
+        for request in list(self.__parked) + [r for r, _, _ in self.__new]:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        with self.__lock:
+            self.__closing = True
+        self.__wake_w.send(b'\0')
+        self.__watcher.join()
+        super().server_close()
+        self.__selector.close()
+        self.__wake_r.close()
+        self.__wake_w.close()
+
+SD_LISTEN_FDS_START = 3
+
+def listen_fds():
+    '''
+    Returns the sockets passed by systemd socket activation (see
+    sd_listen_fds(3)), or an empty list if the process was not passed any.
+
+    The environment variables are removed, so that child processes do not
+    mistake the sockets for their own.
+    '''
+    try:
+        if int(os.environ['LISTEN_PID']) != os.getpid():
+            return []
+        count = int(os.environ['LISTEN_FDS'])
+    except (KeyError, ValueError):
+        return []
+    finally:
+        for name in ['LISTEN_PID', 'LISTEN_FDS', 'LISTEN_FDNAMES']:
+            os.environ.pop(name, None)
+
+    result = []
+    for fd in range(SD_LISTEN_FDS_START, SD_LISTEN_FDS_START + count):
+        os.set_inheritable(fd, False)
+        # Before Python 3.7, socket.socket does not find out the family and
+        # type of the fd it is given.
+        s = socket.socket(fileno=fd)
+        family = socket_family(s)
+        type_ = s.getsockopt(socket.SOL_SOCKET, socket.SO_TYPE)
+        s.detach()
+        result.append(socket.socket(family, type_, fileno=fd))
+    return result
+
+def socket_family(s):
+    '''
+    Returns the address family of s, whatever s.family says.
+    '''
+    so_domain = getattr(socket, 'SO_DOMAIN', None)
+    if so_domain is not None:
+        return s.getsockopt(socket.SOL_SOCKET, so_domain)
+    # Before Python 3.6, the family is told by the shape of the address.
+    address = s.getsockname()
+    if isinstance(address, (str, bytes)):
+        return socket.AF_UNIX
+    return socket.AF_INET6 if len(address) == 4 else socket.AF_INET
+
+class KeepAliveServerHandler(wsgiref.simple_server.ServerHandler):
+    '''
+    Sends HTTP/1.1 responses. If the connection is to be kept open, a
+    response whose length is not known in advance is sent with chunked
+    encoding; otherwise the connection is closed after it.
+
+    The body of a response to a HEAD request is dropped (wsgiref would send
+    it), so that the next request on the connection is not mistaken for it.
+    '''
+    http_version = '1.1'
+    chunked = False
+    complete = False
+    head = False
+
+    def cleanup_headers(self):
+        super().cleanup_headers()
+        request_handler = self.request_handler
+        self.head = self.environ['REQUEST_METHOD'] == 'HEAD'
+        if request_handler.keep_alive and 'Content-Length' not in self.headers:
+            # Without a length, the client would not know the headers of a
+            # HEAD response were for a body it was not sent.
+            if not self.head and self.status[:3] not in ('204', '304'):
+                self.headers['Transfer-Encoding'] = 'chunked'
+                self.chunked = True
+            else:
+                request_handler.keep_alive = False
+        if not request_handler.keep_alive:
+            self.headers['Connection'] = 'close'
+
+    def write(self, data):
+        if not self.status:
+            raise AssertionError('write() before start_response()')
+        elif not self.headers_sent:
+            self.bytes_sent = len(data)
+            self.send_headers()
+        else:
+            self.bytes_sent += len(data)
+
+        if self.head:
+            pass
+        elif not self.chunked:
+            self._write(data)
+        elif data:
+            self._write(b'%x\r\n' % len(data))
+            self._write(data)
+            self._write(b'\r\n')
+        self._flush()
+
+    def finish_content(self):
+        super().finish_content()
+        if self.chunked:
+            self._write(b'0\r\n\r\n')
+            self._flush()
+        self.complete = True
+
+    def handle_error(self):
+        self.request_handler.keep_alive = False
+        super().handle_error()
+
+    def sendfile(self):
+        '''
+        Sends a response given as a wsgi.file_wrapper whose file has a
+        descriptor with socket.sendfile, so that the kernel copies it straight
+        from the file to the socket.
+        '''
+        filelike = self.result.filelike
+        try:
+            fileno = filelike.fileno()
+            offset = filelike.tell()
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            return False
+        count = os.fstat(fileno).st_size - offset
+
+        if 'Content-Length' not in self.headers:
+            self.headers['Content-Length'] = str(count)
+        if not self.headers_sent:
+            self.bytes_sent = count
+            self.send_headers()
+        self._flush()
+        if not self.head:
+            self.request_handler.connection.sendfile(filelike, offset, count)
+        self.complete = True
+        return True
+
+class KeepAliveRequestHandler(wsgiref.simple_server.WSGIRequestHandler):
+    '''
+    Handles HTTP/1.1 requests on a connection until there is no more input
+    waiting, then, if the connection can be kept open, leaves it to
+    KeepAliveServer to wait for the next request.
+    '''
+    protocol_version = 'HTTP/1.1'
+
+    def handle(self):
+        self.keep_alive = False
+        self.handle_one_request()
+        while self.keep_alive and self.__buffered():
+            self.handle_one_request()
+        if self.keep_alive:
+            self.server.keep(self.request, self.client_address)
+
+    def handle_one_request(self):
+        '''
+        Like WSGIRequestHandler.handle, but decides whether the connection can
+        be kept open afterwards.
+        '''
+        self.keep_alive = False
+        self.raw_requestline = self.rfile.readline(65537)
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            return
+        if not self.raw_requestline or not self.parse_request():
+            return
+
+        # A request body the application does not read would be taken for
+        # the next request, so connections that send one are not kept.
+        self.keep_alive = (
+            not self.close_connection
+            and self.request_version == 'HTTP/1.1'
+            and self.headers.get('Content-Length', '0') == '0'
+            and 'Transfer-Encoding' not in self.headers
+            and self.server.request_served(self.request)
+        )
+
+        handler = KeepAliveServerHandler(self.rfile, self.wfile, self.get_stderr(), self.get_environ(), multithread=True)
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+        if not handler.complete:
+            self.keep_alive = False
+
+    def __buffered(self):
+        '''
+        Returns whether the client has already sent more input, such as a
+        pipelined request, without waiting for any.
+        '''
+        timeout = self.connection.gettimeout()
+        self.connection.settimeout(0)
+        try:
+            return bool(self.rfile.peek(1))
+        except OSError:
+            return False
+        finally:
+            self.connection.settimeout(timeout)
+
+class SilentRequestHandler(KeepAliveRequestHandler):
     def log_request(self, code, message):
         if hasattr(http, 'HTTPStatus') and isinstance(code, http.HTTPStatus) and code.value < 400:
             return
@@ -80,13 +657,19 @@ class SilentRequestHandler(wsgiref.simple_server.WSGIRequestHandler):
             return
         super().log_request(code, message)
 
-class Server(IPv64Server, InstantShutdownServer, ThreadPoolServer):
+class Server(IPv64Server, InheritedSocketServer, InstantShutdownServer, KeepAliveServer, ThreadPoolServer):
     '''
-    A WSGIServer that works with IPv6, and processes requests concurrently.
+    A WSGIServer that works with IPv6, processes requests concurrently, and
+    keeps connections open between requests.
 
     server_address[0] must be an ipaddress.ip_address, as opposed to the normal string.
+    If sock is given, it is used instead of binding to server_address. See
+    ThreadPoolServer for lanes and classify, and KeepAliveServer for
+    keepalive_timeout and keepalive_max_requests.
     '''
-    def __init__(self, server_address, RequestHandlerClass, max_threads, bind_v6only, bind_and_activate=True):
+    def __init__(self, server_address, RequestHandlerClass, lanes, classify, bind_v6only, bind_and_activate=True, sock=None, keepalive_timeout=0, keepalive_max_requests=0):
         self._IPv64Server__pre_init(server_address[0], bind_v6only)
-        self._ThreadPoolServer__pre_init(max_threads)
+        self._InheritedSocketServer__pre_init(sock)
+        self._KeepAliveServer__pre_init(keepalive_timeout, keepalive_max_requests)
+        self._ThreadPoolServer__pre_init(lanes, classify)
         super().__init__((str(server_address[0]), server_address[1]), RequestHandlerClass, bind_and_activate)
@@ -41,6 +41,9 @@ setup(
         'prometheus_client',
         'setuptools',
     ],
+    extras_require = {
+        'lxml': ['lxml'],
+    },
     setup_requires = [
         'pytest-runner',
     ],
@@ -0,0 +1,47 @@
+import os
+
+import pytest
+
+from nexsan_exporter import capture, nexsan
+
+@pytest.fixture
+def opstats_bytes(request):
+    test_dir = os.path.join(os.path.dirname(request.module.__file__), 'test_nexsan')
+    with open(os.path.join(test_dir, 'opstats2.xml'), 'rb') as f:
+        return f.read()
+
+@pytest.fixture
+def capture_dir(monkeypatch, tmp_path):
+    monkeypatch.setattr(capture, 'record_directory', str(tmp_path))
+    monkeypatch.setattr(capture, 'replay_directory', str(tmp_path))
+    monkeypatch.setattr(capture, '_replay_positions', {})
+    return tmp_path
+
+def flush():
+    capture._writer.submit(lambda: None).result()
+
+def test_record_replay(capture_dir):
+    capture.record('192.0.2.1,192.0.2.2', b'<a/>', 2)
+    capture.record('192.0.2.1,192.0.2.2', b'<b/>', 1)
+    flush()
+    assert [] == [n for n in os.listdir(str(capture_dir / '192.0.2.1%2C192.0.2.2')) if not n.endswith(capture.SUFFIX)]
+    assert b'<b/>' == capture.replay('192.0.2.1,192.0.2.2')
+    assert b'<a/>' == capture.replay('192.0.2.1,192.0.2.2')
+    assert b'<b/>' == capture.replay('192.0.2.1,192.0.2.2')
+
+def test_replay_probe(capture_dir, opstats_bytes):
+    capture.record('192.0.2.1', opstats_bytes)
+    flush()
+    mf = [mf for mf in nexsan.probe('192.0.2.1', 'u', 'p').collect() if mf.name == 'nexsan_sys_date'][0]
+    assert [('nexsan_sys_date', {}, 1345651206)] == mf.samples
+
+def test_record_failure_logged(capture_dir, caplog):
+    (capture_dir / 'x').write_bytes(b'')
+    capture.record('x', b'<a/>')
+    flush()
+    assert 'Could not save capture of x' in caplog.text
+
+def test_replay_missing(capture_dir):
+    os.mkdir(str(capture_dir / 'empty'))
+    with pytest.raises(FileNotFoundError):
+        capture.replay('empty')
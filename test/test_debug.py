@@ -0,0 +1,46 @@
+import threading
+
+from nexsan_exporter import debug, exporter
+
+def request(monkeypatch, path, query=''):
+    monkeypatch.setattr(debug, 'enabled', True)
+    environ = {'PATH_INFO': path, 'QUERY_STRING': query, 'SCRIPT_NAME': ''}
+    status = []
+    body = b''.join(exporter.wsgi_app(environ, lambda s, h: status.append(s)))
+    return status[0], body.decode()
+
+def test_disabled():
+    environ = {'PATH_INFO': '/debug/threads', 'QUERY_STRING': '', 'SCRIPT_NAME': ''}
+    status = []
+    exporter.wsgi_app(environ, lambda s, h: status.append(s))
+    assert '404 Not Found' == status[0]
+
+def test_threads(monkeypatch):
+    status, body = request(monkeypatch, '/debug/threads')
+    assert '200 OK' == status
+    assert 'MainThread' in body
+
+def test_profile(monkeypatch):
+    stop = threading.Event()
+    def busy_loop():
+        while not stop.is_set():
+            sum(range(1000))
+    t = threading.Thread(target=busy_loop, name='busy')
+    t.start()
+    try:
+        status, body = request(monkeypatch, '/debug/profile', 'seconds=0.1')
+    finally:
+        stop.set()
+        t.join()
+    assert '200 OK' == status
+    assert 'busy;' in body
+    assert 'busy_loop' in body
+
+def test_tracemalloc(monkeypatch):
+    try:
+        _, body = request(monkeypatch, '/debug/tracemalloc')
+        assert body.startswith('Started')
+        _, body = request(monkeypatch, '/debug/tracemalloc')
+        assert body.startswith('Traced memory')
+    finally:
+        request(monkeypatch, '/debug/tracemalloc', 'stop=1')
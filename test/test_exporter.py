@@ -0,0 +1,106 @@
+import os
+import wsgiref.util
+from xml.etree import ElementTree as ET
+
+import prometheus_client
+import prometheus_client.core
+import pytest
+
+from nexsan_exporter import exporter, nexsan
+
+@pytest.fixture
+def opstats(request):
+    test_dir = os.path.join(os.path.dirname(request.module.__file__), 'test_nexsan')
+    with open(os.path.join(test_dir, 'opstats2.xml'), 'rb') as f:
+        return f.read()
+
+@pytest.fixture
+def fake_probe(monkeypatch, opstats):
+    def probe(target, user, pass_, timings=None):
+        if target == 'dead':
+            raise OSError('dead')
+        return nexsan.Collector(ET.fromstring(opstats))
+    monkeypatch.setattr(nexsan, 'probe', probe)
+
+def request(path, query):
+    environ = {'PATH_INFO': path, 'QUERY_STRING': query}
+    wsgiref.util.setup_testing_defaults(environ)
+    status = []
+    body = exporter.wsgi_app(environ, lambda s, h: status.append(s))
+    return status[0], b''.join(body).decode()
+
+def test_probe_many(fake_probe):
+    status, body = request('/probe_many', 'target=a&target=b&target=dead&user=u&pass=p')
+    assert '200 OK' == status
+    assert 1 == body.count('# TYPE nexsan_sys_date counter\n')
+    assert 'nexsan_sys_date{probe_target="a"} 1345651206.0\n' in body
+    assert 'nexsan_sys_date{probe_target="b"} 1345651206.0\n' in body
+    assert 'nexsan_probe_success{probe_target="a"} 1.0\n' in body
+    assert 'nexsan_probe_success{probe_target="dead"} 0.0\n' in body
+    assert 'nexsan_fleet_unhealthy_components{class="env_psu_temp"} 2.0\n' in body
+
+    # Each family's samples are together, after its HELP and TYPE lines.
+    names = []
+    for line in body.splitlines():
+        name = line.split()[2] if line.startswith('# ') else line.split('{')[0].split(' ')[0]
+        if not names or names[-1] != name:
+            names.append(name)
+    assert len(set(names)) == len(names)
+
+def test_render_family_no_header():
+    mf = prometheus_client.core.GaugeMetricFamily('x', 'doc', labels=['l'])
+    mf.add_metric(['v'], 1)
+    assert b'x{l="v"} 1.0\n' == exporter.render_family(mf, False)
+
+def test_probe_streams_families(fake_probe, opstats):
+    environ = {'PATH_INFO': '/probe', 'QUERY_STRING': 'target=a&user=u&pass=p'}
+    wsgiref.util.setup_testing_defaults(environ)
+    chunks = list(exporter.wsgi_app(environ, lambda s, h: None))
+    assert 1 < len(chunks)
+    assert all(c.startswith(b'# HELP ') for c in chunks)
+
+def test_probe_server_timing(fake_probe):
+    environ = {'PATH_INFO': '/probe', 'QUERY_STRING': 'target=a&user=u&pass=p'}
+    wsgiref.util.setup_testing_defaults(environ)
+    headers = []
+    list(exporter.wsgi_app(environ, lambda s, h: headers.extend(h)))
+    server_timing = dict(headers)['Server-Timing']
+    assert ['collect'] == [p.split(';')[0] for p in server_timing.split(', ')]
+
+def test_probe_slow_log(monkeypatch, fake_probe, caplog):
+    monkeypatch.setattr(exporter.timing, 'slow_threshold', 1e-9)
+    monkeypatch.setattr(exporter.timing, 'slow_log_rate', 1)
+    monkeypatch.setattr(exporter.timing, '_limiter', None)
+    environ = {'PATH_INFO': '/probe', 'QUERY_STRING': 'target=a&user=u&pass=p'}
+    wsgiref.util.setup_testing_defaults(environ)
+    for i in range(3):
+        list(exporter.wsgi_app(dict(environ), lambda s, h: None))
+    entries = [r.getMessage() for r in caplog.records if r.getMessage().startswith('Slow probe')]
+    assert 1 == len(entries)
+    assert '"render"' in entries[0]
+
+def test_metrics_self():
+    environ = {'PATH_INFO': '/metrics'}
+    wsgiref.util.setup_testing_defaults(environ)
+    body = b''.join(exporter.wsgi_app(environ, lambda s, h: None))
+    assert b'nexsan_fetch_queue_wait_seconds_bucket{le="+Inf"}' in body
+
+def test_probe_cached_exposition(monkeypatch, opstats):
+    cache = nexsan.SectionCache()
+    monkeypatch.setattr(nexsan, 'probe', lambda target, user, pass_, timings=None: cache.collector(opstats, None))
+    monkeypatch.setattr(exporter, '_expositions', {})
+    environ = {'PATH_INFO': '/probe', 'QUERY_STRING': 'target=cached&user=u&pass=p'}
+
+    bodies = []
+    for i in range(3):
+        e = dict(environ)
+        wsgiref.util.setup_testing_defaults(e)
+        headers = []
+        result = exporter.wsgi_app(e, lambda s, h: headers.extend(h))
+        bodies.append(b''.join(result))
+        if i == 0:
+            assert 'Content-Length' not in dict(headers)
+        else:
+            assert isinstance(result, wsgiref.util.FileWrapper)
+            assert str(len(bodies[0])) == dict(headers)['Content-Length']
+    assert bodies[0] == bodies[1] == bodies[2]
@@ -0,0 +1,80 @@
+import os
+
+import pytest
+
+from nexsan_exporter import exporter, governor, history, memfile, nexsan, snapshots, targets
+
+@pytest.fixture
+def opstats(request):
+    test_dir = os.path.join(os.path.dirname(request.module.__file__), 'test_nexsan')
+    with open(os.path.join(test_dir, 'opstats2.xml'), 'rb') as f:
+        return f.read()
+
+@pytest.fixture
+def state(monkeypatch, opstats):
+    monkeypatch.setattr(nexsan, '_section_caches', {})
+    monkeypatch.setattr(targets, '_targets', {})
+    monkeypatch.setattr(history, '_histories', {})
+    monkeypatch.setattr(history, 'budget', 4096)
+    monkeypatch.setattr(snapshots, '_stale', {})
+    monkeypatch.setattr(exporter, '_expositions', {})
+    monkeypatch.setattr(governor, '_scraped', {})
+    monkeypatch.setattr(governor, '_usage', {})
+    monkeypatch.setattr(governor, '_measured', None)
+    monkeypatch.setattr(governor, 'evictions', 0)
+    monkeypatch.setattr(nexsan, 'fetch', lambda address, user, pass_: opstats)
+
+def test_measure(state):
+    exporter.collect_document('a', 'u', 'p')
+    exporter.forget('a')
+    sizes = governor.measure()
+    assert {'sections', 'targets', 'history'} == set(sizes['a'])
+    assert 4096 < sizes['a']['history']
+    assert all(0 < size for size in sizes['a'].values())
+
+def test_shared_objects_counted_once(state):
+    exporter.collect_document('a', 'u', 'p')
+    seen = set()
+    sections = governor.sizeof([nexsan.retained()['a']], seen)
+    labels = governor.sizeof([targets.retained()['a']], seen)
+    assert labels < governor.sizeof([targets.retained()['a']], set())
+    assert sections + labels == governor.sizeof([nexsan.retained()['a'], targets.retained()['a']], set())
+
+def test_busy_document_counted(state, monkeypatch, opstats):
+    monkeypatch.setattr(targets, 'busy_cpu_percent', 80)
+    exporter.collect_document('a', 'u', 'p')
+    assert len(opstats) < governor.measure()['a']['targets']
+
+    t = targets.get('a')
+    governor.forget('a')
+    assert 'a' not in targets.retained()
+    assert t is not targets.get('a')
+
+def test_memfile_size():
+    assert 10000 < governor.sizeof([memfile.MemoryFile(b'x' * 10000)], set())
+
+def test_evicts_least_recently_scraped(state, monkeypatch):
+    for target in ['a', 'b', 'c']:
+        exporter.collect_document(target, 'u', 'p')
+    exporter.collect_document('a', 'u', 'p')
+    sizes = governor.measure()
+    monkeypatch.setattr(governor, 'budget', sum(sizes['a'].values()) + sum(sizes['c'].values()) + 1)
+    governor.check()
+    assert {'a', 'c'} == set(nexsan.retained())
+    assert {'a', 'c'} == set(history.retained())
+    assert {'a', 'c'} == set(targets.retained())
+    assert 1 == governor.evictions
+
+    # The evicted target starts afresh.
+    exporter.collect_document('b', 'u', 'p')
+    assert 'b' in nexsan.retained()
+
+def test_collect(state):
+    exporter.collect_document('a', 'u', 'p')
+    families = {mf.name: mf for mf in governor.collect()}
+    usage = {s[1]['state']: s[2] for s in families['nexsan_state_bytes'].samples}
+    assert {'sections', 'targets', 'snapshots', 'history', 'rates', 'expositions'} == set(usage)
+    assert 0 < usage['sections']
+    assert 0 == usage['snapshots']
+    assert 'nexsan_state_budget_bytes' not in families
+    assert 0 == families['nexsan_state_evictions_total'].samples[0][2]
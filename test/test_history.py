@@ -0,0 +1,55 @@
+import json
+from xml.etree import ElementTree as ET
+
+from nexsan_exporter import exporter, history, nexsan
+
+def samples(temp):
+    doc = ET.fromstring('''
+      <nexsan_op_status version="2" status="experimental">
+        <nexsan_env_status version="3" status="experimental">
+          <enclosure id="1">
+            <psu id="2">
+              <state good="yes" power_watt="546">OK</state>
+              <temperature_deg_c good="yes">{}</temperature_deg_c>
+            </psu>
+          </enclosure>
+        </nexsan_env_status>
+      </nexsan_op_status>
+    '''.format(temp))
+    return nexsan.Collector(doc).extract()
+
+def test_record_query():
+    h = history.History(1024)
+    h.record(samples(40), 1)
+    h.record(samples(41), 2)
+    assert [{
+        'name': 'nexsan_env_psu_temp_celsius',
+        'labels': {'psu': '2', 'enclosure': '1'},
+        'samples': [(1, 40), (2, 41)],
+    }] == h.query({'nexsan_env_psu_temp_celsius'})
+
+def test_budget():
+    h = history.History(1024)
+    for i in range(100):
+        h.record(samples(i), i)
+    assert h.nbytes <= 1024
+    values = h.query({'nexsan_env_psu_temp_celsius'})[0]['samples']
+    assert (99, 99) == values[-1]
+    assert 1 < len(values) < 100
+
+def test_new_series_aligned():
+    h = history.History(4096)
+    h.record(samples(40), 1)
+    s = samples(41)
+    s['nexsan_env_psu_temp_celsius'].add(('3', '1'), 50)
+    h.record(s, 2)
+    result = {r['labels']['psu']: r['samples'] for r in h.query({'nexsan_env_psu_temp_celsius'})}
+    assert [(1, 40), (2, 41)] == result['2']
+    assert [(2, 50)] == result['3']
+
+def test_history_endpoint(monkeypatch):
+    monkeypatch.setattr(history, '_histories', {})
+    history.get('t').record(samples(40), 1)
+    environ = {'PATH_INFO': '/history', 'QUERY_STRING': 'target=t&series=nexsan_env_psu_temp_celsius', 'REQUEST_METHOD': 'GET'}
+    result = json.loads(b''.join(exporter.wsgi_app(environ, lambda s, h: None)).decode())
+    assert [[1, 40]] == result['series'][0]['samples']
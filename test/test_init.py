@@ -0,0 +1,22 @@
+import argparse
+import subprocess
+import sys
+
+import pytest
+
+import nexsan_exporter
+
+def test_lazy_imports():
+    '''
+    Modules only needed to serve requests are not loaded at startup.
+    '''
+    code = 'import sys, nexsan_exporter; print(" ".join(sorted(sys.modules)))'
+    modules = subprocess.check_output([sys.executable, '-c', code]).decode().split()
+    for m in ['prometheus_client', 'xml.etree.ElementTree', 'urllib.request', 'lxml', 'tracemalloc']:
+        assert m not in modules
+
+def test_percentage():
+    assert 95.0 == nexsan_exporter.percentage('95')
+    for s in ['-1', '100.5']:
+        with pytest.raises(argparse.ArgumentTypeError):
+            nexsan_exporter.percentage(s)
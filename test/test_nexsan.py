@@ -34,6 +34,31 @@ def test_opstats(opstats_xml):
     metrics = list(nexsan.Collector(opstats_xml).collect())
     assert 0 < len(metrics)
 
+def test_generate_latest():
+    '''
+    Tests that collected families render with the installed prometheus_client,
+    with each sample named as its family's TYPE line.
+    '''
+    import prometheus_client
+
+    test_dir, _ = os.path.splitext(__file__)
+    opstats = ET.parse(os.path.join(test_dir, 'opstats2.xml'))
+
+    class Families:
+        def collect(self):
+            return nexsan.Collector(opstats).collect()
+
+    output = prometheus_client.generate_latest(Families()).decode()
+    assert '# TYPE nexsan_perf_read_ios_total counter\n' in output
+    assert 'nexsan_perf_read_ios_total{controller="0",port="SAS - Host1"} 327023.0\n' in output
+    assert '# TYPE nexsan_perf_cpu_usage_percent gauge\n' in output
+    assert '_total_total' not in output
+
+    types = {line.split(' ')[2] for line in output.splitlines() if line.startswith('# TYPE ')}
+    for line in output.splitlines():
+        if not line.startswith('#'):
+            assert line.split('{')[0].split(' ')[0] in types
+
 def getmf(families, name):
     skipped = []
     for f in families:
@@ -946,3 +971,90 @@ def test_nexsan_maid_fewer():
     '''))
     # Just check that the missing elements don't cause an error
     list(c.collect())
+
+def test_absent_sections(nexsan_sys):
+    c = nexsan.Collector(nexsan_sys)
+    assert ['nexsan_sys_details', 'nexsan_sys_date'] == [mf.name for mf in c.collect()]
+
+def test_exposition_order(opstats_xml):
+    names = [mf.name for mf in nexsan.Collector(opstats_xml).collect()]
+    expected = [name for _, families in nexsan.METRICS for name, _, _ in families]
+    assert names == [n for n in expected if n in names]
+
+def test_unknown_version(caplog):
+    doc = '''
+      <nexsan_op_status version="2" status="experimental">
+        <nexsan_sys_details version="99" status="experimental">
+          <friendly_name>nnn</friendly_name>
+          <system_name>sss</system_name>
+          <system_id>iii</system_id>
+          <firmware_version>fff</firmware_version>
+          <date human="Tuesday 17-Apr-2018 11:07">1523963221</date>
+        </nexsan_sys_details>
+      </nexsan_op_status>
+    '''
+    for i in range(2):
+        mf = getmf(nexsan.Collector(ET.fromstring(doc)).collect(), 'nexsan_sys_date')
+        assert [('nexsan_sys_date', {}, 1523963221)] == mf.samples
+    assert 1 == len([r for r in caplog.records if 'nexsan_sys_details' in r.getMessage()])
+
+def test_extractor_versions():
+    assert nexsan.Collector.collect_env_status_v1 is nexsan.extractor('nexsan_env_status', '1')
+    assert nexsan.Collector.collect_env_status_v3 is nexsan.extractor('nexsan_env_status', '3')
+    assert nexsan.Collector.collect_env_status_v3 is nexsan.extractor('nexsan_env_status', '4')
+    assert None is nexsan.extractor('nexsan_unknown_section', '1')
+
+def test_volume_array_rollup(nexsan_volume):
+    c = nexsan.Collector(nexsan_volume)
+    mf = getmf(c.collect(), 'nexsan_volume_array_ios_total')
+    assert 'counter' == mf.type
+    assert [
+        ('nexsan_volume_array_ios_total', {'array': '1'}, 42 + 9445479),
+        ('nexsan_volume_array_ios_total', {'array': '2'}, 271860997 + 79),
+    ] == mf.samples
+
+def test_perf_controller_rollup(nexsan_perf):
+    c = nexsan.Collector(nexsan_perf)
+    mf = getmf(c.collect(), 'nexsan_perf_controller_read_bytes_per_second')
+    assert 'gauge' == mf.type
+    assert [
+        ('nexsan_perf_controller_read_bytes_per_second', {'controller': '2'}, (76 + 77) * 1024 * 1024),
+    ] == mf.samples
+
+def test_unhealthy_components(nexsan_pod):
+    c = nexsan.Collector(nexsan_pod)
+    mf = getmf(c.collect(), 'nexsan_unhealthy_components')
+    assert 'gauge' == mf.type
+    samples = {labels['class']: value for _, labels, value in mf.samples}
+    assert 1 == samples['env_pod_voltage']
+    assert 1 == samples['env_pod_tray_blower']
+    assert 0 == samples['env_psu_power']
+
+@pytest.fixture
+def opstats_body(request):
+    test_dir, _ = os.path.splitext(request.module.__file__)
+    with open(os.path.join(test_dir, 'opstats1.xml'), 'rb') as f:
+        return f.read()
+
+def exposition(families):
+    return [(mf.name, mf.type, mf.samples) for mf in families]
+
+def test_section_cache(monkeypatch, opstats_body):
+    monkeypatch.setattr(nexsan, 'reuse_counts', nexsan.collections.Counter())
+    cache = nexsan.SectionCache()
+    first = list(cache.collector(opstats_body, None).collect())
+    assert exposition(nexsan.Collector(ET.fromstring(opstats_body)).collect()) == exposition(first)
+
+    # An identical document reuses every family.
+    second = list(cache.collector(opstats_body, None).collect())
+    sys_details = getmf(first, 'nexsan_sys_details')
+    assert sys_details is getmf(second, 'nexsan_sys_details')
+    assert 1 == nexsan.reuse_counts['document', 'hit']
+
+    # Only the changed section is collected again.
+    changed = opstats_body.replace(b'>1523963221</date>', b'>1523963281</date>', 1)
+    third = list(cache.collector(changed, None).collect())
+    assert exposition(nexsan.Collector(ET.fromstring(changed)).collect()) == exposition(third)
+    assert 1523963281 == getmf(third, 'nexsan_sys_date').samples[0][2]
+    assert getmf(first, 'nexsan_volume_ios_total') is getmf(third, 'nexsan_volume_ios_total')
+    assert 2 == nexsan.reuse_counts['nexsan_sys_details', 'miss']
@@ -0,0 +1,28 @@
+import os
+
+import pytest
+
+from nexsan_exporter import nexsan, parsers
+
+@pytest.fixture(params=['opstats1.xml', 'opstats2.xml'])
+def opstats_bytes(request):
+    test_dir = os.path.join(os.path.dirname(request.module.__file__), 'test_nexsan')
+    with open(os.path.join(test_dir, request.param), 'rb') as f:
+        return f.read()
+
+@pytest.fixture(params=['etree', 'expat', 'lxml'])
+def engine(request):
+    if request.param not in parsers.ENGINES:
+        pytest.skip('{} is not available'.format(request.param))
+    return parsers.ENGINES[request.param]
+
+def samples(root):
+    return [(mf.name, mf.type, mf.samples) for mf in nexsan.Collector(root).collect()]
+
+def test_conformance(engine, opstats_bytes):
+    '''
+    Every engine must produce the same metrics as ElementTree.
+    '''
+    expected = samples(parsers.parse_etree(opstats_bytes))
+    assert 0 < len(expected)
+    assert expected == samples(engine(opstats_bytes))
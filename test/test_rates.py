@@ -0,0 +1,90 @@
+import math
+import os
+
+import pytest
+
+from nexsan_exporter import exporter, nexsan, rates, targets
+
+@pytest.fixture
+def opstats(request):
+    test_dir = os.path.join(os.path.dirname(request.module.__file__), 'test_nexsan')
+    with open(os.path.join(test_dir, 'opstats2.xml'), 'rb') as f:
+        return f.read()
+
+def samples(values, labels=None):
+    s = nexsan.Samples()
+    for i, v in enumerate(values):
+        s.add((str(i),) if labels is None else labels[i], v)
+    return s
+
+def test_rate():
+    assert [1, 2] == list(rates.rate(samples([10, 20]), samples([20, 40]), 10))
+
+def test_rate_reset():
+    assert [0.5] == list(rates.rate(samples([100]), samples([5]), 10))
+
+def test_rate_reordered_and_new_series():
+    r = rates.rate(samples([10, 20], [('a',), ('b',)]), samples([40, 30, 99], [('b',), ('a',), ('c',)]), 10)
+    assert [2, 2] == list(r[:2])
+    assert math.isnan(r[2])
+
+def document(date, read_ios):
+    return {
+        'nexsan_sys_date': samples([date]),
+        'nexsan_perf_read_ios_total': samples([read_ios], [('0', 'SAS - Host0')]),
+    }
+
+def rate_samples(r):
+    return {mf.name: [(s[1], s[2]) for s in mf.samples] for mf in r.collect(targets.LabelCache())}
+
+def test_exposition():
+    import prometheus_client
+
+    r = rates.Rates()
+    r.update(document(100, 1000))
+    r.update(document(110, 1500))
+    output = prometheus_client.generate_latest(exporter.Families(list(r.collect(targets.LabelCache())))).decode()
+    assert '# TYPE nexsan_perf_read_ios_per_second gauge\n' in output
+    assert 'nexsan_perf_read_ios_per_second{controller="0",port="SAS - Host0"} 50.0\n' in output
+
+def test_update():
+    r = rates.Rates()
+    r.update(document(100, 1000))
+    assert {} == rate_samples(r)
+
+    r.update(document(110, 1500))
+    expected = {'nexsan_perf_read_ios_per_second': [({'controller': '0', 'port': 'SAS - Host0'}, 50)]}
+    assert expected == rate_samples(r)
+
+    # The same document again, as while an array is busy.
+    r.update(document(110, 1500))
+    assert expected == rate_samples(r)
+
+    r.update(document(120, 1500))
+    assert {'nexsan_perf_read_ios_per_second': [({'controller': '0', 'port': 'SAS - Host0'}, 0)]} == rate_samples(r)
+
+def test_update_clock_backwards():
+    r = rates.Rates()
+    r.update(document(100, 1000))
+    r.update(document(110, 1500))
+    r.update(document(50, 2000))
+    assert {} == rate_samples(r)
+    r.update(document(60, 2100))
+    assert [({'controller': '0', 'port': 'SAS - Host0'}, 10)] == rate_samples(r)['nexsan_perf_read_ios_per_second']
+
+def test_probe(monkeypatch, opstats):
+    monkeypatch.setattr(rates, 'enabled', True)
+    monkeypatch.setattr(rates, '_rates', {})
+    monkeypatch.setattr(nexsan, '_section_caches', {})
+    bodies = [opstats, opstats.replace(b'>1345651206</date>', b'>1345651216</date>').replace(b'<read_ios>763406389<', b'<read_ios>763406489<')]
+    monkeypatch.setattr(nexsan, 'fetch', lambda address, user, pass_: bodies.pop(0))
+
+    families = {mf.name: mf for mf in exporter.collect('rates', 'u', 'p')}
+    assert 'nexsan_perf_read_ios_per_second' not in families
+
+    families = {mf.samples[0][0]: mf for mf in exporter.collect('rates', 'u', 'p') if mf.samples}
+    mf = families['nexsan_perf_read_ios_per_second']
+    assert 'gauge' == mf.type
+    assert ('nexsan_perf_read_ios_per_second', {'controller': '0', 'port': 'SAS - Host0'}, 10) == tuple(mf.samples[0][:3])
+    # The label dicts are shared with the counters'.
+    assert mf.samples[0][1] is families['nexsan_perf_read_ios_total'].samples[0][1]
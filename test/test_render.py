@@ -0,0 +1,44 @@
+import os
+
+import pytest
+
+from nexsan_exporter import render
+
+@pytest.fixture
+def opstats_path(request):
+    return os.path.join(os.path.dirname(request.module.__file__), 'test_nexsan', 'opstats2.xml')
+
+def test_render_file(opstats_path):
+    output, timings = render.render_file(opstats_path, 'etree', False)
+    assert b'nexsan_sys_date 1345651206.0\n' in output
+    assert ['read', 'parse', 'collect', 'render'] == [step for step, _ in timings]
+
+def test_render_file_label(opstats_path):
+    output, _ = render.render_file(opstats_path, 'etree', True)
+    assert b'nexsan_sys_date{probe_target="opstats2"} 1345651206.0\n' in output
+
+def test_target_name():
+    assert '192.0.2.1' == render.target_name('/srv/opstats/192.0.2.1.xml')
+    assert '192.0.2.1,192.0.2.2' == render.target_name('/var/lib/x/192.0.2.1%2C192.0.2.2.xml.gz')
+    assert '192.0.2.1' == render.target_name('/srv/record/192.0.2.1/1500000000000.xml.gz')
+    assert 'opstats' == render.target_name('opstats')
+
+def test_output_path():
+    assert os.path.join('out', '192.0.2.1.prom') == render.output_path('out', '/srv/opstats/192.0.2.1.xml')
+    assert os.path.join('out', '192.0.2.1', '1500000000000.prom') == render.output_path('out', '/srv/record/192.0.2.1/1500000000000.xml.gz')
+    for path in ['/srv/record/..%2F..%2Fetc/1.xml.gz', '/var/lib/x/%2E%2E.xml.gz', '/srv/a%2Fb.xml.gz']:
+        with pytest.raises(ValueError):
+            render.output_path('out', path)
+
+def test_strip_duplicate_headers():
+    seen = set()
+    first = b'# HELP a x\n# TYPE a gauge\na 1.0\n'
+    assert first == render.strip_duplicate_headers(first, seen)
+    assert b'a 2.0\n' == render.strip_duplicate_headers(b'# HELP a x\n# TYPE a gauge\na 2.0\n', seen)
+
+def test_write_atomically(tmp_path):
+    path = str(tmp_path / 'x.prom')
+    render.write_atomically(path, b'a 1.0\n')
+    with open(path, 'rb') as f:
+        assert b'a 1.0\n' == f.read()
+    assert ['x.prom'] == os.listdir(str(tmp_path))
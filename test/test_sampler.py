@@ -0,0 +1,77 @@
+import os
+
+import pytest
+
+from nexsan_exporter import capture, nexsan, ring, sampler
+
+def test_ring():
+    r = ring.Ring(3)
+    assert [] == r.values()
+    for x in [1, 2]:
+        r.append(x)
+    assert [1, 2] == r.values()
+    for x in [3, 4]:
+        r.append(x)
+    assert [2, 3, 4] == r.values()
+    assert 3 == len(r)
+
+def test_ring_integers():
+    r = ring.Ring(2, 'q')
+    r.append(2 ** 40)
+    assert [2 ** 40] == r.values()
+
+@pytest.fixture
+def opstats_bytes(request):
+    test_dir = os.path.join(os.path.dirname(request.module.__file__), 'test_nexsan')
+    with open(os.path.join(test_dir, 'opstats1.xml'), 'rb') as f:
+        return f.read()
+
+def getmf(families, name):
+    return [f for f in families if f.name == name][0]
+
+def test_sampler_window(monkeypatch, opstats_bytes):
+    monkeypatch.setattr(sampler, 'interval', 1)
+    monkeypatch.setattr(sampler, 'window', 2)
+    s = sampler.Sampler('192.0.2.1', 'u', 'p')
+    s.sample(opstats_bytes)
+    s.sample(opstats_bytes.replace(b'<read_mbytes_per_sec>76<', b'<read_mbytes_per_sec>176<'))
+    s.sample(opstats_bytes.replace(b'<read_mbytes_per_sec>76<', b'<read_mbytes_per_sec>276<'))
+    families = list(s.collect())
+
+    key = {'controller': '0', 'port': 'Fibre - Host0'}
+    mf = getmf(families, 'nexsan_perf_read_bytes_per_second_max')
+    assert ('nexsan_perf_read_bytes_per_second_max', key, 276 * 1024 * 1024) in mf.samples
+    mf = getmf(families, 'nexsan_perf_read_bytes_per_second_avg')
+    assert ('nexsan_perf_read_bytes_per_second_avg', key, 226 * 1024 * 1024) in mf.samples
+    mf = getmf(families, 'nexsan_perf_samples')
+    assert ('nexsan_perf_samples', key, 2) in mf.samples
+
+def test_sampler_bypasses_capture(monkeypatch, tmp_path, opstats_bytes):
+    monkeypatch.setattr(sampler, 'interval', 1)
+    monkeypatch.setattr(capture, 'record_directory', str(tmp_path))
+    monkeypatch.setattr(nexsan, 'fetch', lambda address, user, pass_: opstats_bytes)
+
+    s = sampler.Sampler('192.0.2.1', 'u', 'p')
+    s.sample(s._Sampler__fetch())
+    capture._writer.submit(lambda: None).result()
+    assert [] == os.listdir(str(tmp_path))
+    mf = getmf(s.collect(), 'nexsan_perf_samples')
+    assert ('nexsan_perf_samples', {'controller': '0', 'port': 'Fibre - Host0'}, 1) in [tuple(sample[:3]) for sample in mf.samples]
+
+def test_touch_other_credentials(monkeypatch):
+    monkeypatch.setattr(sampler, 'interval', 60)
+    monkeypatch.setattr(sampler, '_samplers', {})
+    def fetch(address, user, pass_):
+        raise OSError('no array')
+    monkeypatch.setattr(nexsan, 'fetch', fetch)
+
+    s = sampler.touch('192.0.2.1', 'u', 'p')
+    try:
+        assert s is sampler.touch('192.0.2.1', 'u', 'p')
+        other = sampler.touch('192.0.2.1', 'u', 'wrong')
+        assert s is not other
+        s.join(5)
+        assert not s.is_alive()
+    finally:
+        for t in list(sampler._samplers.values()) + [s]:
+            t.stop()
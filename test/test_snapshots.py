@@ -0,0 +1,170 @@
+import os
+import threading
+import time
+import urllib.error
+
+import pytest
+
+from nexsan_exporter import exporter, nexsan, snapshots
+
+@pytest.fixture
+def opstats(request):
+    test_dir = os.path.join(os.path.dirname(request.module.__file__), 'test_nexsan')
+    with open(os.path.join(test_dir, 'opstats2.xml'), 'rb') as f:
+        return f.read()
+
+@pytest.fixture
+def state_dir(monkeypatch, tmp_path):
+    monkeypatch.setattr(snapshots, 'directory', str(tmp_path))
+    monkeypatch.setattr(snapshots, '_stale', {})
+    monkeypatch.setattr(snapshots, '_digests', {})
+    monkeypatch.setattr(snapshots, '_keys', {})
+    monkeypatch.setattr(nexsan, '_section_caches', {})
+    return tmp_path
+
+def flush():
+    snapshots._writer.submit(lambda: None).result()
+
+def stale_values(collector):
+    return {mf.name: mf.samples[0][2] for mf in snapshots.collect(collector)}
+
+def test_save_load(state_dir, monkeypatch, opstats):
+    monkeypatch.setattr(nexsan, 'fetch', lambda address, user, pass_: opstats)
+    before = time.time()
+    nexsan.probe('192.0.2.1,192.0.2.2', 'u', 'p')
+    flush()
+    assert ['.key', '192.0.2.1%2C192.0.2.2.auth', '192.0.2.1%2C192.0.2.2.xml.gz'] == sorted(os.listdir(str(state_dir)))
+    assert {'nexsan_probe_snapshot_stale': 0} == stale_values(nexsan.Collector([]))
+
+    # As if restarted.
+    monkeypatch.setattr(snapshots, '_digests', {})
+    monkeypatch.setattr(nexsan, '_section_caches', {})
+    snapshots.load()
+    collector = snapshots._stale['192.0.2.1,192.0.2.2'].collector
+    assert before - 1 <= collector.snapshot_time <= time.time()
+    assert [1345651206] == list(collector.extract()['nexsan_sys_date'].values)
+    values = stale_values(collector)
+    assert 1 == values['nexsan_probe_snapshot_stale']
+    assert 0 <= values['nexsan_probe_snapshot_age_seconds'] < 60
+
+def test_load_skips_fetched(state_dir, monkeypatch, opstats):
+    monkeypatch.setattr(nexsan, 'fetch', lambda address, user, pass_: opstats)
+    nexsan.probe('a', 'u', 'p')
+    flush()
+    snapshots.load()
+    assert {} == snapshots._stale
+
+def test_stale_until_fetched(state_dir, monkeypatch, opstats):
+    monkeypatch.setattr(nexsan, 'fetch', lambda address, user, pass_: opstats)
+    nexsan.probe('a', 'u', 'p')
+    flush()
+    monkeypatch.setattr(snapshots, '_digests', {})
+    snapshots.load()
+    stale = snapshots._stale['a']
+
+    answer = threading.Event()
+    def fetch(address, user, pass_):
+        if not answer.wait(5):
+            raise OSError('no answer')
+        return opstats
+    monkeypatch.setattr(nexsan, 'fetch', fetch)
+
+    # Answered at once from the snapshot, while the fetch continues in the
+    # background.
+    assert stale.collector is exporter.collect_document('a', 'u', 'p')
+    assert stale.collector is exporter.collect_document('a', 'u', 'p')
+    refreshing = stale.refreshing
+    answer.set()
+    refreshing.result()
+
+    collector = exporter.collect_document('a', 'u', 'p')
+    assert collector.snapshot_time is None
+    assert {} == snapshots._stale
+
+def test_failed_fetch_drops_stale(state_dir, monkeypatch, opstats):
+    monkeypatch.setattr(nexsan, 'fetch', lambda address, user, pass_: opstats)
+    nexsan.probe('a', 'u', 'p')
+    flush()
+    monkeypatch.setattr(snapshots, '_digests', {})
+    snapshots.load()
+
+    def fetch(address, user, pass_):
+        raise OSError('dead')
+    monkeypatch.setattr(nexsan, 'fetch', fetch)
+    stale = snapshots._stale['a']
+    assert stale.collector is exporter.collect_document('a', 'u', 'p')
+    with pytest.raises(OSError):
+        stale.refreshing.result()
+    assert {} == snapshots._stale
+    with pytest.raises(OSError):
+        exporter.collect_document('a', 'u', 'p')
+
+def unauthorized(address, user, pass_):
+    raise urllib.error.HTTPError('http://{}/'.format(address), 401, 'Unauthorized', {}, None)
+
+def test_other_credentials(state_dir, monkeypatch, opstats):
+    monkeypatch.setattr(nexsan, 'fetch', lambda address, user, pass_: opstats)
+    nexsan.probe('a', 'u', 'p')
+    flush()
+    monkeypatch.setattr(snapshots, '_digests', {})
+    snapshots.load()
+    stale = snapshots._stale['a']
+
+    # Not answered from the snapshot, and the array's refusal of the
+    # credentials does not drop it.
+    monkeypatch.setattr(nexsan, 'fetch', unauthorized)
+    with pytest.raises(urllib.error.HTTPError):
+        exporter.collect_document('a', 'u', 'wrong')
+    assert stale is snapshots._stale['a']
+    assert stale.refreshing is None
+    assert stale.collector is exporter.collect_document('a', 'u', 'p')
+
+def test_other_credentials_other_failure(state_dir, monkeypatch, opstats):
+    monkeypatch.setattr(nexsan, 'fetch', lambda address, user, pass_: opstats)
+    nexsan.probe('a', 'u', 'p')
+    flush()
+    monkeypatch.setattr(snapshots, '_digests', {})
+    snapshots.load()
+
+    def fetch(address, user, pass_):
+        raise OSError('dead')
+    monkeypatch.setattr(nexsan, 'fetch', fetch)
+    with pytest.raises(OSError):
+        exporter.collect_document('a', 'v', 'q')
+    assert {} == snapshots._stale
+
+def test_unknown_credentials(state_dir, monkeypatch, opstats):
+    monkeypatch.setattr(nexsan, 'fetch', lambda address, user, pass_: opstats)
+    nexsan.probe('a', 'u', 'p')
+    flush()
+    os.unlink(snapshots.auth_path('a'))
+    monkeypatch.setattr(snapshots, '_digests', {})
+    snapshots.load()
+    assert snapshots.stale('a', 'u', 'p', lambda: None) is None
+
+def test_expired(state_dir, monkeypatch, opstats):
+    monkeypatch.setattr(snapshots, 'max_age', 60)
+    monkeypatch.setattr(nexsan, 'fetch', lambda address, user, pass_: opstats)
+    for target in ['a', 'b']:
+        nexsan.probe(target, 'u', 'p')
+    flush()
+    os.utime(snapshots.path('a'), (0, 0))
+    monkeypatch.setattr(snapshots, '_digests', {})
+    snapshots.load()
+    assert ['b'] == list(snapshots._stale)
+
+    snapshots._stale['b'].collector.snapshot_time -= 120
+    assert snapshots.stale('b', 'u', 'p', lambda: None) is None
+    assert {} == snapshots._stale
+
+def test_unchanged_document_not_rewritten(state_dir, monkeypatch, opstats):
+    monkeypatch.setattr(nexsan, 'fetch', lambda address, user, pass_: opstats)
+    nexsan.probe('a', 'u', 'p')
+    flush()
+    path = snapshots.path('a')
+    os.utime(path, (0, 0))
+    inode = os.stat(path).st_ino
+    nexsan.probe('a', 'u', 'p')
+    flush()
+    assert inode == os.stat(path).st_ino
+    assert 0 < os.stat(path).st_mtime
@@ -0,0 +1,157 @@
+import threading
+import time
+
+import pytest
+
+from nexsan_exporter import targets
+
+def test_addresses():
+    t = targets.Target('192.0.2.1, 192.0.2.2')
+    assert ['192.0.2.1', '192.0.2.2'] == t.addresses
+
+def test_no_addresses():
+    with pytest.raises(ValueError):
+        targets.Target(',')
+
+def test_fetch_single():
+    t = targets.Target('a')
+    assert 'a' == t.fetch(lambda address: address)
+
+def test_fetch_failover():
+    def fetch_one(address):
+        if address == 'a':
+            raise OSError('dead')
+        return address
+    t = targets.Target('a,b')
+    assert 'b' == t.fetch(fetch_one)
+    assert ['b', 'a'] == t.preferred()
+
+def test_fetch_all_fail():
+    def fetch_one(address):
+        raise OSError(address)
+    t = targets.Target('a,b')
+    with pytest.raises(OSError):
+        t.fetch(fetch_one)
+
+def test_fetch_hedged(monkeypatch):
+    monkeypatch.setattr(targets, 'hedge_default_delay', 0.05)
+    stuck = threading.Event()
+    def fetch_one(address):
+        if address == 'a':
+            stuck.wait(5)
+        return address
+    t = targets.Target('a,b')
+    start = time.monotonic()
+    try:
+        assert 'b' == t.fetch(fetch_one)
+    finally:
+        stuck.set()
+    assert time.monotonic() - start < 1
+
+def test_fetch_hedge_after_turn(monkeypatch):
+    monkeypatch.setattr(targets, 'hedge_default_delay', 0.05)
+    t = targets.Target('a,b')
+    # Another fetch from a holds its turn for longer than the hedge delay;
+    # waiting for the turn is not counted as a slow answer.
+    gate = t._Target__gates['a']
+    gate.acquire(time.monotonic() + 1)
+    threading.Timer(0.2, gate.release).start()
+    assert 'a' == t.fetch(lambda address: address)
+
+def test_hedge_delay_percentile(monkeypatch):
+    monkeypatch.setattr(targets, 'hedge_percentile', 50)
+    t = targets.Target('a,b')
+    for x in [0.1, 0.2, 0.3, 0.4, 0.5]:
+        t._Target__record('a', x)
+    assert 0.3 == t.hedge_delay('a')
+    assert targets.hedge_default_delay == t.hedge_delay('b')
+
+def test_fetch_concurrency_limited():
+    active = []
+    peak = []
+    lock = threading.Lock()
+    def fetch_one(address):
+        with lock:
+            active.append(address)
+            peak.append(len(active))
+        time.sleep(0.02)
+        with lock:
+            active.remove(address)
+        return address
+    t = targets.Target('a')
+    threads = [threading.Thread(target=t.fetch, args=(fetch_one,)) for i in range(4)]
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+    assert [1] * 4 == peak
+
+def test_gate_interval(monkeypatch):
+    monkeypatch.setattr(targets, 'min_fetch_interval', 0.05)
+    g = targets.Gate()
+    start = time.monotonic()
+    for i in range(3):
+        g.acquire(start + 5)
+        g.release()
+    assert time.monotonic() - start >= 0.1
+
+def test_gate_timeout(monkeypatch):
+    monkeypatch.setattr(targets, 'queue_timeouts', 0)
+    g = targets.Gate()
+    g.acquire(time.monotonic() + 1)
+    with pytest.raises(targets.QueueTimeout):
+        g.acquire(time.monotonic() + 0.01)
+    assert 1 == targets.queue_timeouts
+
+def test_gate_cancelled():
+    g = targets.Gate()
+    g.acquire(time.monotonic() + 1)
+    cancelled = threading.Event()
+    threading.Timer(0.05, lambda: (cancelled.set(), g.wake())).start()
+    start = time.monotonic()
+    assert not g.acquire(start + 5, cancelled.is_set)
+    assert time.monotonic() - start < 1
+
+def test_fetch_busy(monkeypatch):
+    monkeypatch.setattr(targets, 'busy_cpu_percent', 80)
+    monkeypatch.setattr(targets, 'busy_interval', 60)
+    count = []
+    def fetch_one(address):
+        count.append(address)
+        return len(count)
+    t = targets.Target('a')
+    c = targets.credentials('u', 'p')
+    assert 1 == t.fetch(fetch_one, c)
+    assert 2 == t.fetch(fetch_one, c)
+    t.cpu_percent = 95
+    assert 60 == t.interval()
+    assert 2 == t.fetch(fetch_one, c)
+    # Not reused for other credentials.
+    assert 3 == t.fetch(fetch_one, targets.credentials('u', 'wrong'))
+    assert 4 == t.fetch(fetch_one, c)
+    assert 4 == t.fetch(fetch_one, c)
+    t.cpu_percent = 50
+    assert 0 == t.interval()
+    assert 5 == t.fetch(fetch_one, c)
+
+def test_label_cache_values_shared():
+    c = targets.LabelCache()
+    a = c.values(['x', 'y'])
+    assert a is c.values(('x', 'y'))
+    c.rotate()
+    assert a is c.values(['x', 'y'])
+
+def test_label_cache_labels_shared():
+    c = targets.LabelCache()
+    v = c.values(['x', 'y'])
+    d = c.labels(('a', 'b'), v)
+    assert {'a': 'x', 'b': 'y'} == d
+    assert d is c.labels(('a', 'b'), v)
+    assert d is not c.labels(('c', 'd'), v)
+
+def test_label_cache_expiry():
+    c = targets.LabelCache()
+    a = c.values(['x'])
+    c.rotate()
+    c.rotate()
+    assert a is not c.values(['x'])
@@ -0,0 +1,37 @@
+import types
+
+from nexsan_exporter import timing
+
+def test_header():
+    t = timing.Timings()
+    t.phases = [('fetch', 0.0123), ('parse', 0.001)]
+    assert 'fetch;dur=12.3, parse;dur=1.0' == t.header()
+
+def test_rate_limiter():
+    r = timing.RateLimiter(2)
+    assert 0 == r.allow()
+    assert 0 == r.allow()
+    assert None is r.allow()
+    assert None is r.allow()
+    assert 2 == r.suppressed
+
+def test_rate_limiter_fractional(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(timing, 'time', types.SimpleNamespace(monotonic=lambda: now[0]))
+    r = timing.RateLimiter(0.5)
+    assert 0 == r.allow()
+    assert None is r.allow()
+    now[0] += 1
+    assert None is r.allow()
+    now[0] += 1
+    assert 2 == r.allow()
+    now[0] += 10
+    assert 0 == r.allow()
+    assert None is r.allow()
+
+def test_histogram():
+    h = timing.Histogram([1, 2])
+    for x in [0.5, 1, 1.5, 3]:
+        h.observe(x)
+    mf = h.family('x', 'doc')
+    assert [('x_bucket', {'le': '1.0'}, 2), ('x_bucket', {'le': '2.0'}, 3), ('x_bucket', {'le': '+Inf'}, 4), ('x_count', {}, 4), ('x_sum', {}, 6.0)] == mf.samples
@@ -0,0 +1,244 @@
+import http.client
+import ipaddress
+import os
+import socket
+import threading
+import time
+import urllib.request
+
+import pytest
+
+from nexsan_exporter import memfile, wsgiext
+
+def test_listen_fds_none(monkeypatch):
+    monkeypatch.delenv('LISTEN_PID', raising=False)
+    monkeypatch.delenv('LISTEN_FDS', raising=False)
+    assert [] == wsgiext.listen_fds()
+
+def test_listen_fds_other_process(monkeypatch):
+    monkeypatch.setenv('LISTEN_PID', str(os.getpid() + 1))
+    monkeypatch.setenv('LISTEN_FDS', '1')
+    assert [] == wsgiext.listen_fds()
+    assert 'LISTEN_FDS' not in os.environ
+
+def test_listen_fds(monkeypatch):
+    sock = socket.socket(socket.AF_INET6)
+    monkeypatch.setattr(wsgiext, 'SD_LISTEN_FDS_START', sock.detach())
+    monkeypatch.setenv('LISTEN_PID', str(os.getpid()))
+    monkeypatch.setenv('LISTEN_FDS', '1')
+    sockets = wsgiext.listen_fds()
+    try:
+        assert [(socket.AF_INET6, socket.SOCK_STREAM)] == [(s.family, s.type) for s in sockets]
+    finally:
+        for s in sockets:
+            s.close()
+
+def test_socket_family_without_so_domain(monkeypatch):
+    monkeypatch.delattr(socket, 'SO_DOMAIN')
+    for family in [socket.AF_INET, socket.AF_INET6, socket.AF_UNIX]:
+        with socket.socket(family) as s, socket.socket(fileno=os.dup(s.fileno())) as inherited:
+            assert family == wsgiext.socket_family(inherited)
+
+def test_inherited_socket():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    sock.listen()
+    port = sock.getsockname()[1]
+
+    def app(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [b'hello']
+
+    server = wsgiext.Server((ipaddress.ip_address('127.0.0.1'), 1), wsgiext.SilentRequestHandler, [wsgiext.Lane('default', 1)], lambda path: 'default', None, sock=sock)
+    server.set_app(app)
+    assert port == server.server_port
+    t = threading.Thread(target=server.serve_forever)
+    t.start()
+    try:
+        with urllib.request.urlopen('http://127.0.0.1:{}/'.format(port)) as resp:
+            assert b'hello' == resp.read()
+    finally:
+        server.shutdown()
+        t.join()
+        server.server_close()
+
+def test_lanes():
+    entered = threading.Event()
+    release = threading.Event()
+    def app(environ, start_response):
+        if environ['PATH_INFO'] == '/slow':
+            entered.set()
+            release.wait(5)
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [environ['PATH_INFO'].encode()]
+
+    lanes = [wsgiext.Lane('slow', 1, 1), wsgiext.Lane('fast', 1)]
+    server = wsgiext.Server((ipaddress.ip_address('127.0.0.1'), 0), wsgiext.SilentRequestHandler, lanes, lambda path: 'slow' if path == '/slow' else 'fast', None)
+    server.set_app(app)
+    port = server.server_port
+    t = threading.Thread(target=server.serve_forever)
+    t.start()
+    slow = []
+    try:
+        for i in range(2):
+            slow.append(threading.Thread(target=lambda: urllib.request.urlopen('http://127.0.0.1:{}/slow'.format(port)).read()))
+            slow[-1].start()
+            entered.wait(5)
+        while lanes[0].queued < 1:
+            time.sleep(0.01)
+
+        # The slow lane's thread is busy and its queue is full...
+        with pytest.raises(urllib.error.HTTPError) as e:
+            urllib.request.urlopen('http://127.0.0.1:{}/slow'.format(port))
+        assert 503 == e.value.code
+        assert 1 == lanes[0].rejected
+        # ... but the fast lane still answers.
+        with urllib.request.urlopen('http://127.0.0.1:{}/fast'.format(port)) as resp:
+            assert b'/fast' == resp.read()
+    finally:
+        release.set()
+        for s in slow:
+            s.join()
+        server.shutdown()
+        t.join()
+        server.server_close()
+
+def test_lane_elastic():
+    lane = wsgiext.Lane('test', max_threads=3, min_threads=1, idle_timeout=0.05)
+    assert 1 == lane.threads
+    release = threading.Event()
+    for i in range(5):
+        assert lane.submit(release.wait, 5)
+    assert 3 == lane.threads
+    assert 2 == lane.grown
+    deadline = time.monotonic() + 5
+    while lane.busy < 3 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert 2 == lane.queued
+
+    release.set()
+    deadline = time.monotonic() + 5
+    while lane.threads > 1 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert 1 == lane.threads
+    assert 2 == lane.shrunk
+    assert 0 == lane.queued
+    lane.shutdown()
+    assert 0 == lane.threads
+
+@pytest.fixture
+def keepalive_server():
+    def app(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        if environ['PATH_INFO'] == '/stream':
+            return (x for x in [b'a', b'', b'bc'])
+        return [environ['PATH_INFO'].encode()]
+
+    lanes = [wsgiext.Lane('default', 2)]
+    server = wsgiext.Server((ipaddress.ip_address('127.0.0.1'), 0), wsgiext.SilentRequestHandler, lanes, lambda path: 'default', None, keepalive_timeout=0.5, keepalive_max_requests=3)
+    server.set_app(app)
+    t = threading.Thread(target=server.serve_forever)
+    t.start()
+    yield server
+    server.shutdown()
+    t.join()
+    server.server_close()
+
+def test_keepalive(keepalive_server):
+    conn = http.client.HTTPConnection('127.0.0.1', keepalive_server.server_port)
+    conn.request('GET', '/one')
+    resp = conn.getresponse()
+    assert b'/one' == resp.read()
+    assert resp.getheader('Connection') is None
+    sock = conn.sock
+
+    conn.request('GET', '/stream')
+    resp = conn.getresponse()
+    assert 'chunked' == resp.getheader('Transfer-Encoding')
+    assert b'abc' == resp.read()
+    assert sock is conn.sock
+
+    # The third request is the last one allowed.
+    conn.request('GET', '/three')
+    resp = conn.getresponse()
+    assert 'close' == resp.getheader('Connection')
+    assert b'/three' == resp.read()
+    conn.close()
+
+def test_keepalive_head(keepalive_server):
+    conn = http.client.HTTPConnection('127.0.0.1', keepalive_server.server_port)
+    conn.request('HEAD', '/one')
+    resp = conn.getresponse()
+    assert '4' == resp.getheader('Content-Length')
+    assert b'' == resp.read()
+
+    conn.request('GET', '/stream')
+    resp = conn.getresponse()
+    assert b'abc' == resp.read()
+
+    # Without a length, the connection is closed after a HEAD response.
+    conn.request('HEAD', '/stream')
+    resp = conn.getresponse()
+    assert 'close' == resp.getheader('Connection')
+    resp.read()
+    conn.close()
+
+def test_slow_request_line(keepalive_server, monkeypatch):
+    monkeypatch.setattr(keepalive_server, 'PEEK_TIMEOUT', 5)
+    silent = [socket.create_connection(('127.0.0.1', keepalive_server.server_port)) for i in range(3)]
+    try:
+        # Connections that have not sent their request line yet do not hold
+        # up the others.
+        start = time.monotonic()
+        conn = http.client.HTTPConnection('127.0.0.1', keepalive_server.server_port)
+        conn.request('GET', '/one')
+        assert b'/one' == conn.getresponse().read()
+        conn.close()
+        assert time.monotonic() - start < 1
+
+        silent[0].sendall(b'GET /late HTTP/1.0\r\n\r\n')
+        data = b''
+        while True:
+            chunk = silent[0].recv(4096)
+            if not chunk:
+                break
+            data += chunk
+        assert data.endswith(b'\r\n\r\n/late')
+    finally:
+        for s in silent:
+            s.close()
+
+def test_keepalive_idle_timeout(keepalive_server):
+    conn = http.client.HTTPConnection('127.0.0.1', keepalive_server.server_port)
+    conn.request('GET', '/one')
+    conn.getresponse().read()
+    time.sleep(1)
+    assert b'' == conn.sock.recv(1)
+    conn.close()
+
+def test_http10_closes(keepalive_server):
+    with socket.create_connection(('127.0.0.1', keepalive_server.server_port)) as s:
+        s.sendall(b'GET /stream HTTP/1.0\r\n\r\n')
+        data = b''
+        while True:
+            chunk = s.recv(4096)
+            if not chunk:
+                break
+            data += chunk
+    assert data.endswith(b'\r\n\r\nabc')
+
+def test_sendfile(keepalive_server):
+    data = b'0123456789' * 100000
+    m = memfile.MemoryFile(data)
+    def app(environ, start_response):
+        start_response('200 OK', [])
+        return environ['wsgi.file_wrapper'](m.open())
+
+    keepalive_server.set_app(app)
+    conn = http.client.HTTPConnection('127.0.0.1', keepalive_server.server_port)
+    for i in range(2):
+        conn.request('GET', '/')
+        resp = conn.getresponse()
+        assert str(len(data)) == resp.getheader('Content-Length')
+        assert data == resp.read()
+    conn.close()